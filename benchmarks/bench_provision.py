@@ -0,0 +1,451 @@
+"""Offline benchmarks for setup_android_env.py.
+
+Builds synthetic archives shaped like the real ones (the Gradle 8.4
+distribution, the command-line tools and an NDK-sized archive with tens of
+thousands of small files), serves them from a local mirror started with
+`setup_android_env.py serve`, and times the download, extraction, template
+and end-to-end provisioning paths. Java, sdkmanager and pip are stubbed out.
+
+Results are written as JSON (benchmarks/results/<commit>.json by default) so
+runs on different commits can be compared:
+
+    python benchmarks/bench_provision.py
+    python benchmarks/bench_provision.py --compare benchmarks/results/<old>.json
+"""
+import os
+import sys
+import io
+import json
+import time
+import random
+import socket
+import shutil
+import hashlib
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import contextlib
+import zipfile
+import threading
+import http.server
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(REPO_ROOT, "setup_android_env.py")
+sys.path.insert(0, REPO_ROOT)
+
+import setup_android_env as env  # noqa: E402
+
+WRAPPER_JAR_URL = "https://raw.githubusercontent.com/gradle/gradle/v8.4.0/gradle/wrapper/gradle-wrapper.jar"
+WRAPPER_PROPERTIES_URL = "https://raw.githubusercontent.com/gradle/gradle/v8.4.0/gradle/wrapper/gradle-wrapper.properties"
+
+# Package path -> (archive name, top-level directory, file count, total MB at scale 1)
+SDK_PACKAGES = {
+    "platform-tools": ("platform-tools_r34.0.5-{host}.zip", "platform-tools", 60, 15),
+    "platforms;android-31": ("platform-31_r01.zip", "android-12", 400, 60),
+    "build-tools;31.0.0": ("build-tools_r31-{host}.zip", "android-12", 300, 55),
+    "ndk;25.2.9519653": ("android-ndk-r25c-{host}.zip", "android-ndk-r25c", 30000, 1000),
+}
+
+# Rough share of NDK files per directory, so sparse installs filter a
+# realistic fraction: host toolchain and headers, then per-ABI sysroot
+# libraries, compiler-rt and simpleperf binaries.
+NDK_TOOLCHAIN = "toolchains/llvm/prebuilt/linux-x86_64"
+NDK_LAYOUT = [
+    (f"{NDK_TOOLCHAIN}/bin", 0.08),
+    (f"{NDK_TOOLCHAIN}/lib64", 0.10),
+    (f"{NDK_TOOLCHAIN}/sysroot/usr/include", 0.22),
+    ("sources/cxx-stl/llvm-libc++/include", 0.06),
+    ("prebuilt/linux-x86_64", 0.06),
+    *[(f"{NDK_TOOLCHAIN}/sysroot/usr/lib/{triple}", 0.08)
+      for triple in ("aarch64-linux-android", "arm-linux-androideabi", "i686-linux-android", "x86_64-linux-android")],
+    *[(f"{NDK_TOOLCHAIN}/lib64/clang/14.0.7/lib/linux/{arch}", 0.03) for arch in ("aarch64", "arm", "i386", "x86_64")],
+    *[(f"simpleperf/bin/android/{arch}", 0.01) for arch in ("arm64", "arm", "x86", "x86_64")],
+]
+
+def synthetic_bytes(rng, size):
+    """Return size bytes that compress roughly like binaries and class files."""
+    half = size // 2
+    text = (b"public final class Synthetic { int field; }\n" * (half // 44 + 1))[:half]
+    return rng.randbytes(size - half) + text
+
+def write_archive(path, root, file_count, total_mb, scale, rng, executables=(), layout=None):
+    """Write a zip with file_count (scaled) files under root/ totalling total_mb (scaled).
+
+    layout optionally lists (directory, share of files) to place files in.
+    """
+    file_count = max(len(executables) + 1, int(file_count * scale))
+    total = int(total_mb * scale * 1024 * 1024)
+    # A few large files and many small ones, like real SDK archives
+    weights = [rng.paretovariate(1.2) for _ in range(file_count)]
+    scale_factor = total / sum(weights)
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+        for number, weight in enumerate(weights):
+            if number < len(executables):
+                name = executables[number]
+                data = b"#!/bin/sh\nexit 0\n"
+            else:
+                depth = "/".join(f"d{rng.randrange(20)}" for _ in range(rng.randrange(1, 5)))
+                if layout:
+                    depth = rng.choices([d for d, _ in layout], [share for _, share in layout])[0] + "/" + depth
+                name = f"{depth}/file{number}.bin"
+                data = synthetic_bytes(rng, max(1, int(weight * scale_factor)))
+            info = zipfile.ZipInfo(f"{root}/{name}", date_time=(2023, 1, 1, 0, 0, 0))
+            info.create_system = 3
+            info.external_attr = (0o100755 if number < len(executables) else 0o100644) << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            zf.writestr(info, data)
+
+def build_artifacts(directory, scale, seed):
+    """Create every synthetic artifact once; returns {upstream URL: path}."""
+    rng = random.Random(seed)
+    host = {"Windows": "windows", "Darwin": "macosx"}.get(platform.system(), "linux")
+    artifacts = {}
+    os.makedirs(directory, exist_ok=True)
+
+    def build(url, name, *args, **kwargs):
+        path = os.path.join(directory, name)
+        if not os.path.exists(path):
+            write_archive(path + ".tmp", *args, rng=rng, **kwargs)
+            os.replace(path + ".tmp", path)
+        artifacts[url] = path
+        return path
+
+    build(env.GRADLE_URL, "gradle-8.4-bin.zip", f"gradle-{env.GRADLE_VERSION}", 250, 130, scale,
+          executables=("bin/gradle", "bin/gradle.bat"))
+    build(env.command_line_tools_url(), "commandlinetools.zip", "cmdline-tools", 180, 130, scale,
+          executables=("bin/sdkmanager", "bin/sdkmanager.bat", "bin/avdmanager"))
+    for url, name in ((WRAPPER_JAR_URL, "gradle-wrapper.jar"), (WRAPPER_PROPERTIES_URL, "gradle-wrapper.properties")):
+        path = os.path.join(directory, name)
+        with open(path, "wb") as f:
+            f.write(synthetic_bytes(random.Random(name), 60000))
+        artifacts[url] = path
+
+    packages = []
+    for package_path, (archive, root, files, megabytes) in SDK_PACKAGES.items():
+        name = archive.format(host=host)
+        path = build(env.REPOSITORY_URL + name, name, root, files, megabytes, scale,
+                     layout=NDK_LAYOUT if package_path.startswith("ndk;") else None)
+        with open(path, "rb") as f:
+            sha1 = hashlib.sha1(f.read()).hexdigest()
+        packages.append(f"""<remotePackage path="{package_path}">
+<type-details xsi:type="generic:genericDetailsType"/><revision><major>1</major></revision>
+<display-name>{package_path}</display-name><uses-license ref="android-sdk-license"/><channelRef ref="channel-0"/>
+<archives><archive><complete><size>{os.path.getsize(path)}</size><checksum type="sha1">{sha1}</checksum>
+<url>{name}</url></complete></archive></archives></remotePackage>""")
+    manifest = os.path.join(directory, env.REPOSITORY_MANIFEST)
+    with open(manifest, "w") as f:
+        f.write(f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<sdk:sdk-repository xmlns:sdk="http://schemas.android.com/sdk/android/repo/repository2/03"
+    xmlns:common="http://schemas.android.com/repository/android/common/02"
+    xmlns:generic="http://schemas.android.com/repository/android/generic/02"
+    xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+<license id="android-sdk-license" type="text">Synthetic license</license>
+<channel id="channel-0">stable</channel>
+{"".join(packages)}
+</sdk:sdk-repository>
+""")
+    return artifacts, manifest
+
+def seed_mirror_cache(cache_dir, artifacts, manifest):
+    """Lay out a cache directory that `serve` exposes as the mirror."""
+    index = {"entries": {}, "hits": 0, "misses": 0, "bytes_saved": 0}
+    for url, path in artifacts.items():
+        with open(path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        blob = os.path.join(cache_dir, "artifacts", digest[:2], digest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        shutil.copyfile(path, blob)
+        index["entries"][env._cache_key(url, None)] = {
+            "url": url, "sha256": digest, "size": os.path.getsize(path), "last_used": time.time()}
+    with open(os.path.join(cache_dir, "index.json"), "w") as f:
+        json.dump(index, f)
+    repository_dir = os.path.join(cache_dir, "repository")
+    os.makedirs(repository_dir, exist_ok=True)
+    shutil.copyfile(manifest, os.path.join(repository_dir, env.REPOSITORY_MANIFEST))
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+@contextlib.contextmanager
+def mirror_server(cache_dir):
+    """Run `setup_android_env.py serve` on cache_dir; yields its URL."""
+    port = free_port()
+    process = subprocess.Popen([sys.executable, SCRIPT, "serve", "--host", "127.0.0.1", "--port", str(port)],
+                               env=dict(os.environ, ANDROID_ENV_CACHE=cache_dir),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        process.terminate()
+        process.wait()
+
+@contextlib.contextmanager
+def delayed_server(path, latency=0.0, bytes_per_second=0, stall_after=None):
+    """Serve the file at path under any URL, with injected delays; yields the server's URL.
+
+    Every response waits latency seconds, bodies are throttled to
+    bytes_per_second and, with stall_after, each response stops sending
+    after that many bytes.
+    """
+    stopped = threading.Event()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            time.sleep(latency)
+            size = os.path.getsize(path)
+            start, end = 0, size - 1
+            requested = self.headers.get("Range", "")
+            if requested.startswith("bytes="):
+                first, _, last = requested[6:].partition("-")
+                start, end = int(first), min(size - 1, int(last) if last else size - 1)
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", str(end - start + 1))
+            self.end_headers()
+            sent = 0
+            with open(path, "rb") as f:
+                f.seek(start)
+                try:
+                    while sent < end - start + 1:
+                        if stall_after is not None and sent >= stall_after:
+                            stopped.wait()
+                            return
+                        data = f.read(min(64 * 1024, end - start + 1 - sent))
+                        self.wfile.write(data)
+                        sent += len(data)
+                        if bytes_per_second:
+                            time.sleep(len(data) / bytes_per_second)
+                except OSError:
+                    pass  # the client gave up on this response
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        stopped.set()
+        server.shutdown()
+        server.server_close()
+
+class Bench:
+    """Times benchmark cases inside an isolated client cache/store/workspace."""
+
+    def __init__(self, workdir, repeat):
+        self.workdir = workdir
+        self.repeat = repeat
+        self.results = {}
+
+    def fresh_cache(self):
+        """Point the module at an empty client cache, store and Gradle user home."""
+        cache = tempfile.mkdtemp(prefix="cache-", dir=self.workdir)
+        env.CACHE_DIR = cache
+        env.STORE_DIR = os.path.join(cache, "store")
+        os.environ["GRADLE_USER_HOME"] = os.path.join(cache, "gradle-user-home")
+
+    def workspace(self):
+        path = tempfile.mkdtemp(prefix="ws-", dir=self.workdir)
+        os.chdir(path)
+        return path
+
+    def run(self, name, func, setup=None):
+        times = []
+        for _ in range(self.repeat):
+            if setup:
+                setup()
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                result = func()
+                times.append(time.perf_counter() - start)
+            if result is False:
+                raise RuntimeError(f"benchmark {name} failed")
+        self.results[name] = {"runs_s": [round(t, 4) for t in times],
+                              "median_s": round(statistics.median(times), 4),
+                              "min_s": round(min(times), 4)}
+        print(f"  {name:36} median {statistics.median(times):8.3f}s  min {min(times):8.3f}s")
+
+def stub_external_tools():
+    """Replace steps that need Java, sdkmanager or pip with no-ops."""
+    env.check_java = lambda ws: True
+    env.install_python_dependencies = lambda: None
+    env.SDK_INSTALLER = "native"
+
+def run_benchmarks(bench, artifacts):
+    gradle_archive = artifacts[env.GRADLE_URL]
+    tools_archive = artifacts[env.command_line_tools_url()]
+    ndk_archive = next(path for url, path in artifacts.items() if "android-ndk" in url)
+
+    # The synthetic Gradle archive cannot match the pinned upstream digest,
+    # and every download comes from local servers
+    env.ARTIFACT_SHA256[env.GRADLE_URL] = None
+    env.ARTIFACT_MIRRORS.clear()
+
+    def copy_to_workspace(path, name):
+        def setup():
+            bench.workspace()
+            shutil.copyfile(path, name)
+        return setup
+
+    # Downloads through the mirror, cold and from the cache
+    bench.run("download_file/gradle/cold", lambda: env.download_file(env.GRADLE_URL, "gradle.zip"),
+              setup=lambda: (bench.fresh_cache(), bench.workspace()))
+    bench.run("download_file/gradle/cached", lambda: env.download_file(env.GRADLE_URL, "gradle.zip"),
+              setup=bench.workspace)
+    bench.run("download_file/ndk/cold", lambda: env.download_file(next(u for u in artifacts if "android-ndk" in u), "ndk.zip"),
+              setup=lambda: (bench.fresh_cache(), bench.workspace()))
+
+    # Mirror selection between local servers with injected delays, without
+    # the LAN mirror: a slow origin next to a fast mirror, then a fast mirror
+    # that stalls every response after 1 MB next to a slower one
+    lan_mirror, stall_seconds = env.MIRROR_URL, env.STALL_SECONDS
+    with open(gradle_archive, "rb") as f:
+        gradle_sha256 = hashlib.sha256(f.read()).hexdigest()
+    try:
+        env.MIRROR_URL, env.STALL_SECONDS = "", 1
+        with delayed_server(gradle_archive, latency=0.2, bytes_per_second=4 * 1024 ** 2) as origin, \
+                delayed_server(gradle_archive, latency=0.05) as fast, \
+                delayed_server(gradle_archive, stall_after=1024 ** 2) as stalling:
+            origin_url = f"{origin}/gradle-8.4-bin.zip"
+            env.ARTIFACT_MIRRORS[origin + "/"] = [fast + "/"]
+            bench.run("download_file/mirrors/ranked",
+                      lambda: env.download_file(origin_url, "gradle.zip", gradle_sha256),
+                      setup=lambda: (bench.fresh_cache(), bench.workspace()))
+            env.ARTIFACT_MIRRORS[origin + "/"] = [fast + "/", stalling + "/"]
+            bench.run("download_file/mirrors/stall",
+                      lambda: env.download_file(origin_url, "gradle.zip", gradle_sha256),
+                      setup=lambda: (bench.fresh_cache(), bench.workspace()))
+            del env.ARTIFACT_MIRRORS[origin + "/"]
+    finally:
+        env.MIRROR_URL, env.STALL_SECONDS = lan_mirror, stall_seconds
+
+    # Extraction: first install into an empty store, then linked from the store
+    bench.run("extract_tools/cold", lambda: env.extract_tools(env.Workspace(), "commandlinetools.zip"),
+              setup=lambda: (bench.fresh_cache(), copy_to_workspace(tools_archive, "commandlinetools.zip")()))
+    bench.run("extract_tools/store", lambda: env.extract_tools(env.Workspace(), "commandlinetools.zip"),
+              setup=copy_to_workspace(tools_archive, "commandlinetools.zip"))
+    bench.run("extract_zip/ndk", lambda: env.extract_zip(ndk_archive, "ndk", strip_prefix="android-ndk-r25c/"),
+              setup=bench.workspace)
+    bench.run("extract_zip/ndk-sparse", lambda: env.extract_zip(ndk_archive, "ndk", strip_prefix="android-ndk-r25c/",
+                                                                include=env.NdkMemberFilter(["arm64-v8a"])),
+              setup=bench.workspace)
+
+    # Gradle: cached download, then the extraction path of download_gradle()
+    bench.fresh_cache()
+    bench.run("download_gradle/extract", lambda: env.download_gradle(env.Workspace()),
+              setup=lambda: (shutil.rmtree(env.STORE_DIR, ignore_errors=True), bench.workspace()))
+    bench.run("download_gradle/store", lambda: env.download_gradle(env.Workspace()), setup=bench.workspace)
+
+    # Templates
+    bench.run("create_android_project_template",
+              lambda: env.create_android_project_template("BenchApp", "com.example.bench"), setup=bench.workspace)
+    bench.run("create_kivy_project_template", lambda: env.create_kivy_project_template("BenchKivy"),
+              setup=bench.workspace)
+
+    def write_manifest():
+        bench.workspace()
+        projects = [{"type": "android" if n % 2 else "kivy", "app_name": f"App{n}",
+                     "package_name": f"com.example.app{n}"} for n in range(100)]
+        with open("projects.json", "w") as f:
+            json.dump(projects, f)
+    bench.run("generate_projects/100", lambda: env.generate_projects("projects.json", "out"), setup=write_manifest)
+
+    # End-to-end main(): cold host, re-run in place, new workspace on a warm host
+    stub_external_tools()
+    bench.run("main/cold", lambda: env.main(["setup"]), setup=lambda: (bench.fresh_cache(), bench.workspace()))
+    bench.run("main/rerun", lambda: env.main(["setup"]))
+    bench.run("main/new-workspace", lambda: env.main(["setup"]), setup=bench.workspace)
+
+    # Snapshot of the last provisioned workspace, restored into empty ones
+    provisioned = os.getcwd()
+    snapshot = os.path.join(bench.workdir, "toolchain.snapshot")
+    bench.run("snapshot/export", lambda: env.export_snapshot(env.Workspace(provisioned), snapshot))
+    bench.run("snapshot/restore", lambda: env.restore_snapshot(env.Workspace(), snapshot), setup=bench.workspace)
+
+    # Profiles that skip the NDK and the Python toolchain
+    bench.run("main/cold/java-only", lambda: env.main(["setup", "--profile", "java-only"]),
+              setup=lambda: (bench.fresh_cache(), bench.workspace()))
+    bench.run("main/cold/kivy-lazy", lambda: env.main(["setup", "--profile", "kivy", "--lazy"]),
+              setup=lambda: (bench.fresh_cache(), bench.workspace()))
+
+    bench.run("main/provision-many/8", lambda: env.main(["provision-many"] + [f"ws{n}" for n in range(8)]),
+              setup=lambda: (bench.fresh_cache(), bench.workspace()))
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def compare(old_path, results):
+    with open(old_path) as f:
+        old = json.load(f)
+    print(f"\nCompared with {old.get('commit')} ({old_path}):")
+    for name, result in results.items():
+        before = old["results"].get(name)
+        if before:
+            ratio = result["median_s"] / before["median_s"] if before["median_s"] else float("inf")
+            print(f"  {name:36} {before['median_s']:8.3f}s -> {result['median_s']:8.3f}s  ({ratio:5.2f}x)")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", type=float, default=0.1,
+                        help="size of the synthetic artifacts relative to the real ones (default 0.1)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workdir", help="where artifacts and scratch workspaces go (default: a temp dir)")
+    parser.add_argument("--output", help="results file (default: benchmarks/results/<commit>.json)")
+    parser.add_argument("--compare", metavar="RESULTS", help="earlier results file to compare against")
+    args = parser.parse_args(argv)
+
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="android-env-bench-"))
+    os.makedirs(workdir, exist_ok=True)
+    print(f"Building synthetic artifacts (scale {args.scale}) in {workdir}...")
+    artifacts, manifest = build_artifacts(os.path.join(workdir, f"artifacts-{args.scale}-{args.seed}"),
+                                          args.scale, args.seed)
+    mirror_cache = tempfile.mkdtemp(prefix="mirror-", dir=workdir)
+    seed_mirror_cache(mirror_cache, artifacts, manifest)
+
+    bench = Bench(workdir, args.repeat)
+    cwd = os.getcwd()
+    try:
+        with mirror_server(mirror_cache) as url:
+            env.MIRROR_URL = url
+            print(f"Mirror at {url}; running benchmarks...")
+            run_benchmarks(bench, artifacts)
+    finally:
+        os.chdir(cwd)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    commit = git_commit()
+    output = args.output or os.path.join(REPO_ROOT, "benchmarks", "results", f"{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({"commit": commit, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   "python": platform.python_version(), "platform": platform.platform(),
+                   "cpu_count": os.cpu_count(), "scale": args.scale, "repeat": args.repeat,
+                   "results": bench.results}, f, indent=1)
+    print(f"Results written to {output}")
+    if args.compare:
+        compare(args.compare, bench.results)
+
+if __name__ == "__main__":
+    main()
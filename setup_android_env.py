@@ -1,26 +1,431 @@
 import os
+import io
 import subprocess
 import platform
 import sys
 import zipfile
 import shutil
+import stat
+import string
+import csv
+import re
+import tempfile
+import contextlib
+import heapq
+import hashlib
+import mmap
+import struct
+import zlib
+import json
+import time
+import argparse
+import threading
+import urllib.parse
+import http.server
+import html
+import xml.etree.ElementTree as ET
 import requests
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
 
-def run_command(command):
-    """Run a shell command and check for errors."""
+# A setup step: `func` returns False on failure, `deps` names the steps that
+# must finish first and `weight` is a rough cost estimate (MB downloaded or
+# unpacked) used to start the longest dependency chains first.
+#
+# Steps with `inputs` (JSON-serializable: URLs, versions, component lists) and
+# an `outputs` callable (returning a fingerprint of what the step produced)
+# are incremental: they are skipped when both match the state manifest from
+# the previous run. `activate` is called instead of `func` for a skipped step,
+# e.g. to set environment variables the step would have set.
+Step = namedtuple("Step", ["name", "func", "deps", "weight", "inputs", "outputs", "activate"],
+                  defaults=(None, None, None))
+
+STATE_FILE = ".android-env-state.json"
+# Size and SHA-256 of every installed file, checked by `verify`
+INTEGRITY_FILE = ".android-env-integrity.json"
+
+# Downloads are kept in a content-addressed cache shared by all workspaces.
+if platform.system() == "Windows":
+    _default_cache = os.path.join(os.environ.get("LOCALAPPDATA", os.path.expanduser("~")), "android-env-setup")
+else:
+    _default_cache = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "android-env-setup")
+CACHE_DIR = os.environ.get("ANDROID_ENV_CACHE", _default_cache)
+CACHE_MAX_BYTES = int(float(os.environ.get("ANDROID_ENV_CACHE_MAX_GB", "20")) * 1024 ** 3)
+
+# Large downloads are split into HTTP Range segments fetched in parallel.
+DOWNLOAD_CONNECTIONS = int(os.environ.get("ANDROID_ENV_DOWNLOAD_CONNECTIONS", "8"))
+SEGMENT_MIN_BYTES = 8 * 1024 * 1024
+DOWNLOAD_BUFFER_BYTES = 1024 * 1024
+# Seconds between saves of a segmented download's resume journal
+JOURNAL_SAVE_SECONDS = 1
+
+# Every HTTP request goes through one transfer engine with keep-alive
+# connection pools per host (DOWNLOAD_CONNECTIONS connections each), at most
+# MAX_TRANSFERS requests in flight and an optional shared bandwidth budget.
+MAX_TRANSFERS = int(os.environ.get("ANDROID_ENV_MAX_TRANSFERS", "16"))
+MAX_BYTES_PER_SECOND = int(float(os.environ.get("ANDROID_ENV_MAX_MB_PER_S", "0")) * 1024 ** 2)
+
+# Unpacked archives are kept in a deduplicated store of files keyed by content
+# hash; workspaces get hardlinks (or reflinks) to the stored files.
+STORE_DIR = os.environ.get("ANDROID_ENV_STORE", os.path.join(CACHE_DIR, "store"))
+
+# Archives are extracted by a process pool; small archives stay in-process.
+EXTRACT_WORKERS = int(os.environ.get("ANDROID_ENV_EXTRACT_WORKERS", os.cpu_count() or 1))
+PARALLEL_EXTRACT_MIN_BYTES = 16 * 1024 * 1024
+
+SDK_COMPONENTS = [
+    "platform-tools",
+    "platforms;android-31",
+    "build-tools;31.0.0",
+    "ndk;25.2.9519653"
+]
+NDK_COMPONENT = next(component for component in SDK_COMPONENTS if component.startswith("ndk;"))
+# ABIs to install the NDK for, e.g. "arm64-v8a" (comma-separated); empty
+# installs the whole NDK. See NdkMemberFilter.
+NDK_ABIS = [abi for abi in os.environ.get("ANDROID_ENV_NDK_ABIS", "").split(",") if abi]
+PYTHON_PACKAGES = [
+    "buildozer",
+    "kivy",
+    "cython",
+    "pillow"
+]
+# Exact pins for PYTHON_PACKAGES and their dependencies, written by
+# `lock-python-dependencies` and committed, so every machine installs (and
+# shares wheels of) the same versions. Installs refuse to run without it.
+PYTHON_LOCK_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "requirements.lock")
+
+# Profiles select what `setup` installs: SDK components, the Python toolchain
+# and the sample projects. With --lazy, the NDK and the Python toolchain are
+# left out and installed by `ensure` when a project first needs them (the
+# Kivy template's build-android.sh calls it before every build).
+PROFILES = {
+    "full": {"sdk": SDK_COMPONENTS, "python": True, "templates": ["android", "kivy"]},
+    "java-only": {"sdk": [component for component in SDK_COMPONENTS if component != NDK_COMPONENT],
+                  "python": False, "templates": ["android"]},
+    "kivy": {"sdk": SDK_COMPONENTS, "python": True, "templates": ["kivy"]},
+    "native": {"sdk": SDK_COMPONENTS, "python": False, "templates": ["android"]},
+}
+DEFAULT_PROFILE = os.environ.get("ANDROID_ENV_PROFILE", "full")
+LAZY_COMPONENTS = ["ndk", "python"]
+
+# SDK packages are installed in-process from the Android repository manifest;
+# set ANDROID_ENV_SDK_INSTALLER=sdkmanager to use sdkmanager instead.
+REPOSITORY_URL = os.environ.get("ANDROID_REPOSITORY_URL", "https://dl.google.com/android/repository/")
+REPOSITORY_MANIFEST = "repository2-3.xml"
+SDK_INSTALLER = os.environ.get("ANDROID_ENV_SDK_INSTALLER", "native")
+
+# A LAN mirror started with `serve`; upstream URLs are rewritten to
+# <mirror>/<host>/<path> and fetched from upstream when the mirror misses.
+MIRROR_URL = os.environ.get("ANDROID_ENV_MIRROR", "").rstrip("/")
+
+# Other origins of the upstream artifacts: each upstream URL prefix maps to
+# mirror prefixes serving the same files. ANDROID_ENV_MIRRORS_FILE (or
+# --mirrors) names a JSON file adding mirrors and pinned SHA-256 digests:
+#   {"mirrors": {"<upstream prefix>": ["<mirror prefix>", ...]},
+#    "sha256": {"<upstream URL>": "<digest>"}}
+ARTIFACT_MIRRORS = {
+    "https://dl.google.com/android/repository/": ["https://dl-ssl.google.com/android/repository/"],
+    "https://services.gradle.org/distributions/": ["https://downloads.gradle.org/distributions/"],
+}
+MIRRORS_FILE = os.environ.get("ANDROID_ENV_MIRRORS_FILE", "")
+
+# The sources of a download are probed concurrently with a PROBE_BYTES Range
+# request and ranked by the expected time of the whole transfer. A segment
+# that receives less than STALL_BYTES_PER_SECOND for STALL_SECONDS moves on
+# to the next source.
+PROBE_BYTES = 256 * 1024
+PROBE_TIMEOUT = 5
+STALL_SECONDS = float(os.environ.get("ANDROID_ENV_STALL_SECONDS", "10"))
+STALL_BYTES_PER_SECOND = 32 * 1024
+
+# Remote Gradle build cache of generated Java projects, e.g. a node started
+# with `cache-node`; GRADLE_BUILD_CACHE_URL overrides it at build time.
+BUILD_CACHE_URL = os.environ.get("ANDROID_ENV_BUILD_CACHE", "")
+BUILD_CACHE_MAX_BYTES = int(float(os.environ.get("ANDROID_ENV_BUILD_CACHE_MAX_GB", "10")) * 1024 ** 3)
+BUILD_CACHE_MAX_ENTRY_BYTES = 100 * 1024 * 1024
+BUILD_CACHE_KEY = re.compile(r"[0-9a-f]{16,128}")
+
+GRADLE_VERSION = "8.4"
+GRADLE_URL = f"https://services.gradle.org/distributions/gradle-{GRADLE_VERSION}-bin.zip"
+
+# Known-good SHA-256 digests of upstream artifacts. Downloads of URLs listed
+# here are rejected if the content does not match.
+ARTIFACT_SHA256 = {
+    GRADLE_URL: "3e1af3ae886920c3ac87f7a91f816c0c7c436f276a6eefdb3da152100fef72ae",
+}
+
+# Every step, download, extraction and subprocess is recorded as a span for
+# the Chrome trace / JSON summary written by `setup --trace`.
+_trace_start = time.perf_counter()
+_trace_spans = []
+_trace_lock = threading.Lock()
+
+class Span:
+    """A timed operation with counters such as bytes_downloaded or files."""
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = dict(args)
+        self.thread = threading.current_thread().name
+        self.start = time.perf_counter()
+        self.cpu_start = time.thread_time()
+        self.wall = None
+        self.cpu = None
+
+    def add(self, **counters):
+        """Add to numeric counters, e.g. span.add(bytes_downloaded=n)."""
+        for key, value in counters.items():
+            self.args[key] = self.args.get(key, 0) + value
+
+    def set(self, **values):
+        self.args.update(values)
+
+    def finish(self):
+        self.wall = time.perf_counter() - self.start
+        # Subprocess spans report the child's CPU time instead
+        self.cpu = self.args.pop("child_cpu_s", None)
+        if self.cpu is None:
+            self.cpu = time.thread_time() - self.cpu_start
+        for counter, rate in (("bytes_downloaded", "download_mb_per_s"), ("bytes_extracted", "extract_mb_per_s")):
+            if self.args.get(counter) and self.wall > 0:
+                self.args[rate] = round(self.args[counter] / self.wall / 1024 ** 2, 2)
+        with _trace_lock:
+            _trace_spans.append(self)
+
+@contextlib.contextmanager
+def trace_span(name, category="step", **args):
+    """Record the enclosed block as a span; yields the Span for counters."""
+    span = Span(name, category, args)
+    try:
+        yield span
+    except BaseException as e:
+        span.set(error=repr(e))
+        raise
+    finally:
+        span.finish()
+
+def run_process(command, check=False, **kwargs):
+    """subprocess.run() that records a span with exit code and CPU time."""
+    label = command if isinstance(command, str) else " ".join(str(part) for part in command)
+    with trace_span(label[:120], "subprocess") as span:
+        kwargs.setdefault("shell", isinstance(command, str))
+        if os.name != "posix" or kwargs.get("capture_output") or kwargs.get("input") is not None:
+            result = subprocess.run(command, **kwargs)
+        else:
+            with subprocess.Popen(command, **kwargs) as process:
+                try:
+                    _, status, usage = os.wait4(process.pid, 0)
+                except BaseException:
+                    process.kill()
+                    raise
+                process.returncode = os.waitstatus_to_exitcode(status)
+                span.set(child_cpu_s=usage.ru_utime + usage.ru_stime)
+            result = subprocess.CompletedProcess(command, process.returncode)
+        span.set(exit_code=result.returncode)
+    if check:
+        result.check_returncode()
+    return result
+
+def write_trace(path):
+    """Write the recorded spans as a Chrome trace and a JSON summary.
+
+    The trace loads in chrome://tracing or ui.perfetto.dev. The summary
+    (path with .summary.json) lists each span's wall and CPU time and
+    counters, plus totals per category.
+    """
+    with _trace_lock:
+        spans = sorted(_trace_spans, key=lambda span: span.start)
+    threads = {}
+    events = []
+    for span in spans:
+        tid = threads.setdefault(span.thread, len(threads) + 1)
+        events.append({
+            "name": span.name, "cat": span.category, "ph": "X", "pid": os.getpid(), "tid": tid,
+            "ts": round((span.start - _trace_start) * 1e6), "dur": round(span.wall * 1e6),
+            "args": dict(span.args, cpu_s=round(span.cpu, 3)),
+        })
+    for thread, tid in threads.items():
+        events.append({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": thread}})
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    totals = {}
+    for span in spans:
+        total = totals.setdefault(span.category, {"count": 0, "wall_s": 0.0, "cpu_s": 0.0})
+        total["count"] += 1
+        total["wall_s"] = round(total["wall_s"] + span.wall, 3)
+        total["cpu_s"] = round(total["cpu_s"] + span.cpu, 3)
+        for key in ("bytes_downloaded", "bytes_extracted", "files"):
+            if key in span.args:
+                total[key] = total.get(key, 0) + span.args[key]
+    summary = {
+        "wall_s": round(time.perf_counter() - _trace_start, 3),
+        "categories": totals,
+        "spans": [{"name": span.name, "category": span.category, "thread": span.thread,
+                   "start_s": round(span.start - _trace_start, 3), "wall_s": round(span.wall, 3),
+                   "cpu_s": round(span.cpu, 3), **span.args} for span in spans],
+    }
+    summary_path = os.path.splitext(path)[0] + ".summary.json"
+    with open(summary_path, "w") as f:
+        json.dump(summary, f, indent=1)
+    print(f"Trace written to {path} (summary: {summary_path})")
+    for category, total in sorted(totals.items()):
+        print(f"  {category:12} {total['count']:4} spans  {total['wall_s']:9.1f}s wall  {total['cpu_s']:9.1f}s CPU")
+
+def run_command(command, env=None):
+    """Run a command (a shell string or an argument list) and check for errors."""
     try:
-        subprocess.run(command, check=True, shell=True)
+        run_process(command, check=True, env=env)
     except subprocess.CalledProcessError as e:
         print(f"Error while executing: {command}\n{e}")
         exit(1)
 
-def check_java():
+@contextlib.contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on path, a lock file created if missing.
+
+    The lock is taken on a fresh file handle, so it excludes other threads
+    as well as other processes (e.g. concurrent CI jobs sharing the cache).
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a+b") as f:
+        if os.name == "nt":
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass  # LK_LOCK gives up after 10 seconds; keep waiting
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+class Workspace:
+    """A directory being provisioned and the environment its tools run in.
+
+    Paths are resolved against root instead of the current directory, and
+    JAVA_HOME, GRADLE_HOME and PATH changes go to env instead of os.environ,
+    so one process can provision several workspaces at once. Scratch files
+    go to a temporary directory private to the run.
+
+    profile, lazy and ndk_abis default to what the last `setup` of the
+    workspace recorded (see PROFILES and NDK_ABIS).
+    """
+
+    def __init__(self, root=".", profile=None, lazy=None, ndk_abis=None):
+        self.root = os.path.abspath(root)
+        self.env = os.environ.copy()
+        self.lock = threading.Lock()
+        self.tmp = None
+        recorded = load_state(self).get("profile", {})
+        self.profile = profile or recorded.get("name", DEFAULT_PROFILE)
+        if self.profile not in PROFILES:
+            raise ValueError(f"Unknown profile '{self.profile}' (choose from {', '.join(PROFILES)})")
+        self.lazy = recorded.get("lazy", False) if lazy is None else lazy
+        self.ndk_abis = sorted(recorded.get("ndk_abis", NDK_ABIS) if ndk_abis is None else ndk_abis)
+        if set(self.ndk_abis) - NDK_ABI_TOKENS.keys():
+            raise ValueError(f"Unknown ABI in {', '.join(self.ndk_abis)} (choose from {', '.join(NDK_ABI_TOKENS)})")
+
+    def sdk_components(self):
+        """Return the SDK components setup installs for the profile."""
+        components = PROFILES[self.profile]["sdk"]
+        if self.lazy:
+            components = [component for component in components if component != NDK_COMPONENT]
+        return components
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def scratch(self, name):
+        """Return a path for a temporary file of this run."""
+        with self.lock:
+            if self.tmp is None:
+                os.makedirs(self.root, exist_ok=True)
+                # Inside the workspace, so cached artifacts can be hardlinked
+                self.tmp = tempfile.mkdtemp(prefix=".setup-", dir=self.root)
+        return os.path.join(self.tmp, name)
+
+    def cleanup(self):
+        with self.lock:
+            if self.tmp is not None:
+                shutil.rmtree(self.tmp, ignore_errors=True)
+                self.tmp = None
+
+    def set_tool_environment(self, home_var, home, bin_dir):
+        """Set a *_HOME variable and put the tool's bin directory first on PATH."""
+        with self.lock:
+            self.env[home_var] = home
+            self.env["PATH"] = bin_dir + os.pathsep + self.env.get("PATH", "")
+
+def fingerprint_paths(paths):
+    """Fingerprint files under paths by relative path, size, mode and mtime.
+
+    Only metadata is read, so even the NDK is fingerprinted in well under a
+    second. Returns None if any path is missing, so a step whose outputs
+    never appeared is not recorded as up to date.
+    """
+    hasher = hashlib.sha256()
+    for path in paths:
+        hasher.update(f"{path}\0".encode())
+        if not os.path.lexists(path):
+            return None
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                full = os.path.join(root, name)
+                st = os.lstat(full)
+                rel = os.path.relpath(full, path)
+                hasher.update(f"{rel}\0{st.st_size}\0{st.st_mode}\0{st.st_mtime_ns}\0".encode())
+    return hasher.hexdigest()
+
+def load_state(ws):
+    """Read the state manifest recorded by the previous run."""
+    try:
+        with open(ws.path(STATE_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_state(ws, state):
+    path = ws.path(STATE_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+def step_is_current(state, step):
+    """Return True if step's inputs and outputs match the state manifest.
+
+    A step with missing outputs (a fingerprint of None) is never current.
+    """
+    if step.outputs is None:
+        return False
+    record = state.get(step.name)
+    if record is None or record["inputs"] != step.inputs:
+        return False
+    outputs = step.outputs()
+    return outputs is not None and record["outputs"] == outputs
+
+def check_java(ws):
     """Check if Java is installed and set JAVA_HOME."""
     print("Checking Java installation...")
     
     try:
         # Try to run java -version
-        result = subprocess.run("java -version", shell=True, capture_output=True, text=True)
+        result = run_process("java -version", capture_output=True, text=True, env=ws.env)
         if result.returncode == 0:
             print("Java is already installed!")
             return True
@@ -33,16 +438,18 @@ def check_java():
         # Download OpenJDK for Windows
         print("Downloading OpenJDK...")
         jdk_url = "https://download.java.net/java/GA/jdk17.0.2/dfd4a8d0985749f896bed50d7138ee7f/8/GPL/openjdk-17.0.2_windows-x64_bin.zip"
-        run_command(f"curl -L -o jdk.zip {jdk_url}")
+        jdk_zip = ws.scratch("jdk.zip")
+        if not download_file(jdk_url, jdk_zip):
+            return False
         
         # Extract JDK
         print("Extracting JDK...")
-        run_command(f"powershell -Command \"Expand-Archive -Path jdk.zip -DestinationPath ./jdk -Force\"")
+        jdk_path = ws.path("jdk", "jdk-17.0.2")
+        install_archive(jdk_zip, jdk_path, strip_prefix="jdk-17.0.2/")
+        os.remove(jdk_zip)
         
         # Set JAVA_HOME
-        jdk_path = os.path.abspath("./jdk/jdk-17.0.2")
-        os.environ["JAVA_HOME"] = jdk_path
-        os.environ["PATH"] = f"{jdk_path}\\bin;{os.environ['PATH']}"
+        ws.set_tool_environment("JAVA_HOME", jdk_path, os.path.join(jdk_path, "bin"))
         
         print(f"Java installed and JAVA_HOME set to: {jdk_path}")
         return True
@@ -50,62 +457,386 @@ def check_java():
         print("Please install Java manually on non-Windows systems.")
         return False
 
-def download_android_tools():
-    """Download Android SDK command-line tools."""
-    print("Downloading Android command-line tools...")
+def command_line_tools_url():
+    """Return the command-line tools download URL for this platform."""
     if platform.system() == "Windows":
-        url = "https://dl.google.com/android/repository/commandlinetools-win-9477386_latest.zip"
-        filename = "commandlinetools.zip"
+        return "https://dl.google.com/android/repository/commandlinetools-win-9477386_latest.zip"
     elif platform.system() == "Darwin":
-        url = "https://dl.google.com/android/repository/commandlinetools-mac-9477386_latest.zip"
-        filename = "commandlinetools.zip"
+        return "https://dl.google.com/android/repository/commandlinetools-mac-9477386_latest.zip"
     else:
-        url = "https://dl.google.com/android/repository/commandlinetools-linux-9477386_latest.zip"
-        filename = "commandlinetools.zip"
+        return "https://dl.google.com/android/repository/commandlinetools-linux-9477386_latest.zip"
 
-    run_command(f"curl -o {filename} {url}")
+def download_android_tools(ws):
+    """Download Android SDK command-line tools."""
+    print("Downloading Android command-line tools...")
+    url = command_line_tools_url()
+    filename = ws.scratch("commandlinetools.zip")
+
+    if not download_file(url, filename):
+        return None
     print(f"Downloaded {filename}")
     return filename
 
-def extract_tools(filename):
+def _zip_member_mode(info):
+    """Return the Unix mode stored in a zip entry, or 0 if there is none."""
+    if info.create_system != 3:  # not created on Unix
+        return 0
+    return info.external_attr >> 16
+
+def _extract_members(archive, dest, members):
+    """Extract (name, relative path) pairs of regular files from archive into dest.
+
+    Runs in a worker process. Unix permission bits recorded in the archive
+    are restored; symlinks are left to _create_symlinks.
+    """
+    count = 0
+    with zipfile.ZipFile(archive) as zf:
+        for name, relpath in members:
+            info = zf.getinfo(name)
+            target = os.path.join(dest, relpath)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            mode = _zip_member_mode(info)
+            with zf.open(info) as src, open(target, "wb") as dst:
+                shutil.copyfileobj(src, dst, DOWNLOAD_BUFFER_BYTES)
+            if mode & 0o7777:
+                os.chmod(target, mode & 0o7777)
+            mtime = time.mktime(info.date_time + (0, 0, -1))
+            os.utime(target, (mtime, mtime))
+            count += 1
+    return count
+
+def _is_symlink_member(info):
+    return stat.S_ISLNK(_zip_member_mode(info)) and platform.system() != "Windows"
+
+def _refuse_paths_below_links(relpaths, links, source):
+    """Refuse any '/' path that lies below one of the symlink paths in links."""
+    for relpath in relpaths:
+        parts = relpath.split("/")
+        for depth in range(1, len(parts)):
+            if "/".join(parts[:depth]) in links:
+                raise ValueError(f"Refusing to extract {relpath!r} through a symlink from {source}")
+
+def _create_symlinks(root, links, source):
+    """Create the {'/' path: link target} symlinks below root, after every file.
+
+    Links are only checked once all of them exist, since a later link can
+    change where an earlier one resolves. Refuses links resolving outside root.
+    """
+    for relpath, link_target in sorted(links.items()):
+        target = os.path.join(root, *relpath.split("/"))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.symlink(link_target, target)
+    real_root = os.path.realpath(root)
+    for relpath, link_target in links.items():
+        resolved = os.path.realpath(os.path.join(root, *relpath.split("/")))
+        if resolved != real_root and not resolved.startswith(real_root + os.sep):
+            raise ValueError(f"Refusing symlink {relpath!r} -> {link_target!r} outside the tree from {source}")
+
+def _partition_members(members, sizes, count):
+    """Spread members over count buckets, largest compressed size first."""
+    buckets = [(0, i, []) for i in range(count)]
+    for member in sorted(members, key=lambda m: sizes[m[0]], reverse=True):
+        total, i, bucket = heapq.heappop(buckets)
+        bucket.append(member)
+        heapq.heappush(buckets, (total + sizes[member[0]], i, bucket))
+    return [bucket for _, _, bucket in buckets if bucket]
+
+def _member_parts(info, strip_prefix, archive):
+    """Return the path components of a member below strip_prefix, or None."""
+    if not info.filename.startswith(strip_prefix):
+        return None
+    relpath = info.filename[len(strip_prefix):]
+    if not relpath:
+        return None
+    return _safe_parts(relpath, info.filename, archive)
+
+def _safe_parts(relpath, name, source):
+    """Split a relative '/' path, refusing absolute paths, '..' and drives."""
+    parts = relpath.rstrip("/").split("/")
+    if relpath.startswith("/") or ".." in parts or ":" in parts[0]:
+        raise ValueError(f"Refusing to extract unsafe path {name!r} from {source}")
+    return parts
+
+def _replace_dir(staging, dest):
+    """Move a fully built staging directory to dest, replacing any old tree."""
+    old = None
+    if os.path.exists(dest):
+        old = f"{dest}.old-{os.getpid()}-{threading.get_ident()}"
+        os.rename(dest, old)
+    os.rename(staging, dest)
+    if old:
+        shutil.rmtree(old)
+
+def extract_zip(archive, dest, strip_prefix="", workers=None, include=None):
+    """Extract a zip archive into dest using a process pool.
+
+    Only members under strip_prefix are extracted, with the prefix removed.
+    include, if given, is called with the path components of each member
+    below the prefix and returns whether to extract it.
+    The archive is unpacked next to dest and then renamed into place, so dest
+    either keeps its old contents or holds the complete new tree. Returns the
+    number of extracted files.
+    """
+    with trace_span(f"extract {os.path.basename(dest)}", "extract", archive=archive) as span:
+        return _extract_zip(archive, dest, strip_prefix, workers, include, span)
+
+def _extract_zip(archive, dest, strip_prefix, workers, include, span):
+    dest = os.path.abspath(dest)
+    staging = f"{dest}.extract-{os.getpid()}-{threading.get_ident()}"
+
+    with zipfile.ZipFile(archive) as zf:
+        infos = zf.infolist()
+    members, sizes, directories, links, relpaths = [], {}, [], {}, []
+    for info in infos:
+        parts = _member_parts(info, strip_prefix, archive)
+        if not parts or (include is not None and not include(parts)):
+            continue
+        relpaths.append("/".join(parts))
+        if info.is_dir():
+            directories.append((os.path.join(staging, *parts), _zip_member_mode(info)))
+        elif _is_symlink_member(info):
+            links["/".join(parts)] = info
+        else:
+            members.append((info.filename, os.path.join(*parts)))
+            sizes[info.filename] = info.compress_size
+            span.add(bytes_extracted=info.file_size)
+    _refuse_paths_below_links(relpaths, links, archive)
+
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+    os.makedirs(staging)
+    try:
+        for directory, _ in directories:
+            os.makedirs(directory, exist_ok=True)
+        workers = workers or EXTRACT_WORKERS
+        if workers > 1 and sum(sizes.values()) >= PARALLEL_EXTRACT_MIN_BYTES:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(_extract_members, archive, staging, bucket)
+                           for bucket in _partition_members(members, sizes, workers)]
+                extracted = sum(future.result() for future in futures)
+        else:
+            extracted = _extract_members(archive, staging, members)
+        # Symlinks last, so no member is ever written through one
+        with zipfile.ZipFile(archive) as zf:
+            _create_symlinks(staging, {relpath: zf.read(info).decode() for relpath, info in links.items()},
+                             archive)
+        extracted += len(links)
+        # Directory modes last, so read-only directories can still be filled
+        for directory, mode in sorted(directories, reverse=True):
+            if mode & 0o7777:
+                os.chmod(directory, mode & 0o7777)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    _replace_dir(staging, dest)
+    span.set(files=extracted)
+    return extracted
+
+def _object_path(digest, executable):
+    name = digest + ("-x" if executable else "")
+    return os.path.join(STORE_DIR, "objects", digest[:2], name)
+
+def _tree_manifest_path(tree_key):
+    return os.path.join(STORE_DIR, "trees", tree_key + ".json")
+
+_FICLONE = 0x40049409  # Linux ioctl that makes a copy-on-write clone
+
+def _reflink(src, dst):
+    """Clone src to dst on filesystems that support it (Btrfs, XFS)."""
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+
+def link_file(src, dst):
+    """Create dst as a hardlink of src, else a reflink, else a copy."""
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    if platform.system() == "Linux":
+        try:
+            _reflink(src, dst)
+            shutil.copymode(src, dst)
+            return
+        except OSError:
+            if os.path.exists(dst):
+                os.remove(dst)
+    shutil.copy2(src, dst)
+
+def store_tree(tree_key, root):
+    """Move the files under root into the store and link them back.
+
+    Files with the same content (and executable bit) are stored once, across
+    trees and versions. Stored files are made read-only so a tool writing to
+    an installed file fails instead of changing every workspace. Writes the
+    tree's manifest and returns it.
+    """
+    manifest = {"files": {}, "symlinks": {}, "dirs": []}
+    files = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel_dir = os.path.relpath(dirpath, root)
+        for name in dirnames:
+            full = os.path.join(dirpath, name)
+            rel = os.path.normpath(os.path.join(rel_dir, name)).replace(os.sep, "/")
+            if os.path.islink(full):
+                manifest["symlinks"][rel] = os.readlink(full)
+            else:
+                manifest["dirs"].append(rel)
+        for name in filenames:
+            full = os.path.join(dirpath, name)
+            rel = os.path.normpath(os.path.join(rel_dir, name)).replace(os.sep, "/")
+            if os.path.islink(full):
+                manifest["symlinks"][rel] = os.readlink(full)
+            else:
+                files.append((full, rel))
+
+    def ingest(item):
+        full, rel = item
+        mode = os.stat(full).st_mode
+        executable = bool(mode & 0o111)
+        digest = _hash_file(full)
+        target = _object_path(digest, executable)
+        if not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            tmp = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+            link_file(full, tmp)
+            if platform.system() != "Windows":
+                os.chmod(tmp, 0o555 if executable else 0o444)
+            os.replace(tmp, target)
+        # rename() between two links of one file is a no-op, so check first
+        if not os.path.samefile(target, full):
+            replacement = f"{full}.link-tmp"
+            link_file(target, replacement)
+            os.replace(replacement, full)
+        return rel, [digest, executable, os.path.getsize(target)]
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+        manifest["files"] = dict(pool.map(ingest, files))
+
+    path = _tree_manifest_path(tree_key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+    return manifest
+
+def load_tree_manifest(tree_key):
+    """Return the stored manifest of a tree, or None if it is not stored."""
+    try:
+        with open(_tree_manifest_path(tree_key)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if all(os.path.exists(_object_path(digest, executable))
+           for digest, executable, _ in manifest["files"].values()):
+        return manifest
+    return None
+
+def store_digests():
+    """Return {(device, inode): SHA-256} of the files in the store.
+
+    Only the object directories are listed; on POSIX each entry carries its
+    inode, so no stored file is read or even stat'ed.
+    """
+    objects = os.path.join(STORE_DIR, "objects")
+    try:
+        device = os.stat(objects).st_dev
+        prefixes = os.listdir(objects)
+    except OSError:
+        return {}
+    digests = {}
+    for prefix in prefixes:
+        with os.scandir(os.path.join(objects, prefix)) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".tmp"):
+                    digests[(device, entry.inode())] = entry.name.split("-")[0]
+    return digests
+
+def materialize_tree(manifest, dest):
+    """Build dest from stored files with links, replacing it atomically."""
+    dest = os.path.abspath(dest)
+    staging = f"{dest}.link-{os.getpid()}-{threading.get_ident()}"
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+    os.makedirs(staging)
+    try:
+        for rel in manifest["dirs"]:
+            os.makedirs(os.path.join(staging, *rel.split("/")), exist_ok=True)
+        for rel, (digest, executable, _) in manifest["files"].items():
+            target = os.path.join(staging, *rel.split("/"))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            link_file(_object_path(digest, executable), target)
+        for rel, link_target in manifest["symlinks"].items():
+            target = os.path.join(staging, *rel.split("/"))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.symlink(link_target, target)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    _replace_dir(staging, dest)
+
+def _same_filesystem(path_a, path_b):
+    def existing(path):
+        path = os.path.abspath(path)
+        while not os.path.exists(path):
+            path = os.path.dirname(path)
+        return path
+    return os.stat(existing(path_a)).st_dev == os.stat(existing(path_b)).st_dev
+
+def install_archive(archive, dest, strip_prefix="", digest=None, include=None):
+    """Install the contents of a zip archive at dest through the shared store.
+
+    If the archive was unpacked before (by any workspace on this host), dest
+    is built from hardlinks in seconds; otherwise the archive is extracted and
+    its files are added to the store. When the store is on another
+    filesystem the archive is simply extracted. include selects members as
+    in extract_zip(); its `key` attribute tells trees of different
+    selections apart in the store.
+    """
+    os.makedirs(STORE_DIR, exist_ok=True)
+    if not _same_filesystem(STORE_DIR, os.path.dirname(os.path.abspath(dest))):
+        return extract_zip(archive, dest, strip_prefix, include=include)
+
+    digest = digest or _hash_file(archive)
+    selection = f"\n{include.key}" if include is not None else ""
+    tree_key = hashlib.sha256(f"{digest}\n{strip_prefix}{selection}".encode()).hexdigest()
+    manifest = load_tree_manifest(tree_key)
+    if manifest is None:
+        # Concurrent installs of the same archive extract it once
+        with file_lock(os.path.join(STORE_DIR, "locks", f"{tree_key}.lock")):
+            manifest = load_tree_manifest(tree_key)
+            if manifest is None:
+                extracted = extract_zip(archive, dest, strip_prefix, include=include)
+                with trace_span(f"store {os.path.basename(dest)}", "link", files=extracted):
+                    store_tree(tree_key, dest)
+                return extracted
+
+    print(f"Linking {os.path.basename(dest)} from the shared store")
+    with trace_span(f"link {os.path.basename(dest)}", "link", files=len(manifest["files"])):
+        materialize_tree(manifest, dest)
+    return len(manifest["files"]) + len(manifest["symlinks"])
+
+def extract_tools(ws, filename):
     """Extract Android command line tools to the correct directory structure."""
     print("Extracting Android command line tools...")
     
-    # Create the required directory structure
-    cmdline_tools_dir = os.path.join("android-sdk", "cmdline-tools")
-    tools_latest_dir = os.path.join(cmdline_tools_dir, "latest")
-    
-    # Create directories if they don't exist
-    os.makedirs(cmdline_tools_dir, exist_ok=True)
-    
-    # Extract to a temporary directory first
-    temp_dir = "temp_tools"
-    os.makedirs(temp_dir, exist_ok=True)
-    
-    if platform.system() == "Windows":
-        with zipfile.ZipFile(filename, 'r') as zip_ref:
-            zip_ref.extractall(temp_dir)
-    else:
-        subprocess.run(["unzip", "-q", filename, "-d", temp_dir], check=True)
-    
-    # Move the contents to the correct location
-    extracted_tools_dir = os.path.join(temp_dir, "cmdline-tools")
-    if os.path.exists(tools_latest_dir):
-        shutil.rmtree(tools_latest_dir)
-    shutil.move(extracted_tools_dir, tools_latest_dir)
+    # The archive's cmdline-tools/ directory becomes cmdline-tools/latest
+    tools_latest_dir = ws.path("android-sdk", "cmdline-tools", "latest")
+    os.makedirs(os.path.dirname(tools_latest_dir), exist_ok=True)
+    install_archive(filename, tools_latest_dir, strip_prefix="cmdline-tools/")
     
     # Cleanup
-    shutil.rmtree(temp_dir)
     os.remove(filename)
     
     print("Android command line tools extracted successfully")
 
-def accept_licenses():
+def accept_licenses(ws):
     """Accept all Android SDK licenses."""
     print("Accepting Android SDK licenses...")
     
     # Create licenses directory if it doesn't exist
-    licenses_dir = "./android-sdk/licenses"
+    licenses_dir = ws.path("android-sdk", "licenses")
     os.makedirs(licenses_dir, exist_ok=True)
     
     # Write license files directly
@@ -121,13 +852,350 @@ def accept_licenses():
     
     print("SDK licenses accepted.")
 
-def install_sdk_and_ndk():
-    """Install Android SDK components using sdkmanager."""
+def _repository_cache_paths():
+    directory = os.path.join(CACHE_DIR, "repository")
+    return os.path.join(directory, REPOSITORY_MANIFEST), os.path.join(directory, REPOSITORY_MANIFEST + ".meta.json")
+
+def fetch_repository_manifest():
+    """Return the SDK repository manifest XML, revalidating the cached copy.
+
+    The manifest is cached with its ETag and Last-Modified headers; an
+    unchanged manifest costs one conditional request, and the cached copy is
+    used when the repository cannot be reached.
+    """
+    manifest_path, _ = _repository_cache_paths()
+    with file_lock(manifest_path + ".lock"):
+        return _fetch_repository_manifest()
+
+def _fetch_repository_manifest():
+    url = REPOSITORY_URL + REPOSITORY_MANIFEST
+    manifest_path, meta_path = _repository_cache_paths()
+    meta = {}
+    if os.path.exists(manifest_path):
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = {}
+    headers = {}
+    if meta.get("url") == url:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    try:
+        response, errors = None, []
+        for candidate in download_candidates(url):
+            try:
+                result = transfer_engine().fetch(candidate, headers=headers)
+            except requests.RequestException as e:
+                errors.append(f"{candidate}: {e}")
+                continue
+            if result.status_code in (200, 304):
+                response = result
+                break
+            errors.append(f"{candidate}: HTTP {result.status_code}")
+        if response is None:
+            raise requests.RequestException("no source served the manifest: " + "; ".join(errors))
+        if response.status_code == 304:
+            print("SDK repository manifest is up to date")
+        else:
+            os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+            with open(manifest_path + ".tmp", "wb") as f:
+                f.write(response.content)
+            os.replace(manifest_path + ".tmp", manifest_path)
+            with open(meta_path, "w") as f:
+                json.dump({"url": url, "etag": response.headers.get("ETag"),
+                           "last_modified": response.headers.get("Last-Modified")}, f)
+    except requests.RequestException as e:
+        if meta.get("url") != url:
+            raise
+        print(f"Could not revalidate SDK repository manifest ({e}), using cached copy")
+
+    with open(manifest_path, "rb") as f:
+        return f.read()
+
+def _host_os():
+    return {"Windows": "windows", "Darwin": "macosx"}.get(platform.system(), "linux")
+
+def _host_arch():
+    return "aarch64" if platform.machine().lower() in ("arm64", "aarch64") else "x64"
+
+def _select_archive(package):
+    """Return the archive element of a remotePackage that fits this host."""
+    fallback = None
+    for archive in package.iter("archive"):
+        host_os = archive.findtext("host-os")
+        host_arch = archive.findtext("host-arch")
+        if host_os not in (None, _host_os()):
+            continue
+        if host_arch in (None, _host_arch()):
+            return archive
+        fallback = fallback or archive
+    return fallback
+
+def resolve_sdk_packages(manifest, components):
+    """Map SDK component paths to their remotePackage elements.
+
+    Stable channel packages are preferred. Returns (packages, licenses) where
+    licenses maps license ids to their text.
+    """
+    root = ET.fromstring(manifest)
+    licenses = {license.get("id"): license.text or "" for license in root.iter("license")}
+    channels = {channel.get("id"): channel.text for channel in root.iter("channel")}
+    packages = {}
+    for package in root.iter("remotePackage"):
+        path = package.get("path")
+        if path not in components or _select_archive(package) is None:
+            continue
+        channel_ref = package.find("channelRef")
+        stable = channel_ref is None or channels.get(channel_ref.get("ref")) == "stable"
+        if path not in packages or stable:
+            packages[path] = package
+    return packages, licenses
+
+def _manifest_namespaces(manifest):
+    """Return the prefix -> URI namespace declarations of the manifest."""
+    namespaces = {}
+    for _, (prefix, uri) in ET.iterparse(io.BytesIO(manifest), events=("start-ns",)):
+        namespaces.setdefault(prefix, uri)
+    return namespaces
+
+def write_package_xml(package, install_dir, licenses, namespaces):
+    """Write the package.xml that sdkmanager keeps in each installed package."""
+    local = ET.Element("localPackage", {"path": package.get("path"), "obsolete": package.get("obsolete", "false")})
+    used_licenses = []
+    for child in package:
+        if child.tag in ("archives", "channelRef"):
+            continue
+        local.append(child)
+        if child.tag == "uses-license":
+            used_licenses.append(child.get("ref"))
+
+    for prefix, uri in namespaces.items():
+        if prefix:
+            ET.register_namespace(prefix, uri)
+    # Attribute values such as xsi:type="generic:genericDetailsType" refer to
+    # prefixes, so every declaration from the manifest is repeated here.
+    declarations = " ".join(f'xmlns:{prefix}="{uri}"' for prefix, uri in namespaces.items() if prefix)
+    common = "http://schemas.android.com/repository/android/common/02"
+    if common not in namespaces.values():
+        declarations += f' xmlns:common="{common}"'
+    prefix = next((p for p, uri in namespaces.items() if uri == common and p), "common")
+
+    with open(os.path.join(install_dir, "package.xml"), "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n')
+        f.write(f"<{prefix}:repository {declarations}>")
+        for license_id in used_licenses:
+            license = ET.Element("license", {"id": license_id, "type": "text"})
+            license.text = licenses.get(license_id, "")
+            f.write(ET.tostring(license, encoding="unicode"))
+        f.write(ET.tostring(local, encoding="unicode"))
+        f.write(f"</{prefix}:repository>\n")
+
+def accept_package_licenses(sdk_root, license_texts):
+    """Record acceptance of licenses the way sdkmanager --licenses does."""
+    licenses_dir = os.path.join(sdk_root, "licenses")
+    os.makedirs(licenses_dir, exist_ok=True)
+    for license_id, text in license_texts.items():
+        digest = hashlib.sha1(text.strip().encode()).hexdigest()
+        path = os.path.join(licenses_dir, license_id)
+        existing = open(path).read().split() if os.path.exists(path) else []
+        if digest not in existing:
+            with open(path, "a") as f:
+                f.write(f"\n{digest}")
+
+def _archive_root_prefix(archive):
+    """Return "dir/" if every member of the archive lives under dir/."""
+    with zipfile.ZipFile(archive) as zf:
+        return _common_root_prefix(zf.namelist())
+
+def _common_root_prefix(names):
+    roots = {name.split("/", 1)[0] for name in names}
+    if len(roots) == 1:
+        root = roots.pop()
+        return root + "/"
+    return ""
+
+def _package_archive_url(package):
+    """Return (url, sha1) of the archive of a remotePackage for this host."""
+    complete = _select_archive(package).find("complete")
+    url = complete.findtext("url")
+    if "://" not in url:
+        url = REPOSITORY_URL + url
+    checksum = complete.find("checksum")
+    sha1 = checksum.text.strip() if checksum is not None and checksum.get("type", "sha1") == "sha1" else None
+    return url, sha1
+
+# Directory names and file name fragments that belong to one ABI in the NDK:
+# the ABI itself, its target triple and architecture names (sysroot libraries,
+# compiler-rt and simpleperf), and the prefixes of its clang wrappers.
+NDK_ABI_TOKENS = {
+    "arm64-v8a": ({"arm64-v8a", "aarch64-linux-android", "aarch64", "arm64", "android-arm64"},
+                  ("aarch64-linux-android", "-aarch64-android")),
+    "armeabi-v7a": ({"armeabi-v7a", "arm-linux-androideabi", "arm", "android-arm"},
+                    ("arm-linux-androideabi", "armv7a-linux-androideabi", "-arm-android")),
+    "x86": ({"x86", "i686-linux-android", "i686", "i386", "android-x86"},
+            ("i686-linux-android", "-i686-android")),
+    "x86_64": ({"x86_64", "x86_64-linux-android", "android-x86_64"},
+               ("x86_64-linux-android", "-x86_64-android")),
+}
+NDK_HOST_TAGS = {"Linux": "linux-x86_64", "Darwin": "darwin-x86_64", "Windows": "windows-x86_64"}
+SPARSE_FILE = ".sparse.json"
+
+class NdkMemberFilter:
+    """Selects the NDK files needed to build for some ABIs on this host.
+
+    Files of other ABIs (sysroot libraries, compiler-rt, simpleperf, clang
+    wrappers) and prebuilts of other hosts are left out; headers, build
+    scripts, meta/ and the host toolchain stay, so ndk-build, CMake and
+    python-for-android work for the selected ABIs.
+    """
+
+    def __init__(self, abis, host_tag=None):
+        unknown = set(abis) - NDK_ABI_TOKENS.keys()
+        if unknown:
+            raise ValueError(f"Unknown ABI {', '.join(sorted(unknown))} "
+                             f"(choose from {', '.join(NDK_ABI_TOKENS)})")
+        self.abis = sorted(abis)
+        self.host_tag = host_tag or NDK_HOST_TAGS.get(platform.system(), "linux-x86_64")
+        # Part of the store tree key; bump the version when the selection changes
+        self.key = f"ndk-sparse-2 {self.host_tag} {','.join(self.abis)}"
+        self.excluded_dirs = set()
+        self.excluded_names = []
+        for abi, (dirs, names) in NDK_ABI_TOKENS.items():
+            if abi not in self.abis:
+                self.excluded_dirs |= dirs
+                self.excluded_names.extend(names)
+        # Whole host tags only: bare OS names also name target directories,
+        # e.g. compiler-rt for Android lives in lib/clang/*/lib/linux/
+        self.excluded_dirs |= {tag for tag in NDK_HOST_TAGS.values() if tag != self.host_tag}
+
+    def __call__(self, parts):
+        if any(part in self.excluded_dirs for part in parts):
+            return False
+        return not any(fragment in parts[-1] for fragment in self.excluded_names)
+
+def ndk_installed_abis(ndk_dir):
+    """Return the ABIs a sparse NDK at ndk_dir has, or None for a complete one."""
+    try:
+        with open(os.path.join(ndk_dir, SPARSE_FILE)) as f:
+            return json.load(f)["abis"]
+    except FileNotFoundError:
+        return None
+
+def install_sdk_package(package, sdk_root, licenses, namespaces, ndk_abis=None):
+    """Download and unpack one SDK package, then write its package.xml.
+
+    With ndk_abis, an NDK package is installed sparsely (see
+    NdkMemberFilter) and the selection is recorded in its .sparse.json.
+    """
+    path = package.get("path")
+    url, sha1 = _package_archive_url(package)
+    include = NdkMemberFilter(ndk_abis) if ndk_abis and path.startswith("ndk;") else None
+
+    print(f"Installing {path}" + (f" for {', '.join(include.abis)}..." if include else "..."))
+    with trace_span(f"install {path}", "sdk-package", sparse=include is not None):
+        blob = fetch_artifact(url, sha1=sha1)
+        install_dir = os.path.join(sdk_root, *path.split(";"))
+        os.makedirs(os.path.dirname(install_dir), exist_ok=True)
+        install_archive(blob, install_dir, strip_prefix=_archive_root_prefix(blob),
+                        digest=os.path.basename(blob), include=include)
+        if include is not None:
+            with open(os.path.join(install_dir, SPARSE_FILE), "w") as f:
+                json.dump({"abis": include.abis, "host": include.host_tag}, f)
+        write_package_xml(package, install_dir, licenses, namespaces)
+    print(f"Successfully installed {path}")
+
+def install_sdk_packages_natively(sdk_root, components, ndk_abis=None):
+    """Install SDK components without sdkmanager.
+
+    The repository manifest is parsed once and all packages are downloaded
+    and unpacked concurrently. Returns the components that could not be
+    installed.
+    """
+    try:
+        manifest = fetch_repository_manifest()
+        packages, licenses = resolve_sdk_packages(manifest, components)
+        namespaces = _manifest_namespaces(manifest)
+    except (requests.RequestException, OSError, ET.ParseError) as e:
+        print(f"Could not read the SDK repository manifest: {e}")
+        return list(components)
+
+    missing = [component for component in components if component not in packages]
+    for component in missing:
+        print(f"{component} was not found in the SDK repository")
+    used = {ref.get("ref") for package in packages.values() for ref in package.iter("uses-license")}
+    accept_package_licenses(sdk_root, {license_id: licenses[license_id]
+                                       for license_id in used if license_id in licenses})
+
+    failed = list(missing)
+    with ThreadPoolExecutor(max_workers=max(1, len(packages))) as pool:
+        futures = {pool.submit(install_sdk_package, package, sdk_root, licenses, namespaces, ndk_abis): path
+                   for path, package in packages.items()}
+        for future, path in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error installing {path}: {e}")
+                failed.append(path)
+    return failed
+
+def sdk_component_installed(ws, component):
+    """Whether an SDK component is installed as the workspace wants it."""
+    install_dir = ws.path("android-sdk", *component.split(";"))
+    if not os.path.exists(os.path.join(install_dir, "package.xml")):
+        return False
+    # A sparse NDK must cover the requested ABIs
+    abis = ndk_installed_abis(install_dir) if component.startswith("ndk;") else None
+    return abis is None or (bool(ws.ndk_abis) and set(ws.ndk_abis) <= set(abis))
+
+def expand_ndk(ws, abis):
+    """Add ABIs to a sparse NDK, or complete it if abis is empty.
+
+    The NDK is unpacked again from the cached archive with the wider
+    selection. Returns True on success.
+    """
+    unknown = set(abis) - NDK_ABI_TOKENS.keys()
+    if unknown:
+        print(f"Unknown ABI {', '.join(sorted(unknown))} (choose from {', '.join(NDK_ABI_TOKENS)})")
+        return False
+    ndk_dir = ws.path("android-sdk", *NDK_COMPONENT.split(";"))
+    if not os.path.exists(os.path.join(ndk_dir, "package.xml")):
+        print(f"{NDK_COMPONENT} is not installed in {ws.root}")
+        return False
+    installed = ndk_installed_abis(ndk_dir)
+    if installed is None:
+        print(f"{NDK_COMPONENT} is already complete")
+        return True
+    wanted = sorted(set(installed) | set(abis)) if abis else []
+    if set(wanted) == NDK_ABI_TOKENS.keys():
+        wanted = []
+    if wanted == sorted(installed):
+        print(f"{NDK_COMPONENT} already has {', '.join(installed)}")
+        return True
+    ws.ndk_abis = wanted
+    print(f"Expanding {NDK_COMPONENT} to " + (", ".join(wanted) if wanted else "all ABIs"))
+    if install_sdk_and_ndk(ws, [NDK_COMPONENT]) is False:
+        return False
+    record_integrity(ws, [ndk_dir])
+    with ws.lock:
+        state = load_state(ws)
+        state.setdefault("profile", {"name": ws.profile, "lazy": ws.lazy})["ndk_abis"] = wanted
+        save_state(ws, state)
+    return True
+
+def install_sdk_and_ndk(ws, components=None):
+    """Install Android SDK components, natively or using sdkmanager.
+
+    components defaults to those of the workspace's profile.
+    """
     print("Installing Android SDK components...")
     
     # Set up environment variables
-    env = os.environ.copy()
-    sdk_root = os.path.abspath("android-sdk")
+    env = ws.env.copy()
+    sdk_root = ws.path("android-sdk")
     env["ANDROID_HOME"] = sdk_root
     env["ANDROID_SDK_ROOT"] = sdk_root
     
@@ -136,13 +1204,30 @@ def install_sdk_and_ndk():
         sdkmanager = os.path.join(sdk_root, "cmdline-tools", "latest", "bin", "sdkmanager.bat")
     else:
         sdkmanager = os.path.join(sdk_root, "cmdline-tools", "latest", "bin", "sdkmanager")
-        # Make sdkmanager executable on Unix systems
-        os.chmod(sdkmanager, 0o755)
     
+    pending = [component for component in (components or ws.sdk_components())
+               if not sdk_component_installed(ws, component)]
+    if not pending:
+        print("All Android SDK components are already installed")
+        return True
+    
+    if SDK_INSTALLER == "native":
+        pending = install_sdk_packages_natively(sdk_root, pending, ws.ndk_abis)
+        if not pending:
+            print("\nAndroid SDK components installation completed")
+            return True
+        print("Falling back to sdkmanager for: " + ", ".join(pending))
+    
+    if NDK_COMPONENT in pending:
+        if ws.ndk_abis:
+            print("Note: sdkmanager installs the complete NDK, not only " + ", ".join(ws.ndk_abis))
+        # sdkmanager would take a sparse NDK for a complete one
+        shutil.rmtree(os.path.join(sdk_root, *NDK_COMPONENT.split(";")), ignore_errors=True)
+
     # Accept licenses first (automatically)
     print("Accepting Android SDK licenses...")
     if platform.system() == "Windows":
-        subprocess.run(f'echo y | "{sdkmanager}" --licenses', shell=True, env=env)
+        run_process(f'echo y | "{sdkmanager}" --licenses', env=env)
         # Additional Windows-specific license acceptance
         licenses = [
             "android-sdk-license",
@@ -159,17 +1244,11 @@ def install_sdk_and_ndk():
                 f.write("\n8933bad161af4178b1185d1a37fbf41ea5269c55\n")
                 f.write("\nd56f5187479451eabf01fb78af6dfcb131a6481e\n")
     else:
-        subprocess.run(f'yes | "{sdkmanager}" --licenses', shell=True, env=env)
+        run_process(f'yes | "{sdkmanager}" --licenses', env=env)
     
     # Install components one by one with proper error handling
-    components = [
-        "platform-tools",
-        "platforms;android-31",
-        "build-tools;31.0.0",
-        "ndk;25.2.9519653"
-    ]
-    
-    for component in components:
+    failed = []
+    for component in pending:
         print(f"\nInstalling {component}...")
         try:
             # Use yes command to automatically accept any prompts
@@ -177,41 +1256,1304 @@ def install_sdk_and_ndk():
                 cmd = f'echo y | "{sdkmanager}" "{component}"'
             else:
                 cmd = f'yes | "{sdkmanager}" "{component}"'
-            subprocess.run(cmd, shell=True, env=env, check=True)
+            run_process(cmd, env=env, check=True)
             print(f"Successfully installed {component}")
         except subprocess.CalledProcessError as e:
             print(f"Error installing {component}: {e}")
             print("Continuing with remaining components...")
+            failed.append(component)
             continue
 
-    print("\nAndroid SDK components installation completed")
+    print("\nAndroid SDK components installation completed")
+    if failed:
+        print(f"Failed to install: {', '.join(failed)}")
+        return False
+    return True
+
+def cache_lock():
+    """Lock guarding the cache index, shared by all processes on the host."""
+    return file_lock(os.path.join(CACHE_DIR, "locks", "index.lock"))
+
+def _cache_index_path():
+    return os.path.join(CACHE_DIR, "index.json")
+
+def _load_cache_index():
+    """Read the cache index; callers must hold cache_lock()."""
+    try:
+        with open(_cache_index_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"entries": {}, "hits": 0, "misses": 0, "bytes_saved": 0}
+
+def _save_cache_index(index):
+    """Atomically replace the cache index; callers must hold cache_lock()."""
+    tmp_path = f"{_cache_index_path()}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp_path, _cache_index_path())
+
+def _cache_key(url, sha256):
+    return hashlib.sha256(f"{url}\n{sha256 or ''}".encode()).hexdigest()
+
+def _blob_path(digest):
+    return os.path.join(CACHE_DIR, "artifacts", digest[:2], digest)
+
+def _evict_cache(index, keep):
+    """Drop least recently used blobs until the cache fits CACHE_MAX_BYTES."""
+    blobs = {}
+    for entry in index["entries"].values():
+        blob = blobs.setdefault(entry["sha256"], {"size": entry["size"], "last_used": 0})
+        blob["last_used"] = max(blob["last_used"], entry["last_used"])
+
+    total = sum(blob["size"] for blob in blobs.values())
+    for digest, blob in sorted(blobs.items(), key=lambda item: item[1]["last_used"]):
+        if total <= CACHE_MAX_BYTES:
+            break
+        if digest == keep:
+            continue
+        try:
+            os.remove(_blob_path(digest))
+        except FileNotFoundError:
+            pass
+        index["entries"] = {key: entry for key, entry in index["entries"].items()
+                            if entry["sha256"] != digest}
+        total -= blob["size"]
+
+class BandwidthBudget:
+    """Token bucket shared by all transfers; 0 bytes per second means no limit."""
+
+    def __init__(self, bytes_per_second):
+        self.rate = bytes_per_second
+        self.tokens = bytes_per_second
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n):
+        """Block until n more bytes fit in the budget."""
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= n
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+class TransferStalled(IOError):
+    """A response body arrived slower than the minimum rate of its transfer."""
+
+# latency is the time until the response headers arrived, duration the time
+# spent reading the body.
+TransferResult = namedtuple("TransferResult", ["url", "status_code", "headers", "content", "size",
+                                               "latency", "duration"])
+
+class TransferEngine:
+    """Runs HTTP transfers on a shared thread pool.
+
+    Each scheme and host gets its own requests Session, so connections are
+    kept alive and reused across downloads. A transfer waits for a slot of
+    its host (at most per_host at once), then the blocking request runs on
+    one of the max_transfers threads of the pool and its body is metered
+    against the bandwidth budget. fetch() can be called from any thread
+    except the pool's own (e.g. from a sink).
+    """
+
+    def __init__(self, max_transfers=None, per_host=None, bytes_per_second=None):
+        self.max_transfers = max_transfers or MAX_TRANSFERS
+        self.per_host = per_host or DOWNLOAD_CONNECTIONS
+        self.budget = BandwidthBudget(MAX_BYTES_PER_SECOND if bytes_per_second is None else bytes_per_second)
+        self.hosts = {}
+        self.hosts_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=self.max_transfers, thread_name_prefix="transfer")
+
+    def _host(self, url):
+        """Return the (session, semaphore) of url's host."""
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        with self.hosts_lock:
+            if key not in self.hosts:
+                session = requests.Session()
+                # Redirects (e.g. to a CDN) reuse the session, so keep a few hosts
+                adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=self.per_host)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.hosts[key] = (session, threading.BoundedSemaphore(self.per_host))
+            return self.hosts[key]
+
+    def _request(self, session, url, method, headers, sink, partial, timeout, min_rate):
+        with session.request(method, url, headers=headers, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            latency = response.elapsed.total_seconds()
+            if method == "HEAD" or (partial and response.status_code != 206):
+                return TransferResult(response.url, response.status_code, response.headers, None, 0, latency, 0)
+            start = time.perf_counter()
+            response.raw.decode_content = True
+            body = io.BytesIO() if sink is None else None
+            buffer = bytearray(DOWNLOAD_BUFFER_BYTES)
+            view = memoryview(buffer)
+            # A read waits for the whole view to fill; with a minimum rate, one
+            # read takes over a second only if the source is below that rate.
+            # The bandwidth budget slows transfers on purpose, so it is exempt.
+            if min_rate and not self.budget.rate:
+                view = view[:min(len(view), int(min_rate))]
+            else:
+                min_rate = None
+            size = window_bytes = 0
+            window_start = time.monotonic()
+            while True:
+                n = response.raw.readinto(view)
+                if not n:
+                    break
+                self.budget.consume(n)
+                if body is None:
+                    sink(view[:n])
+                else:
+                    body.write(view[:n])
+                size += n
+                if min_rate:
+                    window_bytes += n
+                    elapsed = time.monotonic() - window_start
+                    if elapsed >= STALL_SECONDS:
+                        if window_bytes < min_rate * elapsed:
+                            raise TransferStalled(f"{url} slowed to {window_bytes / elapsed / 1024:.1f} KB/s")
+                        window_start, window_bytes = time.monotonic(), 0
+            return TransferResult(response.url, response.status_code, response.headers,
+                                  body.getvalue() if body is not None else None, size,
+                                  latency, time.perf_counter() - start)
+
+    def fetch(self, url, headers=None, sink=None, method="GET", partial=False, timeout=60, min_rate=None):
+        """Fetch url and return a TransferResult.
+
+        The body is passed to sink chunk by chunk if given (content is then
+        None), otherwise returned as content. With partial=True only a 206
+        response has its body read, so callers can check for Range support
+        without downloading a whole file. timeout limits the connection and
+        every wait for data, in seconds; with min_rate (bytes per second) a
+        body slower than that over STALL_SECONDS raises TransferStalled.
+        HTTP errors raise requests.HTTPError.
+        """
+        session, host_limit = self._host(url)
+        # The host slot is taken before a pool thread, so a busy host never
+        # holds up transfers from the others
+        with host_limit:
+            return self.executor.submit(self._request, session, url, method, headers, sink, partial,
+                                        timeout, min_rate).result()
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def transfer_engine():
+    """Return the shared TransferEngine, starting it on first use."""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = TransferEngine()
+        return _engine
+
+def _range_total(response):
+    """Return (size, etag) from the response to a Range request, or (None, None)."""
+    content_range = response.headers.get("Content-Range", "")
+    if response.status_code != 206 or "/" not in content_range:
+        return None, None
+    total = content_range.rsplit("/", 1)[1]
+    if not total.isdigit():
+        return None, None
+    return int(total), response.headers.get("ETag")
+
+def _probe_download(url):
+    """Return (size, etag) of url if the server supports Range requests."""
+    return _range_total(transfer_engine().fetch(url, headers={"Range": "bytes=0-0", "Accept-Encoding": "identity"},
+                                                partial=True))
+
+# A download source as measured by probe_source(): latency is the time to the
+# response headers, rate the throughput of the probe body (None without one)
+# and size is None if the source does not support Range requests.
+Source = namedtuple("Source", ["url", "size", "etag", "latency", "rate"])
+
+def probe_source(url):
+    """Fetch the first PROBE_BYTES of url and return its Source."""
+    response = transfer_engine().fetch(url, headers={"Range": f"bytes=0-{PROBE_BYTES - 1}",
+                                                     "Accept-Encoding": "identity"},
+                                       partial=True, timeout=PROBE_TIMEOUT)
+    size, etag = _range_total(response)
+    rate = response.size / response.duration if response.size and response.duration else None
+    return Source(url, size, etag, response.latency, rate)
+
+def _expected_seconds(source):
+    """Sort key of a Source: Range support first, then the expected download time."""
+    if source.size is None:
+        return (1, source.latency)
+    remaining = max(0, source.size - PROBE_BYTES)
+    return (0, source.latency + (remaining / source.rate if source.rate else 0))
+
+def rank_sources(candidates):
+    """Probe candidate URLs concurrently; return the Sources that answered, best first.
+
+    Probing stops after PROBE_TIMEOUT, or as soon as the candidates still
+    pending could not beat the best answer: their latency alone already
+    exceeds its expected download time. Sources whose size differs from
+    the best one are dropped, so segments can move between the rest; the
+    candidates still pending follow as last resorts. Raises IOError if no
+    candidate answered.
+    """
+    start = time.monotonic()
+    pool = ThreadPoolExecutor(max_workers=len(candidates), thread_name_prefix="probe")
+    futures = {pool.submit(probe_source, candidate): candidate for candidate in candidates}
+    pending, sources, errors = set(futures), [], []
+    while pending:
+        done, pending = wait(pending, timeout=max(0, start + PROBE_TIMEOUT - time.monotonic()),
+                             return_when=FIRST_COMPLETED)
+        if not done:
+            errors += [f"{futures[future]}: no answer within {PROBE_TIMEOUT} s" for future in pending]
+            break
+        for future in done:
+            try:
+                sources.append(future.result())
+            except Exception as e:
+                errors.append(f"{futures[future]}: {e}")
+        if sources:
+            best = min(map(_expected_seconds, sources))
+            if best[0] == 0 and time.monotonic() - start >= best[1]:
+                break
+    # Probes still running are abandoned; PROBE_TIMEOUT bounds them
+    pool.shutdown(wait=False)
+    if not sources:
+        raise IOError("no download source answered: " + "; ".join(errors))
+    sources.sort(key=_expected_seconds)
+    best = sources[0]
+    for source in sources[1:]:
+        if source.size != best.size:
+            print(f"Skipping {source.url}: size {source.size}, expected {best.size}")
+    return ([source for source in sources if source.size == best.size]
+            + [Source(futures[future], best.size, None, None, None)
+               for future in futures if future in pending])
+
+def _plan_segments(size):
+    """Split size bytes into [start, end, done] segments, end exclusive."""
+    count = max(1, min(DOWNLOAD_CONNECTIONS, size // SEGMENT_MIN_BYTES))
+    step = -(-size // count)
+    return [[start, min(start + step, size), 0] for start in range(0, size, step)]
+
+def _load_journal(journal_path, path, url, size, etag):
+    """Return the segments of an interrupted download of the same content."""
+    try:
+        with open(journal_path) as f:
+            journal = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if (journal.get("url") != url or journal.get("size") != size or journal.get("etag") != etag
+            or not os.path.exists(path) or os.path.getsize(path) != size):
+        return None
+    return journal["segments"]
+
+def _fetch_segment(url, path, segment, save_journal, cancelled):
+    """Fetch the missing part of one segment into its place in path.
+
+    A source that stops sending raises a requests timeout and one that
+    slows to a trickle raises TransferStalled, after STALL_SECONDS. Setting
+    cancelled stops the transfer at the next chunk.
+    """
+    start, end, done = segment
+    headers = {"Range": f"bytes={start + done}-{end - 1}", "Accept-Encoding": "identity"}
+    # Unbuffered, so the progress any segment saves in the journal is
+    # already in the file when the process is killed
+    with open(path, "r+b", buffering=0) as f:
+        f.seek(start + done)
+
+        def write(chunk):
+            if cancelled.is_set():
+                raise IOError(f"download of {url} cancelled")
+            if segment[2] + len(chunk) > end - start:
+                raise IOError(f"server sent more than the requested range of {url}")
+            while chunk:
+                written = f.write(chunk)
+                segment[2] += written
+                chunk = chunk[written:]
+            save_journal(force=False)
+
+        response = transfer_engine().fetch(url, headers=headers, sink=write, partial=True,
+                                           timeout=STALL_SECONDS, min_rate=STALL_BYTES_PER_SECOND)
+    if response.status_code != 206:
+        raise IOError(f"server ignored Range request for {url}")
+    if segment[2] < end - start:
+        raise IOError(f"connection closed early while downloading {url}")
+
+def _stream_to_file(url, path):
+    """Download url into path over a single connection, without resuming."""
+    hasher = hashlib.sha256()
+    with open(path, "wb") as f:
+        def write(chunk):
+            hasher.update(chunk)
+            f.write(chunk)
+        response = transfer_engine().fetch(url, sink=write)
+    return hasher.hexdigest(), response.size
+
+def _hash_file(path, algorithm="sha256"):
+    hasher = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(4 * DOWNLOAD_BUFFER_BYTES), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+def _download_to_file(url, path, candidates=None, verified=False):
+    """Download url into path, returning (sha256, size) of the content.
+
+    candidates are the URLs serving url's content (default: url itself);
+    several are ranked by rank_sources() and the fastest is used. When the
+    sources support Range requests the file is fetched as parallel
+    segments, and progress is recorded in a sidecar journal (path + ".json")
+    so that an interrupted download resumes where it stopped. If the caller
+    checks the result against a digest (verified), a segment that fails or
+    stalls continues from the next source; otherwise sources are never
+    mixed and the next one starts over. Servers without Range support, and
+    empty files, get a plain streamed download.
+    """
+    candidates = candidates or [url]
+    name = os.path.basename(urllib.parse.urlsplit(url).path) or url
+    with trace_span(f"download {name}", "download", url=url) as span:
+        try:
+            sources = ([Source(candidates[0], *_probe_download(candidates[0]), None, None)]
+                       if len(candidates) == 1 else rank_sources(candidates))
+        except IOError as e:
+            # e.g. 416 for an empty file, or a 4xx from a server rejecting Range
+            print(f"Range request failed ({e}), streaming instead")
+            sources = [Source(candidate, None, None, None, None) for candidate in candidates]
+        if sources[0].latency is None:
+            print(f"Downloading from {sources[0].url}")
+        else:
+            best = sources[0]
+            speed = f", {best.rate / 1024 ** 2:.1f} MB/s" if best.rate else ""
+            print(f"Downloading from {best.url} ({best.latency * 1000:.0f} ms{speed}; "
+                  f"{len(sources)} of {len(candidates)} sources usable)")
+            span.set(sources=len(sources))
+        span.set(source=sources[0].url)
+        if verified or len(sources) == 1:
+            return _transfer(url, path, span, sources)
+        # Nothing would catch a file stitched from two different origins
+        for source in sources:
+            try:
+                return _transfer(url, path, span, [source])
+            except Exception as e:
+                if source is sources[-1]:
+                    raise
+                print(f"{source.url} failed ({e}), starting over from the next source")
+                span.add(source_switches=1)
+                for partial in (path, path + ".json"):
+                    if os.path.exists(partial):
+                        os.remove(partial)
+
+def _transfer(url, path, span, sources):
+    journal_path = path + ".json"
+    if not sources[0].size:
+        for source in sources:
+            try:
+                digest, size = _stream_to_file(source.url, path)
+                break
+            except Exception as e:
+                if source is sources[-1]:
+                    raise
+                print(f"{source.url} failed ({e}), trying the next source")
+        span.add(bytes_downloaded=size)
+        return digest, size
+
+    size = sources[0].size
+    # A single-source download resumes only from that source; a download
+    # that may mix sources is tied to url and size, and checked by digest
+    journal_url, etag = (sources[0].url, sources[0].etag) if len(sources) == 1 else (url, None)
+    segments = _load_journal(journal_path, path, journal_url, size, etag)
+    if segments is None:
+        segments = _plan_segments(size)
+        with open(path, "wb") as f:
+            f.truncate(size)
+    else:
+        resumed = sum(segment[2] for segment in segments)
+        print(f"Resuming download at {resumed / 1024 ** 2:.1f} of {size / 1024 ** 2:.1f} MB")
+        span.set(resumed_bytes=resumed)
+    span.set(segments=len(segments))
+
+    journal_lock = threading.Lock()
+    source_lock = threading.Lock()
+    current = 0  # index of the source segments are fetched from
+
+    cancelled = threading.Event()
+    last_save = 0
+
+    def save_journal(force=True):
+        """Record the progress of every segment, at most every JOURNAL_SAVE_SECONDS unless forced."""
+        nonlocal last_save
+        with journal_lock:
+            now = time.monotonic()
+            if not force and now - last_save < JOURNAL_SAVE_SECONDS:
+                return
+            last_save = now
+            with open(journal_path + ".tmp", "w") as f:
+                json.dump({"url": journal_url, "size": size, "etag": etag, "segments": segments}, f)
+            os.replace(journal_path + ".tmp", journal_path)
+
+    def fetch(segment):
+        nonlocal current
+        failures = 0
+        while segment[2] < segment[1] - segment[0] and not cancelled.is_set():
+            index = current
+            try:
+                _fetch_segment(sources[index].url, path, segment, save_journal, cancelled)
+            except Exception as e:
+                # Network errors surface as requests, urllib3 or OS errors
+                save_journal()
+                if cancelled.is_set():
+                    return
+                failures += 1
+                if failures == 3 * len(sources):
+                    raise
+                with source_lock:
+                    # The first segment to notice moves every segment on
+                    if len(sources) > 1 and current == index:
+                        current = (index + 1) % len(sources)
+                        print(f"{sources[index].url} failed ({e}), switching to {sources[current].url}")
+                        span.add(source_switches=1)
+                if failures % len(sources) == 0:
+                    time.sleep(failures // len(sources))
+
+    save_journal()
+    pool = ThreadPoolExecutor(max_workers=len(segments))
+    try:
+        for future in [pool.submit(fetch, segment) for segment in segments]:
+            future.result()
+    except BaseException:
+        # A failed segment or Ctrl-C: stop the others and keep their progress
+        cancelled.set()
+        pool.shutdown(wait=True)
+        save_journal()
+        raise
+    pool.shutdown()
+
+    os.remove(journal_path)
+    span.add(bytes_downloaded=size - span.args.get("resumed_bytes", 0))
+    return _hash_file(path), size
+
+def mirror_url(url):
+    """Return the mirror location of an upstream URL."""
+    parts = urllib.parse.urlsplit(url)
+    return f"{MIRROR_URL}/{parts.netloc}{parts.path}" + (f"?{parts.query}" if parts.query else "")
+
+def load_mirrors(path):
+    """Add the mirrors and pinned digests of a JSON mirrors file."""
+    with open(path) as f:
+        config = json.load(f)
+    for prefix, mirrors in config.get("mirrors", {}).items():
+        known = ARTIFACT_MIRRORS.setdefault(prefix, [])
+        known.extend(mirror for mirror in mirrors if mirror not in known)
+    ARTIFACT_SHA256.update(config.get("sha256", {}))
+
+def artifact_mirrors(url):
+    """Return the URLs of url on the mirrors in ARTIFACT_MIRRORS."""
+    return [mirror + url[len(prefix):] for prefix, mirrors in ARTIFACT_MIRRORS.items()
+            if url.startswith(prefix) for mirror in mirrors]
+
+def download_candidates(url):
+    """Return the URLs to try for url: the LAN mirror if configured, url, then its mirrors.
+
+    Callers try the LAN mirror on its own before the others.
+    """
+    candidates = [url] + artifact_mirrors(url)
+    if MIRROR_URL and not url.startswith(MIRROR_URL + "/"):
+        candidates.insert(0, mirror_url(url))
+    return candidates
+
+def fetch_artifact(url, sha256=None, sha1=None):
+    """Return the path of a cached copy of url, downloading it on a miss.
+
+    Artifacts are stored by the SHA-256 of their content and looked up by URL
+    plus expected digest, so a cached artifact is served without touching the
+    network. If sha256 is given (or pinned in ARTIFACT_SHA256), the content is
+    verified while streaming and a mismatch raises ValueError. sha1 is checked
+    on download for sources that only publish SHA-1, like the SDK repository.
+    """
+    sha256 = sha256 or ARTIFACT_SHA256.get(url)
+    key = _cache_key(url, sha256)
+    cached = _cache_lookup(url, key, sha256)
+    if cached:
+        return cached
+    # One download per artifact; other workspaces and processes wait for it
+    with file_lock(os.path.join(CACHE_DIR, "locks", f"{key}.lock")):
+        return _cache_lookup(url, key, sha256) or _download_artifact(url, key, sha256, sha1)
+
+def _cache_lookup(url, key, sha256):
+    """Return the cached blob for key and count a hit, or None on a miss."""
+    with cache_lock():
+        index = _load_cache_index()
+        entry = index["entries"].get(key)
+        if entry is None and sha256 and os.path.exists(_blob_path(sha256)):
+            # Same content already cached under another URL
+            entry = {"url": url, "sha256": sha256, "size": os.path.getsize(_blob_path(sha256))}
+            index["entries"][key] = entry
+        if entry is None or not os.path.exists(_blob_path(entry["sha256"])):
+            return None
+        entry["last_used"] = time.time()
+        index["hits"] += 1
+        index["bytes_saved"] += entry["size"]
+        _save_cache_index(index)
+    print(f"Using cached {url}")
+    with trace_span(f"cache hit {os.path.basename(url)}", "cache", url=url, bytes=entry["size"]):
+        pass
+    return _blob_path(entry["sha256"])
+
+def _download_artifact(url, key, sha256, sha1):
+    tmp_dir = os.path.join(CACHE_DIR, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    # A stable name lets an interrupted download resume on the next run
+    tmp_path = os.path.join(tmp_dir, f"{key}.part")
+    candidates = download_candidates(url)
+    verified = bool(sha256 or sha1)
+    if MIRROR_URL and len(candidates) > 1 and candidates[0] == mirror_url(url):
+        # The LAN mirror alone first: upstream and its mirrors are only
+        # probed on a miss, so a mirrored fleet stays off the WAN
+        try:
+            digest, size = _download_to_file(url, tmp_path, candidates[:1])
+        except Exception as e:
+            print(f"Mirror miss for {url} ({e}), trying upstream")
+            digest, size = _download_to_file(url, tmp_path, candidates[1:], verified)
+    else:
+        digest, size = _download_to_file(url, tmp_path, candidates, verified)
+    if sha256 and digest != sha256:
+        os.remove(tmp_path)
+        raise ValueError(f"SHA-256 mismatch for {url}: expected {sha256}, got {digest}")
+    if sha1 and _hash_file(tmp_path, "sha1") != sha1.lower():
+        os.remove(tmp_path)
+        raise ValueError(f"SHA-1 mismatch for {url}")
+    os.makedirs(os.path.dirname(_blob_path(digest)), exist_ok=True)
+    os.replace(tmp_path, _blob_path(digest))
+
+    with cache_lock():
+        index = _load_cache_index()
+        index["entries"][key] = {"url": url, "sha256": digest, "size": size, "last_used": time.time()}
+        index["misses"] += 1
+        _evict_cache(index, keep=digest)
+        _save_cache_index(index)
+    return _blob_path(digest)
+
+def cache_stats():
+    """Print a summary of the artifact cache."""
+    with cache_lock():
+        index = _load_cache_index()
+    blobs = {entry["sha256"]: entry["size"] for entry in index["entries"].values()}
+    lookups = index["hits"] + index["misses"]
+    print(f"Cache directory: {CACHE_DIR}")
+    print(f"Entries: {len(index['entries'])} ({len(blobs)} unique artifacts)")
+    print(f"Size: {sum(blobs.values()) / 1024 ** 2:.1f} MB of {CACHE_MAX_BYTES / 1024 ** 2:.0f} MB")
+    print(f"Hits: {index['hits']}, misses: {index['misses']}"
+          + (f" ({100 * index['hits'] / lookups:.0f}% hit rate)" if lookups else ""))
+    print(f"Downloads saved: {index['bytes_saved'] / 1024 ** 2:.1f} MB")
+    for entry in sorted(index["entries"].values(), key=lambda e: e["last_used"], reverse=True):
+        last_used = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["last_used"]))
+        print(f"  {entry['size'] / 1024 ** 2:8.1f} MB  {last_used}  {entry['url']}")
+
+# Delta updates read the central directories of two archive versions with
+# Range requests and download only the members whose content changed.
+# Changed members closer together than DELTA_GAP_BYTES are fetched with one
+# request, in requests of up to DELTA_GROUP_BYTES.
+DELTA_GAP_BYTES = 256 * 1024
+DELTA_GROUP_BYTES = 32 * 1024 * 1024
+
+def _fetch_range(url, start, end):
+    """Return bytes [start, end) of url."""
+    response = transfer_engine().fetch(url, headers={"Range": f"bytes={start}-{end - 1}",
+                                                     "Accept-Encoding": "identity"}, partial=True)
+    if response.status_code != 206 or len(response.content) != end - start:
+        raise IOError(f"server did not return the requested range of {url}")
+    return response.content
+
+class RemoteZipFile:
+    """Read-only seekable file over HTTP Range requests.
+
+    Enough for zipfile.ZipFile to read the end record and central directory
+    of a remote archive: the tail is fetched up front and every other read
+    is one request.
+    """
+
+    def __init__(self, url, size):
+        self.url = url
+        self.size = size
+        self.pos = 0
+        self.fetched = 0
+        tail = max(0, size - 65536 - 22)  # largest possible end record
+        self.blocks = [(tail, self._fetch(tail, size))]
+
+    def _fetch(self, start, end):
+        data = _fetch_range(self.url, start, end)
+        self.fetched += len(data)
+        return data
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=0):
+        self.pos = {0: offset, 1: self.pos + offset, 2: self.size + offset}[whence]
+        return self.pos
+
+    def read(self, n=-1):
+        if n is None or n < 0 or self.pos + n > self.size:
+            n = self.size - self.pos
+        if n <= 0:
+            return b""
+        for start, data in self.blocks:
+            if start <= self.pos and self.pos + n <= start + len(data):
+                break
+        else:
+            start, data = self.pos, self._fetch(self.pos, self.pos + n)
+            self.blocks.append((start, data))
+        self.pos += n
+        return data[self.pos - n - start:self.pos - start]
+
+def remote_zip_index(url):
+    """Read the central directory of a remote zip without downloading it.
+
+    Returns a dict with the URL that answered (the mirror or url), the
+    archive size, its ZipInfo entries, the central directory offset and
+    the number of bytes fetched.
+    """
+    candidates = download_candidates(url)
+    for candidate in candidates:
+        try:
+            size, _ = _probe_download(candidate)
+            if size is None:
+                raise IOError(f"{candidate} does not support Range requests")
+            remote = RemoteZipFile(candidate, size)
+            with zipfile.ZipFile(remote) as zf:
+                return {"url": candidate, "size": size, "infos": zf.infolist(),
+                        "start_dir": zf.start_dir, "fetched": remote.fetched}
+        except Exception:
+            if candidate == candidates[-1]:
+                raise
+
+def _local_member_matches(path, info, check_crc):
+    """Whether the installed file at path has the content of info."""
+    if stat.S_ISLNK(_zip_member_mode(info)):
+        return os.path.islink(path) and len(os.readlink(path).encode()) == info.file_size
+    if os.path.islink(path) or not os.path.isfile(path) or os.path.getsize(path) != info.file_size:
+        return False
+    if not check_crc:
+        return True
+    crc = 0
+    with open(path, "rb") as f:
+        while chunk := f.read(DOWNLOAD_BUFFER_BYTES):
+            crc = zlib.crc32(chunk, crc)
+    return crc == info.CRC
+
+def _write_member(data, offset, info, target):
+    """Decompress the local record of info at data[offset:] into target.
+
+    A symlink member is not created; its link target is returned instead.
+    """
+    header = struct.unpack("<4s5H3L2H", data[offset:offset + 30])
+    if header[0] != b"PK\x03\x04":
+        raise zipfile.BadZipFile(f"bad local header for {info.filename}")
+    start = offset + 30 + header[9] + header[10]
+    compressed = memoryview(data)[start:start + info.compress_size]
+    if info.compress_type == zipfile.ZIP_DEFLATED:
+        decompressor = zlib.decompressobj(-15)
+    elif info.compress_type != zipfile.ZIP_STORED:
+        raise zipfile.BadZipFile(f"unsupported compression for {info.filename}")
+    mode = _zip_member_mode(info)
+    crc = 0
+    size = 0
+    link_target = b""
+    with contextlib.ExitStack() as stack:
+        f = None if _is_symlink_member(info) else stack.enter_context(open(target, "wb"))
+        for i in range(0, len(compressed), DOWNLOAD_BUFFER_BYTES):
+            chunk = compressed[i:i + DOWNLOAD_BUFFER_BYTES]
+            if info.compress_type == zipfile.ZIP_DEFLATED:
+                chunk = decompressor.decompress(chunk)
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            if f is None:
+                link_target += chunk
+            else:
+                f.write(chunk)
+    if crc != info.CRC or size != info.file_size:
+        raise ValueError(f"CRC mismatch for {info.filename}")
+    if f is None:
+        return link_target.decode()
+    if mode & 0o7777:
+        os.chmod(target, mode & 0o7777)
+    mtime = time.mktime(info.date_time + (0, 0, -1))
+    os.utime(target, (mtime, mtime))
+
+def _plan_delta_groups(changed, infos, start_dir):
+    """Group changed members into (start, end, members) byte ranges."""
+    offsets = sorted(info.header_offset for info in infos) + [start_dir]
+    record_end = dict(zip(offsets, offsets[1:]))
+    groups = []
+    for info in sorted(changed, key=lambda info: info.header_offset):
+        start, end = info.header_offset, record_end[info.header_offset]
+        if groups and start - groups[-1][1] <= DELTA_GAP_BYTES and end - groups[-1][0] <= DELTA_GROUP_BYTES:
+            groups[-1][1] = end
+            groups[-1][2].append(info)
+        else:
+            groups.append([start, end, [info]])
+    return groups
+
+def delta_update(old_url, old_dir, new_url, new_dir, include=None):
+    """Turn the tree unpacked from old_url at old_dir into that of new_url.
+
+    Both central directories are read with Range requests. Members whose
+    CRC-32, size and mode are unchanged (and whose installed copy still has
+    that size) are linked from old_dir; the others are fetched in coalesced
+    Range requests and verified against their CRC-32. If old_url is None the
+    installed files are checksummed instead. The new tree is built next to
+    new_dir and renamed into place, so old_dir may equal new_dir. include is
+    an optional filter like NdkMemberFilter: members it rejects are neither
+    fetched nor linked, so a sparse install stays sparse. Returns a dict
+    with bytes fetched, archive size and changed/reused file counts.
+    """
+    with trace_span(f"delta {os.path.basename(new_dir)}", "delta", url=new_url) as span:
+        new = remote_zip_index(new_url)
+        fetched = new["fetched"]
+        new_prefix = _common_root_prefix([info.filename for info in new["infos"]])
+        old_entries = None
+        if old_url is not None:
+            old = remote_zip_index(old_url)
+            fetched += old["fetched"]
+            old_prefix = _common_root_prefix([info.filename for info in old["infos"]])
+            old_entries = {}
+            for info in old["infos"]:
+                parts = _member_parts(info, old_prefix, old_url)
+                if parts and not info.is_dir():
+                    old_entries["/".join(parts)] = info
+
+        new_dir = os.path.abspath(new_dir)
+        staging = f"{new_dir}.update-{os.getpid()}-{threading.get_ident()}"
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
+        os.makedirs(staging)
+        try:
+            included = {}
+            for info in new["infos"]:
+                parts = _member_parts(info, new_prefix, new_url)
+                if parts and (include is None or include(parts)):
+                    included["/".join(parts)] = info
+            _refuse_paths_below_links(included, {relpath for relpath, info in included.items()
+                                                if _is_symlink_member(info)}, new_url)
+            directories, reused, changed, targets, links = [], 0, [], {}, {}
+            for relpath, info in included.items():
+                parts = relpath.split("/")
+                target = os.path.join(staging, *parts)
+                if info.is_dir():
+                    os.makedirs(target, exist_ok=True)
+                    directories.append((target, _zip_member_mode(info)))
+                    continue
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                local = os.path.join(old_dir, *parts)
+                if old_entries is not None:
+                    old_info = old_entries.get(relpath)
+                    same = (old_info is not None and old_info.CRC == info.CRC
+                            and old_info.file_size == info.file_size
+                            and _zip_member_mode(old_info) == _zip_member_mode(info)
+                            and _local_member_matches(local, info, check_crc=False))
+                else:
+                    same = _local_member_matches(local, info, check_crc=True)
+                if not same:
+                    changed.append(info)
+                    targets[info.filename] = (relpath, target)
+                elif _is_symlink_member(info):
+                    links[relpath] = os.readlink(local)
+                    reused += 1
+                else:
+                    link_file(local, target)
+                    reused += 1
+
+            def fetch_group(group):
+                start, end, members = group
+                data = _fetch_range(new["url"], start, end)
+                for info in members:
+                    relpath, target = targets[info.filename]
+                    link_target = _write_member(data, info.header_offset - start, info, target)
+                    if link_target is not None:
+                        links[relpath] = link_target
+                return len(data)
+
+            groups = _plan_delta_groups(changed, new["infos"], new["start_dir"])
+            with ThreadPoolExecutor(max_workers=DOWNLOAD_CONNECTIONS) as pool:
+                fetched += sum(pool.map(fetch_group, groups))
+            # Symlinks last, so no member is ever written through one
+            _create_symlinks(staging, links, new_url)
+            for directory, mode in sorted(directories, reverse=True):
+                if mode & 0o7777:
+                    os.chmod(directory, mode & 0o7777)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        _replace_dir(staging, new_dir)
+        span.add(bytes_downloaded=fetched)
+        span.set(files_changed=len(changed), files_reused=reused, requests=len(groups))
+    return {"fetched": fetched, "size": new["size"], "changed": len(changed), "reused": reused}
+
+def _gradle_url(version):
+    return GRADLE_URL.replace(f"gradle-{GRADLE_VERSION}-", f"gradle-{version}-")
+
+def update_component(ws, old_component, new_component):
+    """Update an installed component to another version with a delta update.
+
+    Components are SDK package paths such as "ndk;25.2.9519653", or
+    "gradle;<version>" for the workspace's Gradle. Passing the same
+    component twice refreshes it in place against the current archive.
+    """
+    sdk_root = ws.path("android-sdk")
+    try:
+        if old_component.startswith("gradle;") and new_component.startswith("gradle;"):
+            old_version, new_version = old_component.split(";")[1], new_component.split(";")[1]
+            old_dir = ws.path("gradle", f"gradle-{old_version}")
+            new_dir = ws.path("gradle", f"gradle-{new_version}")
+            old_url = _gradle_url(old_version) if old_version != new_version else None
+            package = None
+            new_url = _gradle_url(new_version)
+        else:
+            manifest = fetch_repository_manifest()
+            packages, licenses = resolve_sdk_packages(manifest, [old_component, new_component])
+            if new_component not in packages:
+                print(f"{new_component} was not found in the SDK repository")
+                return False
+            package = packages[new_component]
+            new_url, _ = _package_archive_url(package)
+            old_url = None
+            if old_component != new_component and old_component in packages:
+                old_url, _ = _package_archive_url(packages[old_component])
+            old_dir = os.path.join(sdk_root, *old_component.split(";"))
+            new_dir = os.path.join(sdk_root, *new_component.split(";"))
+        if not os.path.isdir(old_dir):
+            print(f"{old_component} is not installed at {old_dir}")
+            return False
+        # A sparse NDK is updated to a sparse NDK for the same ABIs
+        abis = ndk_installed_abis(old_dir) if new_component.startswith("ndk;") else None
+        include = NdkMemberFilter(abis) if abis else None
+
+        print(f"Updating {old_component} to {new_component}" + (f" for {', '.join(abis)}..." if abis else "..."))
+        stats = delta_update(old_url, old_dir, new_url, new_dir, include)
+        if include is not None:
+            with open(os.path.join(new_dir, SPARSE_FILE), "w") as f:
+                json.dump({"abis": include.abis, "host": include.host_tag}, f)
+        if package is not None:
+            used = {ref.get("ref") for ref in package.iter("uses-license")}
+            accept_package_licenses(sdk_root, {license_id: licenses[license_id]
+                                               for license_id in used if license_id in licenses})
+            write_package_xml(package, new_dir, licenses, _manifest_namespaces(manifest))
+        record_integrity(ws, [new_dir])
+    except Exception as e:
+        print(f"Error updating {old_component}: {e}")
+        return False
+
+    print(f"Updated {new_component}: {stats['changed']} files downloaded, {stats['reused']} reused, "
+          f"{stats['fetched'] / 1024 ** 2:.1f} MB fetched instead of {stats['size'] / 1024 ** 2:.1f} MB")
+    if old_dir != new_dir:
+        print(f"The previous version is still installed at {old_dir}")
+    return True
+
+def wheelhouse_dir():
+    return os.path.join(CACHE_DIR, "wheelhouse")
+
+def _parse_range(header, size):
+    """Return (start, end) for a single-range Range header, end inclusive.
+
+    Returns None for a missing or unsupported header and raises ValueError
+    for a range that cannot be satisfied.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[len("bytes="):].strip().partition("-")
+    if not first:
+        if not last.isdigit() or int(last) == 0:
+            raise ValueError(header)
+        return max(0, size - int(last)), size - 1
+    if not first.isdigit() or (last and not last.isdigit()):
+        return None
+    start, end = int(first), min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+class ArtifactRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serve cached artifacts at /<upstream host>/<upstream path>.
+
+    Python packages from the wheelhouse are listed at /pip/ for use with
+    pip --find-links. Range requests are supported so clients can fetch
+    segments in parallel and resume.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        print(f"[{self.address_string()}] {format % args}")
+
+    def _resolve(self):
+        """Return (path, etag) of the file for this request, or (None, None)."""
+        path = urllib.parse.urlsplit(self.path).path
+        if path == "/pip/" or path == "/pip":
+            return None, "pip-index"
+        if path.startswith("/pip/"):
+            name = os.path.basename(urllib.parse.unquote(path))
+            candidate = os.path.join(wheelhouse_dir(), name)
+            return (candidate, None) if name and os.path.isfile(candidate) else (None, None)
+
+        upstream = urllib.parse.unquote(path.lstrip("/"))
+        query = urllib.parse.urlsplit(self.path).query
+        urls = {f"{scheme}://{upstream}" + (f"?{query}" if query else "") for scheme in ("https", "http")}
+        with cache_lock():
+            index = _load_cache_index()
+        for entry in index["entries"].values():
+            if entry["url"] in urls and os.path.exists(_blob_path(entry["sha256"])):
+                return _blob_path(entry["sha256"]), entry["sha256"]
+        if REPOSITORY_URL + REPOSITORY_MANIFEST in urls:
+            manifest_path, _ = _repository_cache_paths()
+            if os.path.exists(manifest_path):
+                return manifest_path, None
+        return None, None
+
+    def _send_pip_index(self, head_only):
+        names = sorted(os.listdir(wheelhouse_dir())) if os.path.isdir(wheelhouse_dir()) else []
+        links = "".join(f'<a href="{urllib.parse.quote(name)}">{html.escape(name)}</a><br>\n'
+                        for name in names if not name.startswith("."))
+        body = f"<!DOCTYPE html><html><body>\n{links}</body></html>\n".encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not head_only:
+            self.wfile.write(body)
+
+    def _serve(self, head_only):
+        path, etag = self._resolve()
+        if etag == "pip-index":
+            return self._send_pip_index(head_only)
+        if path is None:
+            return self.send_error(404)
+
+        size = os.path.getsize(path)
+        try:
+            byte_range = _parse_range(self.headers.get("Range"), size)
+        except ValueError:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if byte_range and etag and self.headers.get("If-Range", f'"{etag}"') != f'"{etag}"':
+            byte_range = None
+
+        start, end = byte_range or (0, size - 1)
+        self.send_response(206 if byte_range else 200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        if byte_range:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        if etag:
+            self.send_header("ETag", f'"{etag}"')
+        self.end_headers()
+        if head_only or size == 0:
+            return
+        with open(path, "rb") as f:
+            self.connection.sendfile(f, offset=start, count=end - start + 1)
+
+    def do_GET(self):
+        self._serve(head_only=False)
+
+    def do_HEAD(self):
+        self._serve(head_only=True)
+
+def serve_artifacts(host, port):
+    """Serve the local artifact cache over HTTP until interrupted."""
+    server = http.server.ThreadingHTTPServer((host, port), ArtifactRequestHandler)
+    server.daemon_threads = True
+    print(f"Serving artifacts from {CACHE_DIR} on http://{host}:{port}/")
+    print(f"Point clients at it with ANDROID_ENV_MIRROR=http://<this host>:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+class BuildCacheNode:
+    """Entries of a Gradle build cache node, shared by the request threads.
+
+    Entries are files named by cache key. When the total size exceeds
+    max_bytes, the least recently used entries are evicted down to 90%.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.stores = 0
+        self.entries = {}  # key -> [size, last used]
+        os.makedirs(directory, exist_ok=True)
+        for dirpath, _, filenames in os.walk(directory):
+            for name in filenames:
+                if BUILD_CACHE_KEY.fullmatch(name):
+                    st = os.stat(os.path.join(dirpath, name))
+                    self.entries[name] = [st.st_size, st.st_mtime]
+        self.size = sum(size for size, _ in self.entries.values())
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """Return the path of an entry, or None on a miss."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry[1] = time.time()
+        return self.path(key)
+
+    def put(self, key, source, length):
+        """Store length bytes read from source as the entry for key."""
+        target = self.path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp = f"{target}.{threading.get_ident()}.tmp"
+        remaining = length
+        with open(tmp, "wb") as f:
+            while remaining:
+                chunk = source.read(min(remaining, DOWNLOAD_BUFFER_BYTES))
+                if not chunk:
+                    break
+                f.write(chunk)
+                remaining -= len(chunk)
+        if remaining:
+            os.remove(tmp)
+            raise IOError(f"client sent {length - remaining} of {length} bytes")
+        os.replace(tmp, target)
+        with self.lock:
+            old = self.entries.get(key)
+            self.size += length - (old[0] if old else 0)
+            self.entries[key] = [length, time.time()]
+            self.stores += 1
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        for key, (size, _) in sorted(self.entries.items(), key=lambda item: item[1][1]):
+            if self.size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+            del self.entries[key]
+            self.size -= size
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.size, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses, "stores": self.stores}
+
+class BuildCacheRequestHandler(http.server.BaseHTTPRequestHandler):
+    """The Gradle HTTP build cache protocol: GET and PUT /cache/<key>.
+
+    GET / returns the node's statistics as JSON.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_request(self, code="-", size="-"):
+        # A build makes hundreds of requests; errors are still logged
+        pass
+
+    def _key(self):
+        path = urllib.parse.urlsplit(self.path).path
+        key = path[len("/cache/"):] if path.startswith("/cache/") else ""
+        return key if BUILD_CACHE_KEY.fullmatch(key) else None
+
+    def _send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_GET(self):
+        node = self.server.node
+        if urllib.parse.urlsplit(self.path).path == "/":
+            return self._send_body(json.dumps(node.stats()).encode() + b"\n", "application/json")
+        key = self._key()
+        path = node.get(key) if key else None
+        try:
+            f = open(path, "rb") if path else None
+        except FileNotFoundError:
+            f = None
+        if f is None:
+            return self.send_error(404)
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(size))
+            self.end_headers()
+            if self.command != "HEAD" and size:
+                self.connection.sendfile(f)
+
+    do_HEAD = do_GET
+
+    def do_PUT(self):
+        key = self._key()
+        if key is None:
+            return self.send_error(404)
+        length = self.headers.get("Content-Length")
+        if length is None:
+            return self.send_error(411)
+        length = int(length)
+        if length > BUILD_CACHE_MAX_ENTRY_BYTES:
+            self.close_connection = True
+            return self.send_error(413)
+        try:
+            self.server.node.put(key, self.rfile, length)
+        except OSError as e:
+            self.close_connection = True
+            return self.send_error(500, str(e))
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+def serve_build_cache(host, port, directory=None, max_bytes=None):
+    """Run a Gradle build cache node until interrupted."""
+    directory = directory or os.path.join(CACHE_DIR, "build-cache")
+    node = BuildCacheNode(directory, max_bytes or BUILD_CACHE_MAX_BYTES)
+    server = http.server.ThreadingHTTPServer((host, port), BuildCacheRequestHandler)
+    server.daemon_threads = True
+    server.node = node
+    print(f"Gradle build cache node on http://{host}:{port}/cache/ "
+          f"({len(node.entries)} entries, {node.size / 1024 ** 2:.1f} MB in {directory})")
+    print(f"Point generated projects at it with ANDROID_ENV_BUILD_CACHE=http://<this host>:{port}/cache/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        stats = node.stats()
+        print(f"Build cache: {stats['hits']} hits, {stats['misses']} misses, {stats['stores']} stores")
 
-def download_file(url, filename):
-    """Download a file from URL with progress indication."""
+def download_file(url, filename, sha256=None):
+    """Place a copy of url at filename, going through the artifact cache."""
     try:
-        print(f"Downloading from {url}")
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
-        total_size = int(response.headers.get('content-length', 0))
-        block_size = 1024  # 1 Kibibyte
-        
-        with open(filename, 'wb') as f:
-            for data in response.iter_content(block_size):
-                f.write(data)
-                
+        cached = fetch_artifact(url, sha256)
+        if os.path.exists(filename):
+            os.remove(filename)
+        try:
+            # Callers delete their copy when done, so a hardlink is enough
+            os.link(cached, filename)
+        except OSError:
+            shutil.copyfile(cached, filename)
         return True
     except Exception as e:
         print(f"Error downloading file: {e}")
+        # A partial download stays in the cache's tmp directory for resuming
         if os.path.exists(filename):
             os.remove(filename)
         return False
 
-def download_gradle():
+def download_files(downloads):
+    """Run download_file for (url, filename) pairs concurrently.
+
+    Returns True if every download succeeded.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, len(downloads))) as pool:
+        return all(list(pool.map(lambda download: download_file(*download), downloads)))
+
+def gradle_home_path(ws):
+    return ws.path("gradle", f"gradle-{GRADLE_VERSION}")
+
+def activate_gradle(ws):
+    """Point GRADLE_HOME and PATH at the workspace's Gradle installation."""
+    gradle_home = gradle_home_path(ws)
+    ws.set_tool_environment("GRADLE_HOME", gradle_home, os.path.join(gradle_home, "bin"))
+
+def gradle_user_home():
+    return os.environ.get("GRADLE_USER_HOME") or os.path.join(os.path.expanduser("~"), ".gradle")
+
+def gradle_distribution_url():
+    """Return the URL generated Gradle wrappers fetch Gradle from."""
+    return mirror_url(GRADLE_URL) if MIRROR_URL else GRADLE_URL
+
+def wrapper_distribution_dir(url):
+    """Return the directory the Gradle wrapper installs url into.
+
+    Same layout as the wrapper's own PathAssembler: the zip name without
+    extension, then the MD5 of the URL written in base 36.
+    """
+    name = os.path.splitext(os.path.basename(urllib.parse.urlsplit(url).path))[0]
+    number = int.from_bytes(hashlib.md5(url.encode()).digest(), "big")
+    digits = ""
+    while number:
+        number, digit = divmod(number, 36)
+        digits = "0123456789abcdefghijklmnopqrstuvwxyz"[digit] + digits
+    return os.path.join(gradle_user_home(), "wrapper", "dists", name, digits or "0")
+
+def _wrapper_zip_path():
+    url = gradle_distribution_url()
+    return os.path.join(wrapper_distribution_dir(url), os.path.basename(urllib.parse.urlsplit(url).path))
+
+def gradle_distribution_sha256():
+    """Return the SHA-256 of the Gradle zip, or None if it is not known."""
+    if ARTIFACT_SHA256.get(GRADLE_URL):
+        return ARTIFACT_SHA256[GRADLE_URL]
+    if os.path.exists(_wrapper_zip_path()):
+        return _hash_file(_wrapper_zip_path())
+    return None
+
+def seed_wrapper_distribution(archive, digest):
+    """Install the Gradle zip in the wrapper's dists cache under GRADLE_USER_HOME.
+
+    The zip, its unpacked tree and the .ok marker are laid out as the
+    wrapper would leave them, so the first `./gradlew build` of a generated
+    project neither downloads nor unzips Gradle.
+    """
+    zip_path = _wrapper_zip_path()
+    dist_dir = os.path.dirname(zip_path)
+    with file_lock(zip_path + ".seed.lock"):
+        if os.path.exists(zip_path + ".ok"):
+            return
+        install_archive(archive, os.path.join(dist_dir, f"gradle-{GRADLE_VERSION}"),
+                        strip_prefix=f"gradle-{GRADLE_VERSION}/", digest=digest)
+        if os.path.exists(zip_path):
+            os.remove(zip_path)
+        link_file(archive, zip_path)
+        open(zip_path + ".ok", "w").close()
+    print(f"Gradle wrapper distribution cache seeded at {dist_dir}")
+
+def write_wrapper_properties(project_dir):
+    """Point a project's Gradle wrapper at the seeded distribution."""
+    lines = [
+        "distributionBase=GRADLE_USER_HOME",
+        "distributionPath=wrapper/dists",
+        # ':' is escaped in .properties files
+        "distributionUrl=" + gradle_distribution_url().replace(":", "\\:"),
+    ]
+    sha256 = gradle_distribution_sha256()
+    if sha256:
+        lines.append(f"distributionSha256Sum={sha256}")
+    lines += [
+        "networkTimeout=10000",
+        "zipStoreBase=GRADLE_USER_HOME",
+        "zipStorePath=wrapper/dists",
+    ]
+    path = os.path.join(project_dir, "gradle", "wrapper", "gradle-wrapper.properties")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+def download_gradle(ws):
     """Download and install Gradle."""
     print("Downloading Gradle...")
-    gradle_version = "8.4"
-    url = f"https://services.gradle.org/distributions/gradle-{gradle_version}-bin.zip"
-    filename = os.path.abspath("gradle.zip")
+    gradle_version = GRADLE_VERSION
+    url = GRADLE_URL
+    filename = ws.scratch("gradle.zip")
     
     # First ensure any old files are cleaned up
     if os.path.exists(filename):
@@ -224,13 +2566,14 @@ def download_gradle():
     
     # Verify the zip file
     try:
-        with zipfile.ZipFile(filename, 'r') as zip_ref:
-            # Create gradle directory if it doesn't exist
-            gradle_dir = os.path.abspath("gradle")
-            os.makedirs(gradle_dir, exist_ok=True)
-            
-            print("Extracting Gradle...")
-            zip_ref.extractall(gradle_dir)
+        # Create gradle directory if it doesn't exist
+        gradle_dir = ws.path("gradle")
+        os.makedirs(gradle_dir, exist_ok=True)
+        
+        print("Extracting Gradle...")
+        digest = ARTIFACT_SHA256.get(url) or _hash_file(filename)
+        install_archive(filename, os.path.join(gradle_dir, f"gradle-{gradle_version}"),
+                        strip_prefix=f"gradle-{gradle_version}/", digest=digest)
     except zipfile.BadZipFile:
         print("Error: The downloaded file is not a valid zip file.")
         if os.path.exists(filename):
@@ -242,17 +2585,17 @@ def download_gradle():
             os.remove(filename)
         return False
     
+    try:
+        seed_wrapper_distribution(filename, digest)
+    except Exception as e:
+        # Not fatal: the first wrapper build downloads Gradle itself
+        print(f"Warning: could not seed the Gradle wrapper distribution cache: {e}")
+    
     try:
         # Set up environment variables
         gradle_home = os.path.join(gradle_dir, f"gradle-{gradle_version}")
-        os.environ["GRADLE_HOME"] = gradle_home
-        
-        # Add Gradle to PATH
         gradle_bin = os.path.join(gradle_home, "bin")
-        if platform.system() == "Windows":
-            os.environ["PATH"] = f"{gradle_bin};{os.environ['PATH']}"
-        else:
-            os.environ["PATH"] = f"{gradle_bin}:{os.environ['PATH']}"
+        activate_gradle(ws)
         
         # Clean up
         os.remove(filename)
@@ -274,27 +2617,11 @@ def download_gradle():
         print(f"Error setting up Gradle environment: {e}")
         return False
 
-def create_android_project_template(app_name, package_name):
-    """Create a basic Android project template."""
-    print(f"Creating Android project: {app_name}")
-    
-    # Create project directory
-    os.makedirs(app_name, exist_ok=True)
-    os.chdir(app_name)
-    
-    # Create project structure
-    directories = [
-        "app/src/main/java/" + package_name.replace(".", "/"),
-        "app/src/main/res/layout",
-        "app/src/main/res/values",
-    ]
-    
-    for directory in directories:
-        os.makedirs(directory, exist_ok=True)
-    
-    # Create build.gradle (Project level)
-    with open("build.gradle", "w") as f:
-        f.write("""buildscript {
+# Project templates: relative path -> file body, both with $-placeholders.
+# They are parsed once at import and rendered with plain path-based writes, so
+# projects can be generated from several threads at once.
+ANDROID_PROJECT_FILES = {
+    "build.gradle": """buildscript {
     repositories {
         google()
         mavenCentral()
@@ -313,56 +2640,73 @@ allprojects {
 
 task clean(type: Delete) {
     delete rootProject.buildDir
-}""")
-    
-    # Create settings.gradle
-    with open("settings.gradle", "w") as f:
-        f.write(f"""include ':app'
-rootProject.name = "{app_name}"
-""")
-    
-    # Create app/build.gradle
-    with open("app/build.gradle", "w") as f:
-        f.write(f"""plugins {{
+}""",
+    "settings.gradle": """include ':app'
+rootProject.name = "${app_name}"
+
+// Local build cache plus the shared remote node, if one is configured.
+// GRADLE_BUILD_CACHE_URL overrides the node, GRADLE_BUILD_CACHE_PUSH=false
+// makes it read-only.
+def buildCacheUrl = System.getenv("GRADLE_BUILD_CACHE_URL") ?: "${build_cache_url}"
+buildCache {
+    local {
+        enabled = true
+    }
+    if (buildCacheUrl) {
+        remote(HttpBuildCache) {
+            url = buildCacheUrl.endsWith("/") ? buildCacheUrl : buildCacheUrl + "/"
+            allowInsecureProtocol = buildCacheUrl.startsWith("http:")
+            push = (System.getenv("GRADLE_BUILD_CACHE_PUSH") ?: "true").toBoolean()
+        }
+    }
+}
+""",
+    "gradle.properties": """# Sized for the generating host (CPU cores: ${cpu_count}, memory: ${memory_gb} GB)
+org.gradle.jvmargs=-Xmx${gradle_heap_mb}m -XX:MaxMetaspaceSize=512m -XX:+HeapDumpOnOutOfMemoryError -Dfile.encoding=UTF-8
+org.gradle.workers.max=${cpu_count}
+org.gradle.daemon=true
+org.gradle.parallel=true
+org.gradle.caching=true
+org.gradle.configuration-cache=true
+org.gradle.configuration-cache.problems=warn
+android.useAndroidX=true
+""",
+    "app/build.gradle": """plugins {
     id 'com.android.application'
-}}
+}
 
-android {{
+android {
     compileSdkVersion 31
     
-    defaultConfig {{
-        applicationId "{package_name}"
+    defaultConfig {
+        applicationId "${package_name}"
         minSdkVersion 21
         targetSdkVersion 31
         versionCode 1
         versionName "1.0"
-    }}
+    }
     
-    buildTypes {{
-        release {{
+    buildTypes {
+        release {
             minifyEnabled false
             proguardFiles getDefaultProguardFile('proguard-android-optimize.txt'), 'proguard-rules.pro'
-        }}
-    }}
+        }
+    }
     
-    compileOptions {{
+    compileOptions {
         sourceCompatibility JavaVersion.VERSION_1_8
         targetCompatibility JavaVersion.VERSION_1_8
-    }}
-}}
+    }
+}
 
-dependencies {{
+dependencies {
     implementation 'androidx.appcompat:appcompat:1.4.1'
     implementation 'com.google.android.material:material:1.5.0'
     implementation 'androidx.constraintlayout:constraintlayout:2.1.3'
-}}""")
-    
-    # Create AndroidManifest.xml
-    manifest_path = "app/src/main/AndroidManifest.xml"
-    with open(manifest_path, "w") as f:
-        f.write(f"""<?xml version="1.0" encoding="utf-8"?>
+}""",
+    "app/src/main/AndroidManifest.xml": """<?xml version="1.0" encoding="utf-8"?>
 <manifest xmlns:android="http://schemas.android.com/apk/res/android"
-    package="{package_name}">
+    package="${package_name}">
     
     <application
         android:allowBackup="true"
@@ -380,27 +2724,20 @@ dependencies {{
             </intent-filter>
         </activity>
     </application>
-</manifest>""")
-    
-    # Create MainActivity.java
-    main_activity_path = f"app/src/main/java/{package_name.replace('.', '/')}/MainActivity.java"
-    with open(main_activity_path, "w") as f:
-        f.write(f"""package {package_name};
+</manifest>""",
+    "app/src/main/java/${package_path}/MainActivity.java": """package ${package_name};
 
 import androidx.appcompat.app.AppCompatActivity;
 import android.os.Bundle;
 
-public class MainActivity extends AppCompatActivity {{
+public class MainActivity extends AppCompatActivity {
     @Override
-    protected void onCreate(Bundle savedInstanceState) {{
+    protected void onCreate(Bundle savedInstanceState) {
         super.onCreate(savedInstanceState);
         setContentView(R.layout.activity_main);
-    }}
-}}""")
-    
-    # Create activity_main.xml
-    with open("app/src/main/res/layout/activity_main.xml", "w") as f:
-        f.write("""<?xml version="1.0" encoding="utf-8"?>
+    }
+}""",
+    "app/src/main/res/layout/activity_main.xml": """<?xml version="1.0" encoding="utf-8"?>
 <androidx.constraintlayout.widget.ConstraintLayout xmlns:android="http://schemas.android.com/apk/res/android"
     xmlns:app="http://schemas.android.com/apk/res-auto"
     android:layout_width="match_parent"
@@ -416,21 +2753,69 @@ public class MainActivity extends AppCompatActivity {{
         app:layout_constraintRight_toRightOf="parent"
         app:layout_constraintTop_toTopOf="parent" />
 
-</androidx.constraintlayout.widget.ConstraintLayout>""")
-    
-    # Create strings.xml
-    with open("app/src/main/res/values/strings.xml", "w") as f:
-        f.write(f"""<resources>
-    <string name="app_name">{app_name}</string>
-</resources>""")
+</androidx.constraintlayout.widget.ConstraintLayout>""",
+    "app/src/main/res/values/strings.xml": """<resources>
+    <string name="app_name">${app_name}</string>
+</resources>""",
+}
+
+# Used when Gradle is not available to run `gradle wrapper`
+GRADLE_WRAPPER_FALLBACK_FILES = {
+    "gradlew": """#!/usr/bin/env sh
+exec java -jar gradle/wrapper/gradle-wrapper.jar "$$@"
+""",
+    "gradlew.bat": """@echo off
+java -jar gradle\\wrapper\\gradle-wrapper.jar %*
+""",
+}
+
+GRADLE_WRAPPER_FILES = [
+    "gradlew",
+    "gradlew.bat",
+    os.path.join("gradle", "wrapper", "gradle-wrapper.jar"),
+    os.path.join("gradle", "wrapper", "gradle-wrapper.properties"),
+]
+
+def compile_project_template(files):
+    """Parse a {path: body} template once into (path, body) Template pairs."""
+    return [(string.Template(path), string.Template(body)) for path, body in files.items()]
+
+ANDROID_PROJECT_TEMPLATE = compile_project_template(ANDROID_PROJECT_FILES)
+GRADLE_WRAPPER_FALLBACK_TEMPLATE = compile_project_template(GRADLE_WRAPPER_FALLBACK_FILES)
+
+def render_project(template, project_dir, context):
+    """Write every file of a compiled template below project_dir."""
+    for path, body in template:
+        target = os.path.join(project_dir, *path.substitute(context).split("/"))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, "w") as f:
+            f.write(body.substitute(context))
+
+def setup_gradle_wrapper(project_dir, wrapper_from=None, env=None):
+    """Add the Gradle wrapper to a project.
+
+    The wrapper is copied from wrapper_from if given (a project that already
+    has one), generated with `gradle wrapper`, or downloaded as a fallback
+    when Gradle is not installed. Its properties point at the distribution
+    seeded by download_gradle(), pinned by SHA-256. Gradle is looked up via
+    GRADLE_HOME in env (default: os.environ).
+    """
+    if wrapper_from:
+        for path in GRADLE_WRAPPER_FILES:
+            source = os.path.join(wrapper_from, path)
+            if os.path.exists(source):
+                os.makedirs(os.path.dirname(os.path.join(project_dir, path)), exist_ok=True)
+                shutil.copy2(source, os.path.join(project_dir, path))
+        return
     
-    # Initialize Gradle wrapper
-    gradle_path = os.path.join(os.environ.get("GRADLE_HOME", ""), "bin", "gradle")
+    env = env if env is not None else os.environ
+    gradle_path = os.path.join(env.get("GRADLE_HOME", ""), "bin", "gradle")
     if platform.system() == "Windows":
         gradle_path += ".bat"
     
     try:
-        subprocess.run([gradle_path, "wrapper"], check=True)
+        run_process([gradle_path, "wrapper"], check=True, cwd=project_dir, env=env)
+        write_wrapper_properties(project_dir)
     except subprocess.CalledProcessError as e:
         print(f"Error initializing Gradle wrapper: {e}")
         print("Continuing with project creation...")
@@ -441,57 +2826,213 @@ public class MainActivity extends AppCompatActivity {{
             wrapper_url = "https://raw.githubusercontent.com/gradle/gradle/v8.4.0/gradle/wrapper/gradle-wrapper.jar"
             properties_url = "https://raw.githubusercontent.com/gradle/gradle/v8.4.0/gradle/wrapper/gradle-wrapper.properties"
             
-            os.makedirs("gradle/wrapper", exist_ok=True)
+            wrapper_dir = os.path.join(project_dir, "gradle", "wrapper")
+            os.makedirs(wrapper_dir, exist_ok=True)
             
-            # Download wrapper JAR
-            run_command(f'curl -o "gradle/wrapper/gradle-wrapper.jar" {wrapper_url}')
+            # Download wrapper JAR and properties
+            if not download_files([(wrapper_url, os.path.join(wrapper_dir, "gradle-wrapper.jar")),
+                                   (properties_url, os.path.join(wrapper_dir, "gradle-wrapper.properties"))]):
+                raise RuntimeError("could not download the Gradle wrapper")
             
-            # Download wrapper properties
-            run_command(f'curl -o "gradle/wrapper/gradle-wrapper.properties" {properties_url}')
+            write_wrapper_properties(project_dir)
             
             # Create gradlew and gradlew.bat
-            with open("gradlew", "w") as f:
-                f.write("""#!/usr/bin/env sh
-exec java -jar gradle/wrapper/gradle-wrapper.jar "$@"
-""")
-            
-            with open("gradlew.bat", "w") as f:
-                f.write("""@echo off
-java -jar gradle\\wrapper\\gradle-wrapper.jar %*
-""")
+            render_project(GRADLE_WRAPPER_FALLBACK_TEMPLATE, project_dir, {})
             
             # Make gradlew executable
             if platform.system() != "Windows":
-                os.chmod("gradlew", 0o755)
+                os.chmod(os.path.join(project_dir, "gradlew"), 0o755)
         except Exception as e:
             print(f"Error setting up Gradle wrapper manually: {e}")
+
+def host_memory_bytes():
+    """Return the memory available to this host or container, or None."""
+    limit = None
+    try:
+        # cgroup v2 limit of a container
+        with open("/sys/fs/cgroup/memory.max") as f:
+            value = f.read().strip()
+        if value != "max":
+            limit = int(value)
+    except (OSError, ValueError):
+        pass
+    physical = None
+    if platform.system() == "Windows":
+        import ctypes
+
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [("dwLength", ctypes.c_ulong), ("dwMemoryLoad", ctypes.c_ulong)] + [
+                (name, ctypes.c_ulonglong) for name in ("ullTotalPhys", "ullAvailPhys", "ullTotalPageFile",
+                                                        "ullAvailPageFile", "ullTotalVirtual", "ullAvailVirtual",
+                                                        "ullAvailExtendedVirtual")]
+
+        status = MEMORYSTATUSEX(dwLength=ctypes.sizeof(MEMORYSTATUSEX))
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            physical = status.ullTotalPhys
+    else:
+        try:
+            physical = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        except (AttributeError, ValueError, OSError):
+            pass
+    return min(filter(None, (limit, physical)), default=None)
+
+def gradle_host_settings():
+    """Return gradle.properties values sized to this host's cores and memory.
+
+    The daemon gets a quarter of the memory (1-8 GB) and one worker per
+    core.
+    """
+    cpu_count = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    memory = host_memory_bytes() or 8 * 1024 ** 3
+    heap_mb = min(8192, max(1024, memory // 4 // 1024 ** 2 // 512 * 512))
+    return {"cpu_count": cpu_count, "memory_gb": round(memory / 1024 ** 3, 1), "gradle_heap_mb": heap_mb}
+
+def create_android_project_template(app_name, package_name, parent_dir=".", wrapper_from=None, env=None,
+                                    build_cache_url=None):
+    """Create a basic Android project template.
+
+    Its gradle.properties enables parallel builds, the configuration cache
+    and the build cache, sized for this host; settings.gradle points the
+    remote build cache at build_cache_url (default: BUILD_CACHE_URL).
+    """
+    print(f"Creating Android project: {app_name}")
+    
+    project_dir = os.path.join(parent_dir, app_name)
+    render_project(ANDROID_PROJECT_TEMPLATE, project_dir, dict(
+        gradle_host_settings(),
+        app_name=app_name,
+        package_name=package_name,
+        package_path=package_name.replace(".", "/"),
+        build_cache_url=BUILD_CACHE_URL if build_cache_url is None else build_cache_url,
+    ))
+    setup_gradle_wrapper(project_dir, wrapper_from, env)
     
-    os.chdir("..")
     print(f"Android project '{app_name}' created successfully!")
+    return project_dir
+
+def _pip_command(*args):
+    return [sys.executable, "-m", "pip", *args]
+
+def _mirror_find_links():
+    """Return pip arguments that add the mirror's wheelhouse, if configured."""
+    if not MIRROR_URL:
+        return []
+    host = urllib.parse.urlsplit(MIRROR_URL).hostname
+    return ["--find-links", f"{MIRROR_URL}/pip/", "--trusted-host", host]
+
+def lock_python_dependencies():
+    """Resolve PYTHON_PACKAGES once and write exact pins to the lock file."""
+    print("Resolving Python dependencies...")
+    with tempfile.TemporaryDirectory() as tmp:
+        report_path = os.path.join(tmp, "report.json")
+        run_command(_pip_command("install", "--dry-run", "--ignore-installed", "--quiet",
+                                 "--report", report_path, *_mirror_find_links(), *PYTHON_PACKAGES))
+        with open(report_path) as f:
+            report = json.load(f)
+    pins = sorted(f"{item['metadata']['name']}=={item['metadata']['version']}" for item in report["install"])
+    with open(PYTHON_LOCK_FILE, "w") as f:
+        f.write("# Generated by setup_android_env.py lock-python-dependencies\n")
+        f.write("\n".join(pins) + "\n")
+    print(f"Pinned {len(pins)} packages in {PYTHON_LOCK_FILE}")
+
+def read_python_lock():
+    """Return the name==version pins from the lock file."""
+    with open(PYTHON_LOCK_FILE) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+def _wheelhouse_files(pin):
+    """Return the (wheels, sdists) in the wheelhouse for exactly this pin.
+
+    Only wheels installable on the running interpreter and platform count;
+    the wheelhouse is shared by every Python on the machine.
+    """
+    try:
+        from packaging import tags, utils, version as versions
+    except ImportError:  # pip always vendors packaging
+        from pip._vendor.packaging import tags, utils, version as versions
+    name, _, pinned = pin.partition("==")
+    name, pinned = utils.canonicalize_name(name), versions.Version(pinned)
+    supported = set(tags.sys_tags())
+    wheels, sdists = [], []
+    for filename in os.listdir(wheelhouse_dir()):
+        try:
+            if filename.endswith(".whl"):
+                dist, found, _, file_tags = utils.parse_wheel_filename(filename)
+                if (dist, found) == (name, pinned) and supported & file_tags:
+                    wheels.append(filename)
+            else:
+                dist, found = utils.parse_sdist_filename(filename)
+                if (dist, found) == (name, pinned):
+                    sdists.append(filename)
+        except (utils.InvalidWheelFilename, utils.InvalidSdistFilename):
+            continue
+    return wheels, sdists
+
+def build_wheels(sdists, jobs=None):
+    """Build wheels for sdists in the wheelhouse, several at a time.
+
+    Each build also gets a share of the cores for its setuptools extension
+    modules (`build_ext --parallel`, passed through DIST_EXTRA_CONFIG).
+    """
+    jobs = jobs or max(1, min(len(sdists), os.cpu_count() or 1))
+    with tempfile.TemporaryDirectory() as tmp:
+        config = os.path.join(tmp, "build.cfg")
+        with open(config, "w") as f:
+            f.write(f"[build_ext]\nparallel = {max(1, (os.cpu_count() or 1) // jobs)}\n")
+        env = dict(os.environ, DIST_EXTRA_CONFIG=config)
+
+        def build(sdist):
+            print(f"Building wheel for {sdist}...")
+            run_process(_pip_command("wheel", "--no-deps", "--quiet", "--wheel-dir", wheelhouse_dir(),
+                                     os.path.join(wheelhouse_dir(), sdist)), check=True, env=env)
+
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            for future in [pool.submit(build, sdist) for sdist in sdists]:
+                future.result()
 
 def install_python_dependencies():
-    """Install required Python packages."""
+    """Install required Python packages from a locked local wheelhouse.
+
+    Dependencies are resolved once into requirements.lock. Pinned packages are
+    downloaded into the shared wheelhouse, sdists are built into wheels in
+    parallel, and everything is installed with a single offline pip run.
+    Machines with a populated wheelhouse (or a mirror serving one) skip the
+    download and build entirely. Returns False if the lock file is missing.
+    """
     print("Installing Python dependencies...")
-    packages = [
-        "buildozer",
-        "kivy",
-        "cython"
-    ]
-    for package in packages:
-        print(f"Installing {package}...")
-        run_command(f"pip install {package}")
+    if not os.path.exists(PYTHON_LOCK_FILE):
+        # Resolving here would pin each machine to whatever was newest that day
+        print(f"Error: {PYTHON_LOCK_FILE} is missing; restore it from version control "
+              f"or run `lock-python-dependencies` and commit the result")
+        return False
+    # Workspaces share the interpreter and the wheelhouse
+    with file_lock(os.path.join(CACHE_DIR, "locks", "python.lock")):
+        _install_python_dependencies()
+    return True
 
-def create_kivy_project_template(app_name):
-    """Create a basic Kivy project template."""
-    print(f"Creating Kivy project: {app_name}")
-    
-    # Create project directory
-    project_dir = f"./{app_name}"
-    os.makedirs(project_dir, exist_ok=True)
-    
-    # Create main.py
-    with open(f"{project_dir}/main.py", "w") as f:
-        f.write("""from kivy.app import App
+def _install_python_dependencies():
+    pins = read_python_lock()
+    os.makedirs(wheelhouse_dir(), exist_ok=True)
+
+    missing = [pin for pin in pins if not any(_wheelhouse_files(pin))]
+    if missing:
+        print(f"Downloading {len(missing)} packages into the wheelhouse...")
+        run_command(_pip_command("download", "--no-deps", "--quiet", "--dest", wheelhouse_dir(),
+                                 *_mirror_find_links(), *missing))
+
+    sdists = []
+    for pin in pins:
+        wheels, pin_sdists = _wheelhouse_files(pin)
+        if not wheels:
+            sdists.extend(pin_sdists[:1])
+    if sdists:
+        build_wheels(sdists)
+
+    run_command(_pip_command("install", "--no-index", "--find-links", wheelhouse_dir(),
+                             "--requirement", PYTHON_LOCK_FILE))
+
+KIVY_PROJECT_FILES = {
+    "main.py": """from kivy.app import App
 from kivy.uix.button import Button
 from kivy.uix.label import Label
 from kivy.uix.boxlayout import BoxLayout
@@ -526,96 +3067,1272 @@ class MainApp(App):
 
 if __name__ == '__main__':
     MainApp().run()
-""")
-    
-    # Create buildozer.spec
-    with open(f"{project_dir}/buildozer.spec", "w") as f:
-        f.write(f"""[app]
-title = {app_name}
-package.name = {app_name.lower()}
+""",
+    "buildozer.spec": """[app]
+title = ${app_name}
+package.name = ${package_name}
 package.domain = org.test
 source.dir = .
 source.include_exts = py,png,jpg,kv,atlas
+# Sprites are packed into atlas/ by `setup_android_env.py assets`
+source.exclude_dirs = atlas-src, bin
 version = 0.1
-requirements = python3,kivy
+requirements = ${requirements}
 orientation = portrait
 osx.python_version = 3
 osx.kivy_version = 1.9.1
 fullscreen = 0
 android.permissions = INTERNET
-android.api = 31
+android.api = ${android_api}
 android.minapi = 21
-android.sdk = 31
-android.ndk = 25.2.9519653
+android.sdk = ${android_api}
+android.ndk = ${ndk_version}
+android.sdk_path = ${sdk_path}
+android.ndk_path = ${ndk_path}
 android.private_storage = True
 android.accept_sdk_license = True
-android.arch = arm64-v8a
+android.arch = ${arch}
 
 [buildozer]
 log_level = 2
 warn_on_root = 1
-""")
+# Shared with every project built for the same requirements, NDK, API and arch
+build_dir = ${build_dir}
+""",
+    "build-android.sh": """#!/bin/sh
+# Install the NDK and Python toolchain first if the workspace deferred them
+"${python}" "${setup_script}" ensure ndk python --workspace "${workspace}" || exit 1
+# Pack atlases, recompress images and syntax-check sources (cached by content)
+"${python}" "${setup_script}" assets "$$(dirname "$$0")" || exit 1
+# Build a debug APK with the shared python-for-android cache and ccache
+export USE_CCACHE=1
+export CCACHE_DIR="${ccache_dir}"
+# Projects sharing the build_dir also share buildozer's app and recipe build
+# trees there, so only one of them may build at a time (flock(1) is not on macOS)
+exec "${python}" -c 'import fcntl, os, sys
+lock = open(sys.argv[1], "a")
+fcntl.flock(lock, fcntl.LOCK_EX)
+os.set_inheritable(lock.fileno(), True)
+os.execvp(sys.argv[2], sys.argv[2:])' "${build_dir}/.lock" buildozer android debug "$$@"
+""",
+}
+
+KIVY_REQUIREMENTS = "python3,kivy"
+KIVY_ANDROID_API = 31
+KIVY_ARCH = "arm64-v8a"
+
+KIVY_PROJECT_TEMPLATE = compile_project_template(KIVY_PROJECT_FILES)
+
+def kivy_build_cache(requirements=KIVY_REQUIREMENTS, android_api=KIVY_ANDROID_API, arch=KIVY_ARCH):
+    """Return the shared buildozer build_dir and ccache dir, creating them.
+
+    python-for-android recipes and dists built under the build_dir are
+    reused by every project with the same requirements, NDK version, API
+    level and arch, which together form the cache key.
+    """
+    ndk_version = NDK_COMPONENT.split(";")[1]
+    key_inputs = {"requirements": requirements, "ndk": ndk_version, "api": android_api, "arch": arch}
+    key = hashlib.sha256(json.dumps(key_inputs, sort_keys=True).encode()).hexdigest()[:16]
+    build_dir = os.path.join(CACHE_DIR, "p4a", key)
+    ccache_dir = os.path.join(CACHE_DIR, "ccache")
+    os.makedirs(build_dir, exist_ok=True)
+    os.makedirs(ccache_dir, exist_ok=True)
+    info_path = os.path.join(build_dir, "cache-key.json")
+    if not os.path.exists(info_path):
+        with open(info_path, "w") as f:
+            json.dump(key_inputs, f, indent=2)
+    conf_path = os.path.join(ccache_dir, "ccache.conf")
+    if not os.path.exists(conf_path):
+        with open(conf_path, "w") as f:
+            # Workspaces link the NDK at different paths, so hash compilers by
+            # content and ignore the working directory
+            f.write("max_size = 10G\ncompiler_check = content\nhash_dir = false\n")
+    return {"build_dir": build_dir, "ccache_dir": ccache_dir, "ndk_version": ndk_version,
+            "requirements": requirements, "android_api": android_api, "arch": arch}
+
+def create_kivy_project_template(app_name, parent_dir=".", sdk_root="android-sdk"):
+    """Create a basic Kivy project template."""
+    print(f"Creating Kivy project: {app_name}")
+    
+    project_dir = os.path.join(parent_dir, app_name)
+    sdk_root = os.path.abspath(sdk_root)
+    context = kivy_build_cache()
+    render_project(KIVY_PROJECT_TEMPLATE, project_dir, dict(
+        context,
+        app_name=app_name,
+        package_name=app_name.lower(),
+        sdk_path=sdk_root,
+        ndk_path=os.path.join(sdk_root, "ndk", context["ndk_version"]),
+        python=sys.executable,
+        setup_script=os.path.abspath(__file__),
+        workspace=os.path.dirname(sdk_root),
+    ))
+    if platform.system() != "Windows":
+        os.chmod(os.path.join(project_dir, "build-android.sh"), 0o755)
     
     print(f"Kivy project '{app_name}' created successfully!")
     print("\nTo build the Android APK:")
-    print(f"1. cd {app_name}")
+    print(f"1. cd {project_dir}")
     print("2. buildozer init")
-    print("3. buildozer android debug")
+    print("3. ./build-android.sh (buildozer android debug with the shared build cache)")
     print("\nThe APK will be in the bin/ directory")
+    return project_dir
 
-def verify_installation():
-    """Verify that SDK and NDK components are installed."""
-    sdk_path = "./android-sdk" if platform.system() != "Windows" else ".\\android-sdk"
-    required_dirs = [
-        f"{sdk_path}/platform-tools",
-        f"{sdk_path}/platforms/android-31",
-        f"{sdk_path}/build-tools/31.0.0",
-        f"{sdk_path}/ndk/25.2.9519653"
-    ]
+# Asset pipeline of Kivy projects (`assets`, run by build-android.sh): images
+# in atlas-src/<name>/ are packed into atlas/<name>.atlas, PNG and JPEG files
+# are recompressed losslessly and .py/.kv files are syntax-checked, on a
+# process pool. Results are cached by content hash in CACHE_DIR/assets, and files
+# unchanged since the last run (per ASSET_STATE_FILE) are skipped.
+ATLAS_SOURCE_DIR = "atlas-src"
+ATLAS_OUTPUT_DIR = "atlas"
+ATLAS_PAGE_SIZE = 1024
+ATLAS_PADDING = 2
+ASSET_STATE_FILE = ".android-env-assets.json"
+ASSET_PIPELINE_VERSION = 1
+ASSET_SKIP_DIRS = {ATLAS_SOURCE_DIR, "bin", "venv", "__pycache__"}
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+def _asset_cache_path(*parts):
+    key = hashlib.sha256("\n".join(map(str, (ASSET_PIPELINE_VERSION,) + parts)).encode()).hexdigest()
+    return os.path.join(CACHE_DIR, "assets", key[:2], key)
+
+def _image_optimizer(path):
+    """Return the lossless optimizer for an image, or None if there is none."""
+    if path.lower().endswith(".png"):
+        if shutil.which("oxipng"):
+            return "oxipng"
+        try:
+            import PIL  # noqa: F401
+        except ImportError:
+            return None
+        return "pillow"
+    return "jpegtran" if shutil.which("jpegtran") else None
+
+def _png_is_16bit_color(path):
+    # Pillow reads 16-bit RGB(A) as 8 bits per channel, so re-saving would lose data
+    with open(path, "rb") as f:
+        header = f.read(26)
+    return len(header) == 26 and header[24] == 16 and header[25] in (2, 6)
+
+def _optimize_image(path, optimizer):
+    """Recompress one image losslessly; runs in a worker process.
+
+    The file is only replaced by a smaller, pixel-identical version.
+    Returns its size before and after.
+    """
+    tmp = path + ".optimize.tmp"
+    before = os.path.getsize(path)
+    try:
+        if optimizer == "oxipng":
+            subprocess.run(["oxipng", "--quiet", "--opt", "2", "--strip", "safe", "--out", tmp, path], check=True)
+        elif optimizer == "jpegtran":
+            subprocess.run(["jpegtran", "-copy", "all", "-optimize", "-outfile", tmp, path], check=True)
+        else:
+            from PIL import Image
+            if _png_is_16bit_color(path):
+                return before, before
+            with Image.open(path) as image:
+                image.load()
+                params = {key: image.info[key] for key in ("transparency", "icc_profile", "dpi") if key in image.info}
+                image.save(tmp, "PNG", optimize=True, **params)
+                with Image.open(tmp) as saved:
+                    if saved.mode != image.mode or saved.tobytes() != image.tobytes():
+                        return before, before
+        if os.path.getsize(tmp) < before:
+            os.replace(tmp, path)
+        return before, os.path.getsize(path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def _pack_shelves(sizes, page_size, padding):
+    """Place (width, height) boxes on square pages, tallest first, in rows.
+
+    Returns a (page, x, y) placement per box, in input order.
+    """
+    placements = [None] * len(sizes)
+    page = x = y = row_height = 0
+    for i in sorted(range(len(sizes)), key=lambda i: (-sizes[i][1], -sizes[i][0])):
+        width, height = sizes[i][0] + padding, sizes[i][1] + padding
+        if width > page_size or height > page_size:
+            raise ValueError(f"image of {sizes[i][0]}x{sizes[i][1]} does not fit a {page_size}px atlas page")
+        if x + width > page_size:
+            x, y, row_height = 0, y + row_height, 0
+        if y + height > page_size:
+            page, x, y, row_height = page + 1, 0, 0, 0
+        placements[i] = (page, x, y)
+        x += width
+        row_height = max(row_height, height)
+    return placements
+
+def _pack_atlas(name, images, out_dir, page_size, padding):
+    """Pack images into <name>-<n>.png pages and <name>.atlas; runs in a worker process.
+
+    The .atlas file is the JSON index kivy.atlas writes: per page, the
+    [x, y, width, height] of each image, with y measured from the bottom.
+    Returns the names of the written files.
+    """
+    from PIL import Image
+    sprites = []
+    for path in images:
+        with Image.open(path) as image:
+            sprites.append((os.path.splitext(os.path.basename(path))[0], image.convert("RGBA")))
+    placements = _pack_shelves([sprite.size for _, sprite in sprites], page_size, padding)
+    pages = {}
+    for (sprite_id, sprite), (page, x, y) in zip(sprites, placements):
+        pages.setdefault(page, []).append((sprite_id, sprite, x, y))
+
+    index, written = {}, [f"{name}.atlas"]
+    for page, entries in sorted(pages.items()):
+        width = max(x + sprite.width for _, sprite, x, _ in entries)
+        height = max(y + sprite.height for _, sprite, _, y in entries)
+        canvas = Image.new("RGBA", (width, height))
+        page_name = f"{name}-{page}.png"
+        index[page_name] = {}
+        for sprite_id, sprite, x, y in entries:
+            canvas.paste(sprite, (x, y))
+            index[page_name][sprite_id] = [x, height - y - sprite.height, sprite.width, sprite.height]
+        canvas.save(os.path.join(out_dir, page_name), "PNG")
+        written.append(page_name)
+    with open(os.path.join(out_dir, f"{name}.atlas"), "w") as f:
+        json.dump(index, f, sort_keys=True)
+    return written
+
+def _check_source(path):
+    """Syntax-check a .py file or parse a .kv file; runs in a worker process.
+
+    Nothing is written: buildozer packages only the sources, and
+    python-for-android byte-compiles them for the target Python.
+    Returns an error message, or None.
+    """
+    if path.endswith(".py"):
+        with open(path, "rb") as f:
+            try:
+                compile(f.read(), path, "exec", dont_inherit=True)
+            except (SyntaxError, ValueError) as e:
+                return str(e)
+        return None
+    os.environ.setdefault("KIVY_NO_ARGS", "1")
+    os.environ.setdefault("KIVY_NO_CONSOLELOG", "1")
+    try:
+        from kivy.lang.parser import Parser, ParserException
+    except ImportError:
+        return None
+    with open(path, encoding="utf-8") as f:
+        try:
+            Parser(content=f.read(), filename=path)
+        except ParserException as e:
+            return str(e)
+    return None
+
+def _asset_files(project_dir):
+    """Return the image and source files of a project, relative to it."""
+    found = []
+    for dirpath, dirnames, filenames in os.walk(project_dir):
+        dirnames[:] = [d for d in dirnames if d not in ASSET_SKIP_DIRS and not d.startswith(".")]
+        for name in filenames:
+            if name.lower().endswith(IMAGE_EXTENSIONS + (".py", ".kv")):
+                found.append(os.path.relpath(os.path.join(dirpath, name), project_dir).replace(os.sep, "/"))
+    return sorted(found)
+
+def optimize_assets(project_dir, jobs=None):
+    """Run the asset pipeline of a Kivy project. Returns True on success."""
+    project_dir = os.path.abspath(project_dir)
+    state_path = os.path.join(project_dir, ASSET_STATE_FILE)
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {"files": {}, "atlases": {}}
+    counts = dict.fromkeys(["atlases", "atlases_cached", "images", "images_cached", "checked", "unchanged"], 0)
+    saved = 0
+    errors = []
+    with trace_span("assets", "assets", project=project_dir) as span, \
+            ProcessPoolExecutor(max_workers=jobs or EXTRACT_WORKERS) as pool:
+        # Atlases first: their pages are then optimized like any other image
+        source_root = os.path.join(project_dir, ATLAS_SOURCE_DIR)
+        atlas_dir = os.path.join(project_dir, ATLAS_OUTPUT_DIR)
+        atlas_jobs = {}
+        for name in sorted(os.listdir(source_root)) if os.path.isdir(source_root) else []:
+            folder = os.path.join(source_root, name)
+            images = sorted(os.path.join(folder, image) for image in os.listdir(folder)
+                            if image.lower().endswith(IMAGE_EXTENSIONS)) if os.path.isdir(folder) else []
+            if not images:
+                continue
+            digests = _hash_files(images)
+            key = _asset_cache_path("atlas", name, ATLAS_PAGE_SIZE, ATLAS_PADDING,
+                                    *(f"{os.path.basename(path)}={digests[path]}" for path in images))
+            if state["atlases"].get(name) == key and os.path.exists(os.path.join(atlas_dir, f"{name}.atlas")):
+                continue
+            os.makedirs(atlas_dir, exist_ok=True)
+            for old in os.listdir(atlas_dir):
+                if old == f"{name}.atlas" or re.fullmatch(re.escape(name) + r"-\d+\.png", old):
+                    os.remove(os.path.join(atlas_dir, old))
+            if os.path.isdir(key):
+                for cached in os.listdir(key):
+                    shutil.copyfile(os.path.join(key, cached), os.path.join(atlas_dir, cached))
+                state["atlases"][name] = key
+                counts["atlases_cached"] += 1
+            else:
+                atlas_jobs[pool.submit(_pack_atlas, name, images, atlas_dir, ATLAS_PAGE_SIZE, ATLAS_PADDING)] = (name, key)
+        for future, (name, key) in atlas_jobs.items():
+            try:
+                written = future.result()
+            except Exception as e:
+                errors.append(f"{ATLAS_SOURCE_DIR}/{name}: {e}")
+                continue
+            staging = f"{key}.{os.getpid()}.tmp"
+            os.makedirs(staging, exist_ok=True)
+            for output in written:
+                shutil.copyfile(os.path.join(atlas_dir, output), os.path.join(staging, output))
+            if os.path.isdir(key):
+                shutil.rmtree(staging)
+            else:
+                os.replace(staging, key)
+            state["atlases"][name] = key
+            counts["atlases"] += 1
+
+        files = _asset_files(project_dir)
+        digests = _hash_files([os.path.join(project_dir, rel) for rel in files])
+        image_jobs, check_jobs = {}, {}
+        for rel in files:
+            path = os.path.join(project_dir, rel)
+            digest = digests[path]
+            if state["files"].get(rel) == digest:
+                counts["unchanged"] += 1
+                continue
+            if rel.endswith((".py", ".kv")):
+                check_jobs[pool.submit(_check_source, path)] = rel
+                continue
+            optimizer = _image_optimizer(path)
+            if optimizer is None:
+                continue
+            cached = _asset_cache_path("image", optimizer, digest)
+            if os.path.exists(cached):
+                saved += os.path.getsize(path) - os.path.getsize(cached)
+                shutil.copyfile(cached, path)
+                counts["images_cached"] += 1
+                state["files"][rel] = _hash_file(path)
+            else:
+                image_jobs[pool.submit(_optimize_image, path, optimizer)] = (rel, optimizer, cached)
+
+        for future, (rel, optimizer, cached) in image_jobs.items():
+            path = os.path.join(project_dir, rel)
+            try:
+                before, after = future.result()
+            except Exception as e:
+                errors.append(f"{rel}: {e}")
+                continue
+            saved += before - after
+            counts["images"] += 1
+            state["files"][rel] = _hash_file(path)
+            # The result is final too, e.g. when another checkout copies it
+            for key in {cached, _asset_cache_path("image", optimizer, state["files"][rel])}:
+                os.makedirs(os.path.dirname(key), exist_ok=True)
+                shutil.copyfile(path, key + ".tmp")
+                os.replace(key + ".tmp", key)
+        for future, rel in check_jobs.items():
+            error = future.result()
+            if error:
+                errors.append(f"{rel}: {error}")
+                state["files"].pop(rel, None)
+                continue
+            counts["checked"] += 1
+            state["files"][rel] = digests[os.path.join(project_dir, rel)]
+        span.set(bytes_saved=saved, errors=len(errors), **counts)
+
+    with open(state_path + ".tmp", "w") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(state_path + ".tmp", state_path)
+    print(f"Assets: {counts['atlases']} atlases packed ({counts['atlases_cached']} from cache), "
+          f"{counts['images']} images recompressed ({counts['images_cached']} from cache), "
+          f"{counts['checked']} sources checked, {counts['unchanged']} unchanged; "
+          f"{saved / 1024:.0f} KB saved")
+    for error in errors:
+        print(f"Error: {error}")
+    return not errors
+
+def read_project_manifest(path):
+    """Read project definitions from a JSON list or a CSV file.
+
+    Each project has a "type" ("android" or "kivy"), an "app_name" and, for
+    Android projects, a "package_name". Every project is generated into its
+    own directory, so two app_names naming the same directory are refused.
+    """
+    with open(path, newline="") as f:
+        if path.lower().endswith(".csv"):
+            projects = [dict(row) for row in csv.DictReader(f)]
+        else:
+            projects = json.load(f)
+    directories = {}
+    for number, project in enumerate(projects, 1):
+        kind = project.get("type", "android")
+        if kind not in ("android", "kivy"):
+            raise ValueError(f"Project {number}: unknown type {kind!r}")
+        if not project.get("app_name"):
+            raise ValueError(f"Project {number}: app_name is required")
+        if kind == "android" and not project.get("package_name"):
+            raise ValueError(f"Project {number}: package_name is required for Android projects")
+        # Case-only differences collide on macOS and Windows file systems
+        directory = os.path.normpath(project["app_name"]).lower()
+        if directory in directories:
+            raise ValueError(f"Project {number}: app_name {project['app_name']!r} has the same "
+                             f"directory as project {directories[directory]}")
+        directories[directory] = number
+    return projects
+
+def generate_projects(manifest_path, output_dir, jobs=None):
+    """Generate every project listed in a manifest, in parallel.
+
+    The Gradle wrapper is generated once and copied into the other Android
+    projects instead of starting Gradle for each of them. Returns True if all
+    projects were created.
+    """
+    projects = read_project_manifest(manifest_path)
+    os.makedirs(output_dir, exist_ok=True)
+    android = [p for p in projects if p.get("type", "android") == "android"]
+    wrapper_from = None
+    if android:
+        first = android[0]
+        wrapper_from = create_android_project_template(first["app_name"], first["package_name"], output_dir)
+
+    def generate(project):
+        if project.get("type", "android") == "kivy":
+            create_kivy_project_template(project["app_name"], output_dir)
+        elif project is not android[0]:
+            create_android_project_template(project["app_name"], project["package_name"],
+                                            output_dir, wrapper_from=wrapper_from)
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=jobs or min(32, (os.cpu_count() or 1) * 4)) as pool:
+        futures = {pool.submit(generate, project): project["app_name"] for project in projects}
+        for future, app_name in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error creating project {app_name}: {e}")
+                failed += 1
+    print(f"Generated {len(projects) - failed} of {len(projects)} projects in {output_dir}")
+    return failed == 0
+
+def _scan_tree(path):
+    """Return ({rel: stat_result} of files, {rel: target} of symlinks) under path."""
+    files, symlinks = {}, {}
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            full = os.path.join(dirpath, name)
+            rel = os.path.relpath(full, path).replace(os.sep, "/")
+            st = os.lstat(full)
+            if stat.S_ISLNK(st.st_mode):
+                symlinks[rel] = os.readlink(full)
+            elif stat.S_ISREG(st.st_mode):
+                files[rel] = st
+    return files, symlinks
+
+def _hash_file_mmap(path):
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                hasher.update(mapped)
+    return hasher.hexdigest()
+
+def _hash_files(paths):
+    """Return {path: sha256}, hashing on all cores.
+
+    hashlib releases the GIL while hashing a memory-mapped file, so threads
+    are enough to keep every core busy; the largest files start first.
+    """
+    paths = sorted(paths, key=lambda path: os.path.getsize(path), reverse=True)
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+        return dict(zip(paths, pool.map(_hash_file_mmap, paths)))
+
+def load_integrity(ws):
+    try:
+        with open(ws.path(INTEGRITY_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"components": {}}
+
+def save_integrity(ws, manifest):
+    path = ws.path(INTEGRITY_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+def record_integrity(ws, dirs):
+    """Record the size and SHA-256 of every file under dirs.
+
+    Called whenever the setup installs or replaces a component; the
+    recorded manifest is what verify_integrity() checks against. Files
+    linked from the store take the digest of their stored object; only
+    the others are hashed.
+    """
+    components = {}
+    with trace_span("record integrity", "verify") as span:
+        stored = store_digests()
+        for directory in dirs:
+            if not os.path.isdir(directory):
+                continue
+            files, symlinks = _scan_tree(directory)
+            digests = {rel: stored.get((st.st_dev, st.st_ino)) for rel, st in files.items()}
+            unstored = [rel for rel, digest in digests.items() if digest is None]
+            hashes = _hash_files([os.path.join(directory, rel) for rel in unstored])
+            for rel in unstored:
+                digests[rel] = hashes[os.path.join(directory, rel)]
+            components[os.path.relpath(directory, ws.root).replace(os.sep, "/")] = {
+                "files": {rel: [st.st_size, digests[rel], st.st_mtime_ns, st.st_ino]
+                          for rel, st in files.items()},
+                "symlinks": symlinks,
+            }
+            span.add(files=len(files), hashed=len(unstored))
+    # Steps finish concurrently; hash outside the lock, merge under it
+    with ws.lock:
+        manifest = load_integrity(ws)
+        manifest["components"].update(components)
+        save_integrity(ws, manifest)
+
+def verify_integrity(ws, full=False):
+    """Check installed components against the recorded integrity manifest.
+
+    Missing files and size changes are found from metadata alone. Files
+    whose size, mtime and inode still match the manifest are trusted unless
+    full is set; the others are hashed in parallel. Returns a list of
+    problems (empty if everything matches).
+    """
+    manifest = load_integrity(ws)
+    problems = []
+    checked = hashed = 0
+    with trace_span("verify integrity", "verify", full=full) as span:
+        for component, recorded in sorted(manifest["components"].items()):
+            directory = ws.path(*component.split("/"))
+            if not os.path.isdir(directory):
+                problems.append(f"{component}: missing")
+                continue
+            files, symlinks = _scan_tree(directory)
+            suspect = []
+            for rel, (size, digest, mtime_ns, inode) in recorded["files"].items():
+                st = files.get(rel)
+                if st is None:
+                    problems.append(f"{component}/{rel}: missing")
+                elif st.st_size != size:
+                    problems.append(f"{component}/{rel}: size {st.st_size}, expected {size}")
+                elif full or (st.st_mtime_ns, st.st_ino) != (mtime_ns, inode):
+                    suspect.append(rel)
+            for rel, target in recorded["symlinks"].items():
+                if symlinks.get(rel) != target:
+                    problems.append(f"{component}/{rel}: symlink changed or missing")
+            for rel in files.keys() - recorded["files"].keys():
+                print(f"Note: {component}/{rel} is not part of the installed component")
+
+            hashes = _hash_files([os.path.join(directory, rel) for rel in suspect])
+            for rel in suspect:
+                entry = recorded["files"][rel]
+                if hashes[os.path.join(directory, rel)] != entry[1]:
+                    problems.append(f"{component}/{rel}: content changed")
+                else:
+                    # Same content: trust the new metadata on the next run
+                    entry[2], entry[3] = files[rel].st_mtime_ns, files[rel].st_ino
+            checked += len(recorded["files"])
+            hashed += len(suspect)
+        span.set(files=checked, hashed=hashed, problems=len(problems))
+    if hashed and not problems:
+        with ws.lock:
+            save_integrity(ws, manifest)
+    print(f"Checked {checked} files in {len(manifest['components'])} components ({hashed} hashed)")
+    return problems
+
+def integrity_dirs(ws):
+    """Return the directories recorded for verification, by setup step."""
+    sdk_root = ws.path("android-sdk")
+    return {
+        "gradle": [gradle_home_path(ws)],
+        "cmdline-tools": [os.path.join(sdk_root, "cmdline-tools", "latest")],
+        "sdk": [os.path.join(sdk_root, *component.split(";")) for component in ws.sdk_components()],
+    }
+
+def verify_installation(ws, full=False):
+    """Verify that SDK and NDK components are installed and intact.
+
+    Installed files are checked against the integrity manifest recorded at
+    install time (see verify_integrity()).
+    """
+    sdk_path = ws.path("android-sdk")
+    required_dirs = [os.path.join(sdk_path, *component.split(";")) for component in ws.sdk_components()]
     
     print("Verifying installation...")
     for directory in required_dirs:
         if not os.path.exists(directory):
             print(f"Missing: {directory}")
-            exit(1)
+            return False
+    problems = verify_integrity(ws, full)
+    if problems:
+        for problem in problems[:20]:
+            print(f"Damaged: {problem}")
+        if len(problems) > 20:
+            print(f"... and {len(problems) - 20} more")
+        print("Re-run the setup with --force or update the damaged components")
+        return False
     print("All required components are installed successfully!")
+    return True
+
+def install_command_line_tools(ws):
+    """Download and extract the Android command-line tools."""
+    filename = download_android_tools(ws)
+    if filename is None:
+        return False
+    extract_tools(ws, filename)
+    return True
+
+def require_java(ws):
+    """Fail the setup if Java is not available."""
+    if not check_java(ws):
+        print("Java installation required. Please install Java and try again.")
+        return False
+    return True
+
+def ensure_components(ws, names):
+    """Install the deferred components in names ("ndk", "python") if missing.
+
+    Generated projects call this (as `ensure`) before building, so a
+    workspace set up with --lazy gets each component on first use. Returns
+    True if all of them are installed.
+    """
+    ndk_dir = ws.path("android-sdk", *NDK_COMPONENT.split(";"))
+    for name in names:
+        if name == "ndk":
+            # Builds of several projects may start at once
+            with file_lock(ws.path(".android-env-ensure.lock")):
+                if sdk_component_installed(ws, NDK_COMPONENT):
+                    continue
+                print(f"{NDK_COMPONENT} is needed and not installed yet")
+                if install_sdk_and_ndk(ws, [NDK_COMPONENT]) is False:
+                    return False
+                record_integrity(ws, [ndk_dir])
+        elif name == "python":
+            if None not in installed_python_packages(PYTHON_PACKAGES).values():
+                continue
+            print("The Python toolchain is needed and not installed yet")
+            if not install_python_dependencies():
+                return False
+        else:
+            print(f"Unknown component '{name}' (choose from {', '.join(LAZY_COMPONENTS)})")
+            return False
+    return True
+
+def installed_python_packages(packages):
+    """Return the installed version of each package, or None if missing."""
+    from importlib import metadata
+    versions = {}
+    for package in packages:
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+# Snapshots pack a provisioned toolchain into one file: zlib-compressed chunks
+# of SNAPSHOT_CHUNK_BYTES of file data, followed by a JSON index of files,
+# chunks and their SHA-256, and a trailer pointing at the index. Chunks are
+# independent, so export compresses and restore decompresses them in parallel.
+SNAPSHOT_MAGIC = b"ANDROID-ENV-SNAPSHOT-1\n"
+SNAPSHOT_CHUNK_BYTES = 8 * 1024 * 1024
+SNAPSHOT_ROOTS = ["android-sdk", "gradle", "jdk"]
+
+def _snapshot_entries(ws):
+    """Return (files, symlinks, dirs) under the snapshot roots of ws."""
+    files, symlinks, dirs = [], {}, []
+    for root in SNAPSHOT_ROOTS:
+        if not os.path.isdir(ws.path(root)):
+            continue
+        dirs.append([root, stat.S_IMODE(os.stat(ws.path(root)).st_mode)])
+        for dirpath, dirnames, filenames in os.walk(ws.path(root)):
+            dirnames.sort()
+            for name in dirnames + sorted(filenames):
+                full = os.path.join(dirpath, name)
+                rel = os.path.relpath(full, ws.root).replace(os.sep, "/")
+                st = os.lstat(full)
+                if stat.S_ISLNK(st.st_mode):
+                    symlinks[rel] = os.readlink(full)
+                elif stat.S_ISDIR(st.st_mode):
+                    dirs.append([rel, stat.S_IMODE(st.st_mode)])
+                else:
+                    files.append([rel, stat.S_IMODE(st.st_mode), st.st_size, st.st_mtime_ns])
+    return files, symlinks, dirs
+
+def _plan_snapshot_chunks(files):
+    """Pack file contents into chunks of [file index, file offset, length] pieces."""
+    chunks, pieces, size = [], [], 0
+    for number, (_, _, file_size, _) in enumerate(files):
+        offset = 0
+        while offset < file_size:
+            length = min(file_size - offset, SNAPSHOT_CHUNK_BYTES - size)
+            pieces.append([number, offset, length])
+            offset += length
+            size += length
+            if size == SNAPSHOT_CHUNK_BYTES:
+                chunks.append(pieces)
+                pieces, size = [], 0
+    if pieces:
+        chunks.append(pieces)
+    return chunks
+
+def _compress_chunk(root, pieces):
+    """Read and compress one chunk of (path, offset, length) pieces; runs in a worker process."""
+    raw = bytearray()
+    for rel, offset, length in pieces:
+        with open(os.path.join(root, *rel.split("/")), "rb") as f:
+            f.seek(offset)
+            data = f.read(length)
+        if len(data) != length:
+            raise IOError(f"{rel} changed while exporting the snapshot")
+        raw += data
+    return zlib.compress(raw, 6), len(raw), hashlib.sha256(raw).hexdigest()
+
+def _bounded_map(pool, func, items, window):
+    """pool.map that keeps at most window results in flight, in order."""
+    pending = []
+    for item in items:
+        pending.append(pool.submit(func, *item))
+        if len(pending) >= window:
+            yield pending.pop(0).result()
+    for future in pending:
+        yield future.result()
+
+def export_snapshot(ws, path, workers=None):
+    """Write the workspace's toolchain (SDK, licenses, Gradle, JDK) to a snapshot.
+
+    Refuses to export an installation that does not pass verification.
+    Returns True on success.
+    """
+    if not verify_installation(ws):
+        print("Not exporting a snapshot of an incomplete installation")
+        return False
+    with trace_span(f"export {os.path.basename(path)}", "snapshot") as span:
+        files, symlinks, dirs = _snapshot_entries(ws)
+        paths = [entry[0] for entry in files]
+        chunk_plan = _plan_snapshot_chunks(files)
+        chunks = []
+        workers = workers or EXTRACT_WORKERS
+        with open(path + ".tmp", "wb") as out, ProcessPoolExecutor(max_workers=workers) as pool:
+            out.write(SNAPSHOT_MAGIC)
+            tasks = [(ws.root, [(paths[number], offset, length) for number, offset, length in pieces])
+                     for pieces in chunk_plan]
+            results = _bounded_map(pool, _compress_chunk, tasks, 2 * workers)
+            for pieces, (data, raw_size, digest) in zip(chunk_plan, results):
+                chunks.append({"offset": out.tell(), "length": len(data), "size": raw_size,
+                               "sha256": digest, "pieces": pieces})
+                out.write(data)
+            index = zlib.compress(json.dumps({
+                "roots": [root for root in SNAPSHOT_ROOTS if os.path.isdir(ws.path(root))],
+                "files": files, "symlinks": symlinks, "dirs": dirs, "chunks": chunks,
+            }).encode())
+            index_offset = out.tell()
+            out.write(index)
+            out.write(struct.pack("<QQ", index_offset, len(index)) + SNAPSHOT_MAGIC)
+        os.replace(path + ".tmp", path)
+        total = sum(entry[2] for entry in files)
+        span.set(files=len(files), bytes=total, compressed=os.path.getsize(path))
+    print(f"Snapshot written to {path}: {len(files)} files, {total / 1024 ** 2:.1f} MB "
+          f"in {os.path.getsize(path) / 1024 ** 2:.1f} MB, id {hashlib.sha256(index).hexdigest()[:16]}")
+    return True
+
+def read_snapshot_index(path):
+    """Return the index of a snapshot and its id (the SHA-256 of the index)."""
+    trailer = struct.calcsize("<QQ") + len(SNAPSHOT_MAGIC)
+    with open(path, "rb") as f:
+        if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not an environment snapshot")
+        f.seek(-trailer, os.SEEK_END)
+        index_offset, index_length = struct.unpack("<QQ", f.read(struct.calcsize("<QQ")))
+        if f.read() != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is truncated")
+        f.seek(index_offset)
+        data = f.read(index_length)
+    return json.loads(zlib.decompress(data)), hashlib.sha256(data).hexdigest()
+
+def _check_snapshot_index(index, path):
+    """Refuse an index with paths that would land outside its roots.
 
-def main():
+    Every root must be one of SNAPSHOT_ROOTS, and every file, directory and
+    symlink must lie below a root and not below a symlink of the snapshot.
+    """
+    for root in index["roots"]:
+        if root not in SNAPSHOT_ROOTS:
+            raise ValueError(f"Refusing to restore unknown root {root!r} from {path}")
+    rels = [entry[0] for entry in index["files"]] + [rel for rel, _ in index["dirs"]] + list(index["symlinks"])
+    for rel in rels:
+        if _safe_parts(rel, rel, path)[0] not in index["roots"]:
+            raise ValueError(f"Refusing to restore {rel!r} outside the roots of {path}")
+    _refuse_paths_below_links(rels, index["symlinks"], path)
+
+def _check_snapshot_links(staging, index, path):
+    """Refuse restored symlinks that resolve outside their own root."""
+    for rel in index["symlinks"]:
+        root = os.path.realpath(os.path.join(staging, rel.split("/")[0]))
+        resolved = os.path.realpath(os.path.join(staging, *rel.split("/")))
+        if resolved != root and not resolved.startswith(root + os.sep):
+            raise ValueError(f"Refusing to restore symlink {rel!r} pointing outside its root from {path}")
+
+def _restore_chunk(path, staging, chunk):
+    """Decompress one chunk into the staging files; runs in a worker process.
+
+    chunk is an index entry whose pieces name files by path.
+    """
+    with open(path, "rb") as f:
+        f.seek(chunk["offset"])
+        raw = zlib.decompress(f.read(chunk["length"]))
+    if len(raw) != chunk["size"] or hashlib.sha256(raw).hexdigest() != chunk["sha256"]:
+        raise ValueError(f"Snapshot chunk at offset {chunk['offset']} is corrupt")
+    view = memoryview(raw)
+    position = 0
+    for rel, offset, length in chunk["pieces"]:
+        with open(os.path.join(staging, *rel.split("/")), "r+b") as f:
+            f.seek(offset)
+            f.write(view[position:position + length])
+        position += length
+    return len(raw)
+
+def restore_snapshot(ws, path, workers=None):
+    """Restore a snapshot into the workspace, replacing its toolchain.
+
+    Every root is rebuilt in a staging directory, chunks are decompressed
+    in parallel and checked against their SHA-256, and the finished roots
+    are renamed into place. The state manifest is updated so a following
+    `setup` skips the restored steps. Returns True on success.
+    """
+    try:
+        index, snapshot_id = read_snapshot_index(path)
+    except (OSError, ValueError) as e:
+        print(f"Error reading snapshot: {e}")
+        return False
+    print(f"Restoring snapshot {snapshot_id[:16]} into {ws.root}...")
+    staging = ws.path(f".restore-{os.getpid()}")
+    with trace_span(f"restore {os.path.basename(path)}", "snapshot", files=len(index["files"])) as span:
+        try:
+            _check_snapshot_index(index, path)
+            for rel, _ in index["dirs"]:
+                os.makedirs(os.path.join(staging, *rel.split("/")), exist_ok=True)
+            paths = [entry[0] for entry in index["files"]]
+            for rel, _, size, _ in index["files"]:
+                with open(os.path.join(staging, *rel.split("/")), "wb") as f:
+                    f.truncate(size)
+            workers = workers or EXTRACT_WORKERS
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(_restore_chunk, os.path.abspath(path), staging,
+                                       dict(chunk, pieces=[(paths[number], offset, length)
+                                                           for number, offset, length in chunk["pieces"]]))
+                           for chunk in index["chunks"]]
+                span.add(bytes_extracted=sum(future.result() for future in futures))
+            for rel, mode, _, mtime_ns in index["files"]:
+                target = os.path.join(staging, *rel.split("/"))
+                os.chmod(target, mode)
+                os.utime(target, ns=(mtime_ns, mtime_ns))
+            # Symlinks come last, so no file is ever written through one
+            if platform.system() != "Windows":
+                for rel, link_target in index["symlinks"].items():
+                    os.symlink(link_target, os.path.join(staging, *rel.split("/")))
+                _check_snapshot_links(staging, index, path)
+            for rel, mode in sorted(index["dirs"], reverse=True):
+                os.chmod(os.path.join(staging, *rel.split("/")), mode)
+            for root in index["roots"]:
+                _replace_dir(os.path.join(staging, root), ws.path(root))
+        except (OSError, ValueError, zlib.error) as e:
+            print(f"Error restoring snapshot: {e}")
+            return False
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    if "gradle" in index["roots"]:
+        activate_gradle(ws)
+    # Only steps whose outputs all came with the snapshot are up to date; a
+    # java-only snapshot restored into a full workspace still needs the NDK
+    state = load_state(ws)
+    for step in setup_steps(ws):
+        if step.name in ("gradle", "cmdline-tools", "sdk"):
+            outputs = step.outputs()
+            if outputs is not None:
+                state[step.name] = {"inputs": step.inputs, "outputs": outputs}
+            else:
+                state.pop(step.name, None)
+    save_state(ws, state)
+    record_integrity(ws, [directory for dirs in integrity_dirs(ws).values() for directory in dirs])
+    print(f"Restored {len(index['files'])} files")
+    return True
+
+def setup_steps(ws):
+    """Declare the setup steps of a workspace and the dependencies between them.
+
+    Only the steps the workspace's profile needs are returned.
+    """
+    sdk_root = ws.path("android-sdk")
+    sdk_components = ws.sdk_components()
+    sdk_outputs = [os.path.join(sdk_root, *component.split(";")) for component in sdk_components]
+    profile = PROFILES[ws.profile]
+    java_app, kivy_app = ws.path("MyJavaApp"), ws.path("MyKivyApp")
+    recorded_dirs = integrity_dirs(ws)
+
+    # Outputs of None mean something is missing; see step_is_current()
+    def python_packages():
+        versions = installed_python_packages(PYTHON_PACKAGES)
+        return None if None in versions.values() else versions
+
+    def recording(name, func):
+        """Wrap a step so a successful run records its files for `verify`."""
+        def run():
+            result = func()
+            if result is not False:
+                record_integrity(ws, recorded_dirs[name])
+            return result
+        return run
+
+    steps = [
+        Step("gradle", recording("gradle", lambda: download_gradle(ws)), [], 130,
+             inputs={"url": GRADLE_URL, "version": GRADLE_VERSION, "wrapper_url": gradle_distribution_url(),
+                     "gradle_user_home": gradle_user_home()},
+             outputs=lambda: fingerprint_paths([gradle_home_path(ws), _wrapper_zip_path() + ".ok"]),
+             activate=lambda: activate_gradle(ws)),
+        Step("java", lambda: require_java(ws), [], 180),
+        Step("cmdline-tools", recording("cmdline-tools", lambda: install_command_line_tools(ws)), [], 130,
+             inputs={"url": command_line_tools_url()},
+             outputs=lambda: fingerprint_paths([os.path.join(sdk_root, "cmdline-tools", "latest")])),
+        Step("python-dependencies", install_python_dependencies, [], 40,
+             inputs={"packages": PYTHON_PACKAGES, "python": sys.executable,
+                     "lock": fingerprint_paths([PYTHON_LOCK_FILE])},
+             outputs=python_packages),
+        # sdkmanager is a Java program
+        Step("sdk", recording("sdk", lambda: install_sdk_and_ndk(ws)), ["cmdline-tools", "java"],
+             1100 if NDK_COMPONENT in sdk_components else 100,
+             inputs={"components": sdk_components, "ndk_abis": ws.ndk_abis},
+             outputs=lambda: fingerprint_paths(sdk_outputs)),
+        # verify checks every recorded component, so it waits for all installers
+        Step("verify", lambda: verify_installation(ws), ["gradle", "cmdline-tools", "sdk"], 1),
+        # Templates are only regenerated when missing, so local edits to the
+        # sample projects are kept. `gradle wrapper` needs Gradle installed.
+        Step("android-template",
+             lambda: create_android_project_template("MyJavaApp", "com.example.myjavaapp", ws.root, env=ws.env),
+             ["gradle"], 1,
+             inputs={"app_name": "MyJavaApp", "package_name": "com.example.myjavaapp"},
+             outputs=lambda: os.path.isdir(java_app) or None),
+        Step("kivy-template", lambda: create_kivy_project_template("MyKivyApp", ws.root, sdk_root), [], 1,
+             inputs={"app_name": "MyKivyApp"},
+             outputs=lambda: os.path.isdir(kivy_app) or None),
+    ]
+    skipped = set()
+    if not profile["python"] or ws.lazy:
+        skipped.add("python-dependencies")
+    for template in ("android", "kivy"):
+        if template not in profile["templates"]:
+            skipped.add(f"{template}-template")
+    return [step for step in steps if step.name not in skipped]
+
+def critical_path_priorities(steps):
+    """Return, per step, the total weight of the heaviest chain starting at it."""
+    dependents = {step.name: [] for step in steps}
+    for step in steps:
+        for dep in step.deps:
+            if dep not in dependents:
+                raise ValueError(f"Step '{step.name}' depends on unknown step '{dep}'")
+            dependents[dep].append(step.name)
+
+    by_name = {step.name: step for step in steps}
+    priorities = {}
+
+    def visit(name, path):
+        if name in path:
+            raise ValueError(f"Dependency cycle through step '{name}'")
+        if name not in priorities:
+            tail = [visit(child, path | {name}) for child in dependents[name]]
+            priorities[name] = by_name[name].weight + max(tail, default=0)
+        return priorities[name]
+
+    for step in steps:
+        visit(step.name, frozenset())
+    return priorities
+
+def _run_traced_step(step):
+    with trace_span(step.name, "step") as span:
+        result = step.func()
+        span.set(ok=result is not False)
+        return result
+
+def run_steps(ws, steps, max_workers=None, force=False):
+    """Run setup steps on a worker pool as soon as their dependencies finish.
+
+    Ready steps are started in critical-path order, so the heaviest chains
+    (the big downloads) begin first. Incremental steps that are up to date
+    with the state manifest are skipped unless force is set. Returns True if
+    every step succeeded; after the first failure no new steps are started.
+    """
+    state = load_state(ws)
+    priorities = critical_path_priorities(steps)
+    by_name = {step.name: step for step in steps}
+    remaining = {step.name: set(step.deps) for step in steps}
+    max_workers = max_workers or min(len(steps), (os.cpu_count() or 1) + 2, 8)
+
+    ready = []
+    for name, deps in remaining.items():
+        if not deps:
+            heapq.heappush(ready, (-priorities[name], name))
+
+    def finish(name):
+        for other, deps in remaining.items():
+            if name in deps:
+                deps.discard(name)
+                if not deps:
+                    heapq.heappush(ready, (-priorities[other], other))
+
+    running = {}
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while ready or running:
+            while ready and not failed and len(running) < max_workers:
+                _, name = heapq.heappop(ready)
+                step = by_name[name]
+                if not force and step_is_current(state, step):
+                    print(f"Skipping {name} (up to date)")
+                    with trace_span(name, "step", skipped=True):
+                        pass
+                    if step.activate:
+                        step.activate()
+                    finish(name)
+                    continue
+                running[pool.submit(_run_traced_step, step)] = name
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                # result() re-raises exceptions and SystemExit from the step
+                if future.result() is False:
+                    print(f"Step '{name}' failed.")
+                    failed.append(name)
+                    state.pop(name, None)
+                    continue
+                step = by_name[name]
+                outputs = step.outputs() if step.outputs is not None else None
+                if outputs is not None:
+                    state[name] = {"inputs": step.inputs, "outputs": outputs}
+                else:
+                    state.pop(name, None)
+                save_state(ws, state)
+                finish(name)
+    if failed:
+        save_state(ws, state)
+
+    return not failed
+
+def provision(ws, force=False):
+    """Run the setup steps of one workspace. Returns True if all succeeded."""
+    os.makedirs(ws.path("android-sdk"), exist_ok=True)
+    state = load_state(ws)
+    state["profile"] = {"name": ws.profile, "lazy": ws.lazy, "ndk_abis": ws.ndk_abis}
+    save_state(ws, state)
+    try:
+        return run_steps(ws, setup_steps(ws), force=force)
+    except SystemExit:
+        # A step gave up with exit(); only this workspace fails
+        return False
+    finally:
+        ws.cleanup()
+
+def provision_many(roots, jobs=None, force=False, profile=None, lazy=None, ndk_abis=None):
+    """Provision several workspaces at once and return those that failed.
+
+    All workspaces share the transfer engine, the artifact cache and the
+    store, so each artifact is downloaded and unpacked once and the other
+    workspaces wait for it and link the result.
+    """
+    with ThreadPoolExecutor(max_workers=jobs or len(roots), thread_name_prefix="workspace") as pool:
+        results = list(pool.map(lambda root: provision(Workspace(root, profile, lazy, ndk_abis), force), roots))
+    return [root for root, ok in zip(roots, results) if not ok]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Set up an Android development environment.")
+    subparsers = parser.add_subparsers(dest="command")
+    provision_options = argparse.ArgumentParser(add_help=False)
+    provision_options.add_argument("--profile", choices=list(PROFILES),
+                                   help="components to install (default: the workspace's last profile, else full)")
+    provision_options.add_argument("--lazy", action=argparse.BooleanOptionalAction, default=None,
+                                   help="install the NDK and Python toolchain when a project first needs them")
+    provision_options.add_argument("--ndk-abis", type=lambda text: [abi for abi in text.split(",") if abi],
+                                   metavar="ABI[,ABI...]",
+                                   help="install only the NDK files these ABIs need, e.g. arm64-v8a "
+                                        "('' for the complete NDK; or set ANDROID_ENV_NDK_ABIS)")
+    provision_options.add_argument("--build-cache", metavar="URL",
+                                   help="remote Gradle build cache for the Java template, e.g. a 'cache-node' "
+                                        "(or set ANDROID_ENV_BUILD_CACHE)")
+    provision_options.add_argument("--force", action="store_true",
+                                   help="redo every step, even those recorded as up to date")
+    provision_options.add_argument("--sdk-installer", choices=["native", "sdkmanager"],
+                                   help="how to install SDK packages (default: native)")
+    provision_options.add_argument("--trace", metavar="FILE",
+                                   help="write a Chrome trace of every step to FILE and a JSON summary next to it")
+    provision_options.add_argument("--mirror", help="LAN mirror started with 'serve' (or set ANDROID_ENV_MIRROR)")
+    provision_options.add_argument("--mirrors", metavar="FILE",
+                                   help="JSON file of more download mirrors and pinned digests "
+                                        "(or set ANDROID_ENV_MIRRORS_FILE)")
+    provision_options.add_argument("--max-mb-per-s", type=float,
+                                   help="bandwidth budget shared by all downloads (or set ANDROID_ENV_MAX_MB_PER_S)")
+    setup_parser = subparsers.add_parser("setup", parents=[provision_options],
+                                         help="provision the environment (default)")
+    setup_parser.add_argument("--workspace", default=".", help="directory to provision (default: current)")
+    many_parser = subparsers.add_parser("provision-many", parents=[provision_options],
+                                        help="provision several workspaces in parallel, sharing downloads")
+    many_parser.add_argument("workspaces", nargs="+", metavar="WORKSPACE")
+    many_parser.add_argument("--jobs", type=int, help="number of workspaces provisioned at once (default: all)")
+    subparsers.add_parser("cache-stats", help="show artifact cache usage")
+    subparsers.add_parser("lock-python-dependencies", help="re-resolve Python packages into requirements.lock")
+    generate_parser = subparsers.add_parser("generate", help="generate projects listed in a JSON or CSV manifest")
+    generate_parser.add_argument("manifest", help="JSON list or CSV file with type, app_name and package_name")
+    generate_parser.add_argument("--output-dir", default=".")
+    generate_parser.add_argument("--jobs", type=int, help="number of projects generated at once")
+    generate_parser.add_argument("--build-cache", metavar="URL",
+                                 help="remote Gradle build cache for Java projects (or set ANDROID_ENV_BUILD_CACHE)")
+    assets_parser = subparsers.add_parser("assets", help="pack atlases, recompress images and syntax-check sources of a Kivy project")
+    assets_parser.add_argument("project", nargs="?", default=".", help="Kivy project directory (default: current)")
+    assets_parser.add_argument("--jobs", type=int, help="number of worker processes")
+    update_parser = subparsers.add_parser("update", help="update an installed component, downloading only changed files")
+    update_parser.add_argument("component", help='installed component, e.g. "ndk;25.2.9519653" or "gradle;8.4"')
+    update_parser.add_argument("target", nargs="?", help="version to update to (default: refresh component in place)")
+    update_parser.add_argument("--mirror", help="LAN mirror started with 'serve' (or set ANDROID_ENV_MIRROR)")
+    update_parser.add_argument("--mirrors", metavar="FILE",
+                               help="JSON file of more download mirrors (or set ANDROID_ENV_MIRRORS_FILE)")
+    update_parser.add_argument("--workspace", default=".", help="workspace to update (default: current)")
+    ensure_parser = subparsers.add_parser("ensure", help="install deferred components if they are missing")
+    ensure_parser.add_argument("components", nargs="+", choices=LAZY_COMPONENTS)
+    ensure_parser.add_argument("--workspace", default=".", help="workspace to install into (default: current)")
+    expand_parser = subparsers.add_parser("expand-ndk", help="add ABIs to a sparse NDK install")
+    expand_parser.add_argument("abis", nargs="*", metavar="ABI",
+                               help=f"ABIs to add: {', '.join(NDK_ABI_TOKENS)} (default: complete the NDK)")
+    expand_parser.add_argument("--workspace", default=".", help="workspace to expand (default: current)")
+    verify_parser = subparsers.add_parser("verify", help="check installed files against the recorded sizes and hashes")
+    verify_parser.add_argument("--full", action="store_true", help="hash every file, not only those whose metadata changed")
+    verify_parser.add_argument("--workspace", default=".", help="workspace to verify (default: current)")
+    export_parser = subparsers.add_parser("export-snapshot", help="pack the installed toolchain into a snapshot file")
+    export_parser.add_argument("snapshot")
+    export_parser.add_argument("--workspace", default=".", help="workspace to export (default: current)")
+    restore_parser = subparsers.add_parser("restore-snapshot", help="restore a toolchain snapshot into a workspace")
+    restore_parser.add_argument("snapshot")
+    restore_parser.add_argument("--workspace", default=".", help="workspace to restore into (default: current)")
+    node_parser = subparsers.add_parser("cache-node", help="run a Gradle HTTP build cache node for generated projects")
+    node_parser.add_argument("--host", default="0.0.0.0")
+    node_parser.add_argument("--port", type=int, default=5071)
+    node_parser.add_argument("--dir", help="where entries are stored (default: <cache>/build-cache)")
+    node_parser.add_argument("--max-gb", type=float,
+                             help="size limit, least recently used entries are evicted first "
+                                  "(default: 10, or set ANDROID_ENV_BUILD_CACHE_MAX_GB)")
+    serve_parser = subparsers.add_parser("serve", help="serve the artifact cache as a LAN mirror")
+    serve_parser.add_argument("--host", default="0.0.0.0")
+    serve_parser.add_argument("--port", type=int, default=8080)
+    return parser.parse_args(argv)
+
+def main(argv=None):
     """Main function to set up the Android development environment."""
-    print("Starting Android development environment setup...")
+    global SDK_INSTALLER, MIRROR_URL, MAX_BYTES_PER_SECOND, BUILD_CACHE_URL
+    args = parse_args(argv)
+    BUILD_CACHE_URL = getattr(args, "build_cache", None) or BUILD_CACHE_URL
+    mirrors_file = getattr(args, "mirrors", None) or MIRRORS_FILE
+    if mirrors_file:
+        load_mirrors(mirrors_file)
+    if args.command == "cache-stats":
+        cache_stats()
+        return
+    if args.command == "lock-python-dependencies":
+        lock_python_dependencies()
+        return
+    if args.command == "generate":
+        if not generate_projects(args.manifest, args.output_dir, args.jobs):
+            exit(1)
+        return
+    if args.command == "assets":
+        if not optimize_assets(args.project, args.jobs):
+            exit(1)
+        return
+    if args.command == "update":
+        MIRROR_URL = (args.mirror or MIRROR_URL).rstrip("/")
+        if not update_component(Workspace(args.workspace), args.component, args.target or args.component):
+            exit(1)
+        return
+    if args.command == "ensure":
+        if not ensure_components(Workspace(args.workspace), args.components):
+            exit(1)
+        return
+    if args.command == "expand-ndk":
+        if not expand_ndk(Workspace(args.workspace), args.abis):
+            exit(1)
+        return
+    if args.command == "verify":
+        if not verify_installation(Workspace(args.workspace), args.full):
+            exit(1)
+        return
+    if args.command == "export-snapshot":
+        if not export_snapshot(Workspace(args.workspace), args.snapshot):
+            exit(1)
+        return
+    if args.command == "restore-snapshot":
+        if not restore_snapshot(Workspace(args.workspace), args.snapshot):
+            exit(1)
+        return
+    if args.command == "serve":
+        serve_artifacts(args.host, args.port)
+        return
+    if args.command == "cache-node":
+        serve_build_cache(args.host, args.port, args.dir, args.max_gb and int(args.max_gb * 1024 ** 3))
+        return
     
-    # Install dependencies in order
-    if not download_gradle():
-        print("Error: Failed to install Gradle. Please check the logs above for details.")
+    SDK_INSTALLER = getattr(args, "sdk_installer", None) or SDK_INSTALLER
+    MIRROR_URL = (getattr(args, "mirror", None) or MIRROR_URL).rstrip("/")
+    if getattr(args, "max_mb_per_s", None) is not None:
+        MAX_BYTES_PER_SECOND = int(args.max_mb_per_s * 1024 ** 2)
+    
+    trace_path = getattr(args, "trace", None)
+    force = getattr(args, "force", False)
+    if args.command == "provision-many":
+        print(f"Provisioning {len(args.workspaces)} workspaces...")
+        try:
+            failed = provision_many(args.workspaces, args.jobs, force, args.profile, args.lazy, args.ndk_abis)
+        finally:
+            if trace_path:
+                write_trace(trace_path)
+        if failed:
+            print("Error: Setup did not complete for: " + ", ".join(failed))
+            exit(1)
+        print(f"\nProvisioned {len(args.workspaces)} workspaces")
         return
     
-    # Create directories
-    os.makedirs("android-sdk", exist_ok=True)
+    print("Starting Android development environment setup...")
     
-    # Install Java if needed
-    if not check_java():
-        print("Java installation required. Please install Java and try again.")
+    ws = Workspace(getattr(args, "workspace", "."), getattr(args, "profile", None), getattr(args, "lazy", None),
+                   getattr(args, "ndk_abis", None))
+    try:
+        ok = provision(ws, force)
+    finally:
+        if trace_path:
+            write_trace(trace_path)
+    if not ok:
+        print("Error: Setup did not complete. Please check the logs above for details.")
         exit(1)
     
-    tools_filename = download_android_tools()
-    extract_tools(tools_filename)
-    install_sdk_and_ndk()
-    install_python_dependencies()
-    verify_installation()
-    create_android_project_template("MyJavaApp", "com.example.myjavaapp")
-    create_kivy_project_template("MyKivyApp")
-    
-    print("\nAndroid development environment setup complete!")
-    print("\nTwo sample projects have been created:")
-    print("\n1. Java-based Android app (MyJavaApp):")
-    print("   - Open in Android Studio")
-    print("   - Build: './gradlew build'")
-    print("   - Run: './gradlew installDebug'")
-    print("\n2. Python-based Kivy app (MyKivyApp):")
-    print("   - cd MyKivyApp")
-    print("   - buildozer init")
-    print("   - buildozer android debug")
-    print("   - APK will be in the bin/ directory")
+    print(f"\nAndroid development environment setup complete! (profile: {ws.profile}"
+          f"{', lazy' if ws.lazy else ''})")
+    templates = PROFILES[ws.profile]["templates"]
+    print(f"\nSample projects created: {len(templates)}")
+    if "android" in templates:
+        print("\nJava-based Android app (MyJavaApp):")
+        print("   - Open in Android Studio")
+        print("   - Build: './gradlew build'")
+        print("   - Run: './gradlew installDebug'")
+    if "kivy" in templates:
+        print("\nPython-based Kivy app (MyKivyApp):")
+        print("   - cd MyKivyApp")
+        print("   - buildozer init")
+        print("   - ./build-android.sh (buildozer android debug with the shared build cache)")
+        print("   - APK will be in the bin/ directory")
+    if ws.lazy:
+        print("\nThe NDK and Python toolchain are installed on first use "
+              "(or run 'python setup_android_env.py ensure ndk python').")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,75 @@
+"""Shared fixtures: an isolated cache and a local HTTP server with Range support."""
+import os
+import sys
+import tempfile
+import threading
+import http.server
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+os.environ["ANDROID_ENV_CACHE"] = tempfile.mkdtemp(prefix="android-env-test-cache-")
+os.environ.pop("ANDROID_ENV_MIRROR", None)
+os.environ.pop("ANDROID_ENV_MIRRORS_FILE", None)
+
+import setup_android_env as env  # noqa: E402
+
+
+class FileHandler(http.server.BaseHTTPRequestHandler):
+    """Serve server.files ({path: bytes}).
+
+    Range is honoured if server.ranges is True and answered with 400 if it
+    is "reject". server.status, if set, replaces the status of successful
+    responses. With server.truncate set, responses stop after that many
+    bytes of body and the connection is closed.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get("Range")))
+        data = self.server.files.get(self.path)
+        if data is None:
+            return self.send_error(404)
+        byte_range = None
+        if self.server.ranges == "reject" and self.headers.get("Range"):
+            return self.send_error(400)
+        if self.server.ranges:
+            try:
+                byte_range = env._parse_range(self.headers.get("Range"), len(data))
+            except ValueError:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+        start, end = byte_range or (0, len(data) - 1)
+        self.send_response(self.server.status or (206 if byte_range else 200))
+        self.send_header("Content-Length", str(end - start + 1))
+        if byte_range:
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        self.end_headers()
+        body = data[start:end + 1]
+        if self.server.truncate is not None and len(body) > self.server.truncate:
+            self.wfile.write(body[:self.server.truncate])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def http_server():
+    """Start a local server; returns it with files, ranges, status, truncate, requests and url()."""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FileHandler)
+    server.daemon_threads = True
+    server.files, server.ranges, server.status, server.truncate, server.requests = {}, True, None, None, []
+    server.url = lambda path: f"http://127.0.0.1:{server.server_address[1]}{path}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,120 @@
+"""Segmented, resumable downloads against a local HTTP server."""
+import os
+import json
+import random
+import hashlib
+
+import pytest
+
+import setup_android_env as env
+
+DATA = random.Random(0).randbytes(300_000)
+
+
+@pytest.fixture(autouse=True)
+def small_segments(monkeypatch):
+    monkeypatch.setattr(env, "DOWNLOAD_CONNECTIONS", 4)
+    monkeypatch.setattr(env, "SEGMENT_MIN_BYTES", 50_000)
+
+
+@pytest.mark.parametrize("header,size,expected", [
+    ("bytes=0-0", 10, (0, 0)),
+    ("bytes=2-5", 10, (2, 5)),
+    ("bytes=4-", 10, (4, 9)),
+    ("bytes=5-100", 10, (5, 9)),
+    ("bytes=-3", 10, (7, 9)),
+    ("bytes=-30", 10, (0, 9)),
+    (None, 10, None),
+    ("items=0-1", 10, None),
+    ("bytes=0-1,4-5", 10, None),
+    ("bytes=a-b", 10, None),
+])
+def test_parse_range(header, size, expected):
+    assert env._parse_range(header, size) == expected
+
+
+@pytest.mark.parametrize("header,size", [("bytes=10-", 10), ("bytes=5-2", 10), ("bytes=-0", 10), ("bytes=0-0", 0)])
+def test_parse_range_unsatisfiable(header, size):
+    with pytest.raises(ValueError):
+        env._parse_range(header, size)
+
+
+def test_plan_segments_cover_the_file():
+    segments = env._plan_segments(len(DATA))
+    assert len(segments) == 4
+    assert segments[0][0] == 0 and segments[-1][1] == len(DATA)
+    assert all(a[1] == b[0] for a, b in zip(segments, segments[1:]))
+
+
+def test_segments_are_merged_into_the_file(tmp_path, http_server):
+    http_server.files["/a.bin"] = DATA
+    path = str(tmp_path / "a.bin")
+    assert env._download_to_file(http_server.url("/a.bin"), path) == (hashlib.sha256(DATA).hexdigest(), len(DATA))
+    with open(path, "rb") as f:
+        assert f.read() == DATA
+    assert not os.path.exists(path + ".json")
+    ranges = sorted(header for _, header in http_server.requests if header != "bytes=0-0")
+    assert len(ranges) == 4
+
+
+def test_resumes_from_the_journal(tmp_path, http_server):
+    http_server.files["/a.bin"] = DATA
+    url = http_server.url("/a.bin")
+    path = str(tmp_path / "a.bin")
+    segments = env._plan_segments(len(DATA))
+    with open(path, "wb") as f:
+        f.truncate(len(DATA))
+        for segment in segments[:2]:
+            segment[2] = (segment[1] - segment[0]) // 2
+            f.seek(segment[0])
+            f.write(DATA[segment[0]:segment[0] + segment[2]])
+    with open(path + ".json", "w") as f:
+        json.dump({"url": url, "size": len(DATA), "etag": None, "segments": segments}, f)
+
+    assert env._download_to_file(url, path)[1] == len(DATA)
+    with open(path, "rb") as f:
+        assert f.read() == DATA
+    ranges = {header for _, header in http_server.requests}
+    for start, end, done in segments:
+        assert f"bytes={start + done}-{end - 1}" in ranges
+
+
+def test_interrupted_download_keeps_its_progress(tmp_path, monkeypatch, http_server):
+    # Bytes of a buffer cut short by the closed connection are lost
+    monkeypatch.setattr(env, "DOWNLOAD_BUFFER_BYTES", 1000)
+    http_server.files["/a.bin"] = DATA
+    url = http_server.url("/a.bin")
+    path = str(tmp_path / "a.bin")
+    http_server.truncate = 10_000
+    with pytest.raises(Exception):
+        env._download_to_file(url, path)
+    with open(path + ".json") as f:
+        journal = json.load(f)
+    assert all(done >= 10_000 for _, _, done in journal["segments"])
+
+    http_server.truncate = None
+    http_server.requests.clear()
+    assert env._download_to_file(url, path)[0] == hashlib.sha256(DATA).hexdigest()
+    ranges = {header for _, header in http_server.requests}
+    for start, end, done in journal["segments"]:
+        assert f"bytes={start + done}-{end - 1}" in ranges
+
+
+@pytest.mark.parametrize("ranges", [False, "reject"])
+def test_server_without_range_support(tmp_path, http_server, ranges):
+    http_server.files["/a.bin"] = DATA
+    http_server.ranges = ranges
+    path = str(tmp_path / "a.bin")
+    assert env._download_to_file(http_server.url("/a.bin"), path)[1] == len(DATA)
+    with open(path, "rb") as f:
+        assert f.read() == DATA
+    assert not os.path.exists(path + ".json")
+
+
+@pytest.mark.parametrize("ranges", [True, False, "reject"])
+def test_empty_file(tmp_path, http_server, ranges):
+    http_server.files["/empty"] = b""
+    http_server.ranges = ranges
+    path = str(tmp_path / "empty")
+    assert env._download_to_file(http_server.url("/empty"), path) == (hashlib.sha256(b"").hexdigest(), 0)
+    assert os.path.getsize(path) == 0
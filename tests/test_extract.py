@@ -0,0 +1,96 @@
+"""Archive extraction and delta updates never write outside their destination."""
+import io
+import os
+import stat
+import zipfile
+
+import pytest
+
+import setup_android_env as env
+
+
+def make_zip(entries):
+    """Return a zip of (name, data) files and (name, None, link target) symlinks."""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, data, *link in entries:
+            info = zipfile.ZipInfo(name, (2024, 1, 1, 0, 0, 0))
+            info.create_system = 3
+            if link:
+                info.external_attr = (stat.S_IFLNK | 0o777) << 16
+                zf.writestr(info, link[0])
+            else:
+                info.external_attr = (stat.S_IFREG | 0o644) << 16
+                zf.writestr(info, data)
+    return buffer.getvalue()
+
+
+VALID = [("pkg/bin/tool", b"tool"), ("pkg/lib/libc.so", b"lib"), ("pkg/tool", None, "bin/tool"),
+         ("pkg/lib/current", None, ".")]
+
+UNSAFE = {
+    "member below a symlink": [("pkg/link", None, "../../outside"), ("pkg/link/evil", b"x")],
+    "member below a symlink listed first": [("pkg/link/evil", b"x"), ("pkg/link", None, "../../outside")],
+    "symlink outside the tree": [("pkg/a", b"a"), ("pkg/link", None, "../../outside/evil")],
+    "absolute symlink": [("pkg/a", b"a"), ("pkg/link", None, "/")],
+    "symlink through a later symlink": [("pkg/a", None, "b/../outside"), ("pkg/b", None, "..")],
+    "parent path": [("pkg/../../outside/evil", b"x")],
+}
+
+
+@pytest.fixture
+def outside(tmp_path):
+    path = tmp_path / "outside"
+    path.mkdir()
+    return path
+
+
+def check_extracted(dest):
+    with open(os.path.join(dest, "tool"), "rb") as f:
+        assert f.read() == b"tool"
+    assert os.readlink(os.path.join(dest, "tool")) == "bin/tool"
+    assert os.path.isfile(os.path.join(dest, "lib", "current", "libc.so"))
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_extract_zip_restores_symlinks(tmp_path, monkeypatch, workers):
+    monkeypatch.setattr(env, "PARALLEL_EXTRACT_MIN_BYTES", 0)
+    archive = tmp_path / "ok.zip"
+    archive.write_bytes(make_zip(VALID))
+    dest = str(tmp_path / "a" / "dest")
+    assert env.extract_zip(str(archive), dest, strip_prefix="pkg/", workers=workers) == 4
+    check_extracted(dest)
+
+
+@pytest.mark.parametrize("entries", UNSAFE.values(), ids=UNSAFE.keys())
+def test_extract_zip_refuses_escapes(tmp_path, outside, entries):
+    archive = tmp_path / "bad.zip"
+    archive.write_bytes(make_zip(entries))
+    dest = tmp_path / "a" / "dest"
+    dest.parent.mkdir()
+    with pytest.raises(ValueError):
+        env.extract_zip(str(archive), str(dest), strip_prefix="pkg/", workers=1)
+    assert os.listdir(outside) == []
+    assert not dest.exists()
+    assert os.listdir(dest.parent) == []
+
+
+def test_delta_update_restores_symlinks(tmp_path, http_server):
+    http_server.files["/new.zip"] = make_zip(VALID)
+    dest = str(tmp_path / "a" / "dest")
+    result = env.delta_update(None, dest, http_server.url("/new.zip"), dest)
+    assert result["changed"] == 4
+    check_extracted(dest)
+    # A refresh against the same archive reuses the installed links
+    assert env.delta_update(None, dest, http_server.url("/new.zip"), dest)["reused"] == 4
+    check_extracted(dest)
+
+
+@pytest.mark.parametrize("entries", UNSAFE.values(), ids=UNSAFE.keys())
+def test_delta_update_refuses_escapes(tmp_path, outside, http_server, entries):
+    http_server.files["/bad.zip"] = make_zip(entries)
+    dest = tmp_path / "a" / "dest"
+    with pytest.raises(ValueError):
+        env.delta_update(None, str(dest), http_server.url("/bad.zip"), str(dest))
+    assert os.listdir(outside) == []
+    assert not dest.exists()
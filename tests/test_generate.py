@@ -0,0 +1,28 @@
+"""Project manifests for bulk generation."""
+import json
+
+import pytest
+
+import setup_android_env as env
+
+
+def write_manifest(tmp_path, projects):
+    path = tmp_path / "projects.json"
+    path.write_text(json.dumps(projects))
+    return str(path)
+
+
+def test_reads_distinct_projects(tmp_path):
+    projects = [{"app_name": "One", "package_name": "org.one"}, {"type": "kivy", "app_name": "Two"}]
+    assert env.read_project_manifest(write_manifest(tmp_path, projects)) == projects
+
+
+@pytest.mark.parametrize("second", ["One", "one", "./One", "One/"])
+def test_refuses_projects_sharing_a_directory(tmp_path, second):
+    path = write_manifest(tmp_path, [{"app_name": "One", "package_name": "org.one"},
+                                     {"type": "kivy", "app_name": second}])
+    with pytest.raises(ValueError, match="same directory"):
+        env.read_project_manifest(path)
+    with pytest.raises(ValueError):
+        env.generate_projects(path, str(tmp_path / "out"))
+    assert not (tmp_path / "out").exists()
@@ -0,0 +1,33 @@
+"""Fetching the SDK repository manifest from upstream and its mirrors."""
+import pytest
+import requests
+
+import setup_android_env as env
+
+
+@pytest.fixture
+def repository(tmp_path, monkeypatch, http_server):
+    monkeypatch.setattr(env, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(env, "REPOSITORY_URL", http_server.url("/upstream/"))
+    monkeypatch.setattr(env, "ARTIFACT_MIRRORS", {http_server.url("/upstream/"): [http_server.url("/mirror/")]})
+    return http_server
+
+
+def test_falls_back_to_a_mirror(repository):
+    repository.files["/mirror/" + env.REPOSITORY_MANIFEST] = b"<manifest/>"
+    assert env.fetch_repository_manifest() == b"<manifest/>"
+
+
+def test_refuses_a_response_that_is_not_200_or_304(repository):
+    repository.files["/upstream/" + env.REPOSITORY_MANIFEST] = b"<partial/>"
+    repository.files["/mirror/" + env.REPOSITORY_MANIFEST] = b"<partial/>"
+    repository.status = 203
+    with pytest.raises(requests.RequestException):
+        env.fetch_repository_manifest()
+
+
+def test_uses_the_cached_copy_when_no_source_answers(repository):
+    repository.files["/upstream/" + env.REPOSITORY_MANIFEST] = b"<manifest/>"
+    assert env.fetch_repository_manifest() == b"<manifest/>"
+    repository.files.clear()
+    assert env.fetch_repository_manifest() == b"<manifest/>"
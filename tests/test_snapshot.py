@@ -0,0 +1,71 @@
+"""Snapshot restore refuses indexes that would write outside the workspace."""
+import os
+import json
+import zlib
+import struct
+import hashlib
+
+import pytest
+
+import setup_android_env as env
+
+
+def write_snapshot(path, files, symlinks=None, dirs=None, roots=("jdk",)):
+    """Write a snapshot of {rel: bytes} files with a hand-made index."""
+    raw = b"".join(files.values())
+    data = zlib.compress(raw)
+    entries = [[rel, 0o644, len(content), 0] for rel, content in files.items()]
+    pieces = [[number, 0, entry[2]] for number, entry in enumerate(entries) if entry[2]]
+    with open(path, "wb") as f:
+        f.write(env.SNAPSHOT_MAGIC)
+        chunk = {"offset": f.tell(), "length": len(data), "size": len(raw),
+                 "sha256": hashlib.sha256(raw).hexdigest(), "pieces": pieces}
+        f.write(data)
+        index = zlib.compress(json.dumps({
+            "roots": list(roots), "files": entries, "symlinks": symlinks or {},
+            "dirs": dirs if dirs is not None else [[root, 0o755] for root in roots],
+            "chunks": [chunk] if raw else [],
+        }).encode())
+        index_offset = f.tell()
+        f.write(index)
+        f.write(struct.pack("<QQ", index_offset, len(index)) + env.SNAPSHOT_MAGIC)
+
+
+def tree(top):
+    """Return every path below top, without following symlinks."""
+    return sorted(os.path.join(dirpath, name) for dirpath, dirnames, filenames in os.walk(top)
+                  for name in dirnames + filenames)
+
+
+@pytest.fixture
+def workspace(tmp_path):
+    root = tmp_path / "ws"
+    root.mkdir()
+    return env.Workspace(str(root))
+
+
+def test_restores_files_and_inner_symlinks(tmp_path, workspace):
+    snapshot = str(tmp_path / "ok.snapshot")
+    write_snapshot(snapshot, {"jdk/bin/java": b"java"}, symlinks={"jdk/java": "bin/java"},
+                   dirs=[["jdk", 0o755], ["jdk/bin", 0o755]])
+    assert env.restore_snapshot(workspace, snapshot, workers=1)
+    with open(workspace.path("jdk", "java"), "rb") as f:
+        assert f.read() == b"java"
+
+
+@pytest.mark.parametrize("files,symlinks,roots", [
+    ({"jdk/../../evil": b"x"}, {}, ["jdk"]),
+    ({"/tmp/evil": b"x"}, {}, ["jdk"]),
+    ({"C:/evil": b"x"}, {}, ["jdk"]),
+    ({"evil": b"x"}, {}, [".."]),
+    ({"evil/file": b"x"}, {}, ["jdk"]),
+    ({"jdk/link/evil": b"x"}, {"jdk/link": ".."}, ["jdk"]),
+    ({}, {"jdk/link": "../../evil"}, ["jdk"]),
+    ({}, {"jdk/link": "/tmp"}, ["jdk"]),
+])
+def test_refuses_unsafe_index(tmp_path, workspace, files, symlinks, roots):
+    snapshot = str(tmp_path / "bad.snapshot")
+    write_snapshot(snapshot, files, symlinks, roots=roots)
+    before = tree(tmp_path)
+    assert not env.restore_snapshot(workspace, snapshot, workers=1)
+    assert tree(tmp_path) == before